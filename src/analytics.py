@@ -0,0 +1,134 @@
+import numpy
+
+
+# d2 constant for moving ranges of two, used to estimate sigma of individuals
+D2 = 1.128
+
+# Robust z-score above which a value is flagged as outlier
+OUTLIER_Z = 3.5
+
+
+# Loaders return dict of numpy arrays. data.csv and counting.csv have a comma inside the
+# time column, so column indices are one more than the number of fields before it.
+
+def loadWeighings(path):
+	weight, stabilization_time = numpy.loadtxt(path, delimiter=",", usecols=(3, 5), unpack=True, ndmin=2)
+	return {"weight": weight, "stabilization_time": stabilization_time}
+
+
+def loadCounting(path):
+	session, weight = numpy.loadtxt(path, delimiter=",", usecols=(0, 4), unpack=True, ndmin=2)
+	return {"session": session.astype(numpy.int64), "weight": weight}
+
+
+# Archive written by archive.ArchiveWriter, rows with t1 <= time < t2.
+def loadArchive(path, t1=-numpy.inf, t2=numpy.inf):
+	from archive import ArchiveReader
+
+	return ArchiveReader(path).range(t1, t2)
+
+
+# Samples currently held in a ringbuffer.SampleRing, oldest first.
+def loadRing(ring):
+	return {name: numpy.asarray(column) for name, column in ring.snapshot(ring.capacity).items()}
+
+
+# Cp and Cpk for given mean and std (arrays or scalars), nan where limits are missing.
+def capability(mean, std, lsl=None, usl=None):
+	with numpy.errstate(divide="ignore", invalid="ignore"):
+		if lsl is None or usl is None:
+			cp = numpy.full(numpy.shape(mean), numpy.nan)
+		else:
+			cp = (usl - lsl) / (6 * std)
+		upper = (usl - mean) / (3 * std) if usl is not None else numpy.full(numpy.shape(mean), numpy.inf)
+		lower = (mean - lsl) / (3 * std) if lsl is not None else numpy.full(numpy.shape(mean), numpy.inf)
+		cpk = numpy.minimum(upper, lower)
+		cpk = numpy.where(numpy.isinf(cpk), numpy.nan, cpk)
+	return cp, cpk
+
+
+# Statistics per session: session id, count, mean, std (sample), min, max, Cp, Cpk.
+# Sessions are grouped with one sort and reduceat, no Python loop over rows or sessions.
+def sessionStats(session, weight, lsl=None, usl=None):
+	order = numpy.argsort(session, kind="stable")
+	session = session[order]
+	weight = weight[order]
+	ids, starts, counts = numpy.unique(session, return_index=True, return_counts=True)
+	if not len(ids):
+		empty = numpy.empty(0)
+		return {"session": ids, "count": counts, "mean": empty, "std": empty, "min": empty, "max": empty, "cp": empty, "cpk": empty}
+
+	sums = numpy.add.reduceat(weight, starts)
+	mean = sums / counts
+	deviation = weight - numpy.repeat(mean, counts)
+	sq = numpy.add.reduceat(deviation * deviation, starts)
+	with numpy.errstate(divide="ignore", invalid="ignore"):
+		std = numpy.sqrt(sq / (counts - 1))
+	cp, cpk = capability(mean, std, lsl, usl)
+	return {
+		"session": ids,
+		"count": counts,
+		"mean": mean,
+		"std": std,
+		"min": numpy.minimum.reduceat(weight, starts),
+		"max": numpy.maximum.reduceat(weight, starts),
+		"cp": cp,
+		"cpk": cpk
+	}
+
+
+# Individuals chart: center line and 3 sigma limits, sigma estimated from mean moving range.
+def individualsLimits(x):
+	x = numpy.asarray(x, dtype=float)
+	center = x.mean()
+	sigma = numpy.abs(numpy.diff(x)).mean() / D2 if len(x) > 1 else 0.0
+	return center - 3 * sigma, center, center + 3 * sigma
+
+
+# X-bar chart over sessions: limits per session from pooled within-session std.
+def xbarLimits(mean, std, count):
+	valid = count > 1
+	center = numpy.average(mean, weights=count)
+	pooled = numpy.sqrt(numpy.sum((count[valid] - 1) * std[valid] ** 2) / numpy.sum(count[valid] - 1))
+	half = 3 * pooled / numpy.sqrt(count)
+	return center - half, center, center + half
+
+
+# Boolean mask of outliers by robust z-score (median and MAD), insensitive to the outliers themselves.
+def outliers(x, z=OUTLIER_Z):
+	x = numpy.asarray(x, dtype=float)
+	median = numpy.median(x)
+	mad = numpy.median(numpy.abs(x - median))
+	if mad == 0:
+		return x != median
+	return numpy.abs(0.6745 * (x - median) / mad) > z
+
+
+# Robust piece weight from many single-piece readings: mean of the readings that are not
+# outliers. Returns (weight, std, number of readings used).
+def referenceWeight(x, z=OUTLIER_Z):
+	x = numpy.asarray(x, dtype=float)
+	inliers = x[~outliers(x, z)]
+	if not len(inliers):
+		return numpy.nan, numpy.nan, 0
+	std = inliers.std(ddof=1) if len(inliers) > 1 else 0.0
+	return inliers.mean(), std, len(inliers)
+
+
+if __name__ == "__main__":
+	import argparse
+
+	parser = argparse.ArgumentParser(description="Statistics of counting sessions in counting.csv")
+	parser.add_argument("path", nargs="?", default="counting.csv")
+	parser.add_argument("--lsl", type=float)
+	parser.add_argument("--usl", type=float)
+	args = parser.parse_args()
+
+	data = loadCounting(args.path)
+	stats = sessionStats(data["session"], data["weight"], args.lsl, args.usl)
+	flagged = outliers(data["weight"])
+	print("session  count      mean       std       min       max     Cp    Cpk")
+	for row in zip(*(stats[key] for key in ("session", "count", "mean", "std", "min", "max", "cp", "cpk"))):
+		print("{0:7d} {1:6d} {2:9.3f} {3:9.4f} {4:9.3f} {5:9.3f} {6:6.2f} {7:6.2f}".format(*row))
+	print("outliers: {0} of {1} objects".format(int(flagged.sum()), len(flagged)))
+	print("reference piece weight: {0:.4f} (std {1:.4f}, n={2})".format(*referenceWeight(data["weight"])))
@@ -0,0 +1,307 @@
+import json
+import math
+import os
+import time
+from array import array
+
+from sample import STATUS_CODES, Status, TIME_FORMAT
+
+
+# Columns as (name, array typecode). First column is time (wall clock seconds) and has to be
+# non-decreasing, readers rely on it for range lookups.
+WEIGHINGS = (
+	("time", "d"),
+	("status", "B"),
+	("weight", "d"),
+	("unit", "B"),
+	("stabilization_time", "d"),
+	("pressure", "f"),
+	("humidity", "f"),
+	("temperature", "f")
+)
+
+COUNTING = (
+	("time", "d"),
+	("session", "q"),
+	("status", "B"),
+	("weight", "d"),
+	("unit", "B")
+)
+
+SCHEMAS = {
+	"weighings": WEIGHINGS,
+	"counting": COUNTING
+}
+
+CHUNK_ROWS = 1 << 16
+ARCHIVE_META = "archive.json"
+CHUNK_META = "chunk.json"
+
+# Metadata is rewritten after this many rows or seconds, when a chunk is full and on close.
+# Readers see rows up to the last metadata written.
+META_ROWS = 4096
+META_INTERVAL = 5.0
+
+
+# "1013 mbar" -> 1013.0, "" -> nan
+def envValue(text):
+	try:
+		return float(text.split()[0])
+	except (IndexError, ValueError):
+		return math.nan
+
+
+def _chunkName(n):
+	return "{0:08d}".format(n)
+
+
+# Appends rows to an archive directory:
+#	archive.json             schema, unit table
+#	00000000/chunk.json      rows, first and last time of the chunk
+#	00000000/<column>.bin    raw values of one column, native byte order
+# A chunk holds at most chunk_rows rows, then a new one is started. Rows are buffered in
+# typed arrays and appended to the column files on flush(). The column files of the last
+# chunk stay open, metadata is rewritten every meta_rows rows or meta_interval seconds.
+class ArchiveWriter():
+
+	def __init__(self, path, kind="weighings", chunk_rows=CHUNK_ROWS, meta_rows=META_ROWS, meta_interval=META_INTERVAL):
+		self.path = path
+		os.makedirs(path, exist_ok=True)
+		meta_path = os.path.join(path, ARCHIVE_META)
+		if os.path.exists(meta_path):
+			with open(meta_path) as f:
+				meta = json.load(f)
+			assert meta["kind"] == kind, "[ArchiveWriter] archive holds " + meta["kind"]
+		else:
+			meta = {"kind": kind, "schema": SCHEMAS[kind], "chunk_rows": chunk_rows, "units": []}
+		self.meta = meta
+		self.schema = [tuple(column) for column in meta["schema"]]
+		self.chunk_rows = meta["chunk_rows"]
+		self.units = {unit: i for i, unit in enumerate(meta["units"])}
+		self.meta_rows = meta_rows
+		self.meta_interval = meta_interval
+
+		chunks = sorted(name for name in os.listdir(path) if name.isdigit())
+		self.chunk = int(chunks[-1]) if chunks else 0
+		self.chunk_meta = self._readChunkMeta(self.chunk)
+		self.buffers = [array(code) for name, code in self.schema]
+		self.files = None  # open column files of the last chunk
+		self.unsaved = 0  # rows written since metadata was
+		self.saved = time.monotonic()
+
+
+	def _readChunkMeta(self, n):
+		try:
+			with open(os.path.join(self.path, _chunkName(n), CHUNK_META)) as f:
+				return json.load(f)
+		except FileNotFoundError:
+			return {"rows": 0, "t_min": None, "t_max": None}
+
+
+	# Column files of the current chunk, cut to the rows in its metadata. Rows written after
+	# the last metadata by a writer that did not close are dropped, the columns stay aligned.
+	def _openChunk(self):
+		directory = os.path.join(self.path, _chunkName(self.chunk))
+		os.makedirs(directory, exist_ok=True)
+		self.files = []
+		for name, code in self.schema:
+			f = open(os.path.join(directory, name + ".bin"), "ab")
+			f.truncate(self.chunk_meta["rows"] * array(code).itemsize)
+			self.files.append(f)
+
+
+	def _closeChunk(self):
+		if self.files is not None:
+			for f in self.files:
+				f.close()
+			self.files = None
+
+
+	def unitCode(self, unit):
+		code = self.units.get(unit)
+		if code is None:
+			code = self.units[unit] = len(self.meta["units"])
+			self.meta["units"].append(unit)
+		return code
+
+
+	# Row with values in schema order, unit as text.
+	def append(self, row):
+		for buffer, (name, code), value in zip(self.buffers, self.schema, row):
+			buffer.append(self.unitCode(value) if name == "unit" else value)
+
+
+	# Stable reading queued for Libra.writefile, see libra.formatRecord.
+	def appendRecord(self, record):
+		sample, stabilization_time, env_data = record
+		self.append((
+			sample.wallTime(),
+			sample.status,
+			sample.weight,
+			sample.unit,
+			stabilization_time,
+			envValue(env_data["pressure"]),
+			envValue(env_data["humidity"]),
+			envValue(env_data["temperature"])
+		))
+
+
+	def flush(self):
+		rows = len(self.buffers[0])
+		start = 0
+		while start < rows:
+			if self.chunk_meta["rows"] >= self.chunk_rows:
+				self._closeChunk()
+				self.chunk += 1
+				self.chunk_meta = {"rows": 0, "t_min": None, "t_max": None}
+			n = min(rows - start, self.chunk_rows - self.chunk_meta["rows"])
+			self._writeChunk(start, start + n)
+			start += n
+		self.buffers = [array(code) for name, code in self.schema]
+		if self.unsaved >= self.meta_rows or (self.unsaved and time.monotonic() - self.saved >= self.meta_interval):
+			self._writeMeta()
+
+
+	def _writeChunk(self, start, end):
+		if self.files is None:
+			self._openChunk()
+		for buffer, f in zip(self.buffers, self.files):
+			buffer[start:end].tofile(f)
+			f.flush()
+
+		times = self.buffers[0]
+		meta = self.chunk_meta
+		meta["rows"] += end - start
+		if meta["t_min"] is None:
+			meta["t_min"] = times[start]
+		meta["t_max"] = times[end - 1]
+		self.unsaved += end - start
+		if meta["rows"] >= self.chunk_rows:
+			self._writeMeta()  # chunk is done, readers see all of it
+
+
+	# Metadata is written after the data, a reader never sees rows that are not there.
+	def _writeMeta(self):
+		self._writeJson(os.path.join(self.path, _chunkName(self.chunk), CHUNK_META), self.chunk_meta)
+		self._writeJson(os.path.join(self.path, ARCHIVE_META), self.meta)
+		self.unsaved = 0
+		self.saved = time.monotonic()
+
+
+	def _writeJson(self, path, data):
+		with open(path + ".tmp", "w") as f:
+			json.dump(data, f)
+		os.replace(path + ".tmp", path)
+
+
+	def close(self):
+		self.flush()
+		if self.unsaved:
+			self._writeMeta()
+		self._closeChunk()
+
+
+# Reads an archive written by ArchiveWriter with numpy.memmap, without copying data.
+# numpy is imported in the methods that use it, writing (Libra) does not need it.
+class ArchiveReader():
+
+	def __init__(self, path):
+		self.path = path
+		with open(os.path.join(path, ARCHIVE_META)) as f:
+			self.meta = json.load(f)
+		self.schema = [tuple(column) for column in self.meta["schema"]]
+		self.units = self.meta["units"]
+		self.chunks = []  # (number, chunk meta)
+		for name in sorted(name for name in os.listdir(path) if name.isdigit()):
+			try:
+				with open(os.path.join(path, name, CHUNK_META)) as f:
+					meta = json.load(f)
+			except FileNotFoundError:  # chunk just started, no rows saved yet
+				continue
+			if meta["rows"]:
+				self.chunks.append((int(name), meta))
+
+
+	def __len__(self):
+		return sum(meta["rows"] for n, meta in self.chunks)
+
+
+	# Columns of chunk n as dict of read-only memmaps.
+	def chunk(self, n, rows):
+		import numpy
+
+		directory = os.path.join(self.path, _chunkName(n))
+		return {
+			name: numpy.memmap(os.path.join(directory, name + ".bin"), dtype=numpy.dtype(code), mode="r", shape=(rows,))
+			for name, code in self.schema
+		}
+
+
+	# Rows with t1 <= time < t2 as one dict of column views per chunk (no copying).
+	def rangeChunks(self, t1=-math.inf, t2=math.inf):
+		import numpy
+
+		for n, meta in self.chunks:
+			if meta["t_max"] < t1 or meta["t_min"] >= t2:
+				continue
+			columns = self.chunk(n, meta["rows"])
+			lo, hi = numpy.searchsorted(columns["time"], [t1, t2], side="left")
+			if lo < hi:
+				yield {name: column[lo:hi] for name, column in columns.items()}
+
+
+	# Rows with t1 <= time < t2 as dict of arrays. A range within one chunk is returned
+	# without copying, ranges spanning chunks are concatenated.
+	def range(self, t1=-math.inf, t2=math.inf):
+		import numpy
+
+		parts = list(self.rangeChunks(t1, t2))
+		if len(parts) == 1:
+			return parts[0]
+		return {
+			name: numpy.concatenate([part[name] for part in parts]) if parts else numpy.empty(0, dtype=numpy.dtype(code))
+			for name, code in self.schema
+		}
+
+
+# "10/18/2026, 17:11:13" split by comma -> wall clock seconds
+def _parseTime(date, clock):
+	return time.mktime(time.strptime(date + "," + clock, TIME_FORMAT))
+
+
+# Convert data.csv (kind "weighings") or counting.csv (kind "counting") to an archive.
+# Returns number of rows converted, rows that can not be parsed are skipped.
+def convertCsv(csv_path, archive_path, kind="weighings"):
+	writer = ArchiveWriter(archive_path, kind)
+	rows = 0
+	with open(csv_path, encoding="utf-8") as f:
+		for line in f:
+			parts = line.rstrip("\n").split(",")  # time has a comma in it
+			try:
+				if kind == "counting":
+					session, date, clock, status, weight, unit = parts[:6]
+					row = (_parseTime(date, clock), int(session), STATUS_CODES.get(status, Status.OTHER), float(weight), unit)
+				else:
+					date, clock, status, weight, unit, stabilization_time, pressure, humidity, temperature = parts[:9]
+					row = (
+						_parseTime(date, clock), STATUS_CODES.get(status, Status.OTHER), float(weight), unit,
+						float(stabilization_time), envValue(pressure), envValue(humidity), envValue(temperature)
+					)
+			except ValueError:
+				continue
+			writer.append(row)
+			rows += 1
+			if rows % writer.chunk_rows == 0:
+				writer.flush()
+	writer.close()
+	return rows
+
+
+if __name__ == "__main__":
+	import sys
+
+	if len(sys.argv) < 3:
+		print("usage: archive.py data.csv|counting.csv ARCHIVE_DIR [weighings|counting]")
+		sys.exit(1)
+	kind = sys.argv[3] if len(sys.argv) > 3 else ("counting" if "counting" in sys.argv[1] else "weighings")
+	print("{0} rows converted".format(convertCsv(sys.argv[1], sys.argv[2], kind)))
@@ -0,0 +1,229 @@
+import asyncio
+import collections
+import time
+
+import serial
+
+from commands import COMMAND_TIMEOUT
+from counting import CountingEngine, OnceCounting, RowCounting, DONE
+from framing import FrameParser
+from libra import CMD_CONT_READ, CMD_SET_TARE, STABLE, UNSTABLE, NAN
+from ringbuffer import SampleRing, SAMPLE_CAPACITY
+from sessions import MemorySessions
+from stability import StabilityDetector
+
+
+# Libra driven by an asyncio event loop instead of threads. The serial port is put in
+# non-blocking mode and registered with the loop, so no thread sits in read_until.
+# Lines are either responses to pending commands (routed by their first word) or samples,
+# which go to the ring buffer and wake up everyone awaiting the stream. Samples are also fed
+# to a stability detector and the countings run by a counting engine, as in Libra.
+#
+#	async with AsyncLibra("/dev/ttyUSB0") as libra:
+#		await libra.tare()
+#		async for sample in libra.stream():
+#			...
+#
+# Only POSIX serial ports are supported, as the loop needs a file descriptor to watch.
+class AsyncLibra():
+
+	def __init__(self, port=None, baudrate=2400, bytesize=serial.SEVENBITS, parity=serial.PARITY_EVEN,
+			stopbits=serial.STOPBITS_ONE, xonxoff=True, ser=None, sample_capacity=SAMPLE_CAPACITY, product="default",
+			sessions=None):
+		self.port = port
+		self.serial_options = {
+			"baudrate": baudrate,
+			"bytesize": bytesize,
+			"parity": parity,
+			"stopbits": stopbits,
+			"xonxoff": xonxoff
+		}
+		self.ser = ser  # already opened serial-like object, used instead of opening port
+
+		self.samples = SampleRing(sample_capacity)
+		self.listeners = []  # callables called with every new sample, on the loop thread
+		self.current_tare = 0.00
+		self.stabilization_time = NAN
+		self.stabilization_time_start = None
+		self.stability = StabilityDetector.fromProfile(product)
+		self.counting = CountingEngine(self.stability)
+		self.sessions = sessions if sessions is not None else MemorySessions()  # where row countings go
+		self.count_result = None  # counting.CountResult of last count_once
+
+		self.loop = None
+		self.parser = FrameParser()
+		self.pending = collections.defaultdict(collections.deque)  # response prefix -> futures
+		self.waiters = []  # futures of stream() consumers waiting for new samples
+		self.error = None  # exception that closed the port, if any
+
+
+	async def __aenter__(self):
+		await self.open()
+		return self
+
+
+	async def __aexit__(self, *args):
+		self.close()
+
+
+	async def open(self):
+		self.loop = asyncio.get_running_loop()
+		if self.ser is None:
+			self.ser = serial.Serial(port=self.port, timeout=0, **self.serial_options)
+		else:
+			self.ser.timeout = 0
+		self.loop.add_reader(self.ser.fileno(), self._onReadable)
+		self.ser.write(CMD_CONT_READ)
+
+
+	def close(self, error=None):
+		if self.ser is None:
+			return
+		self.loop.remove_reader(self.ser.fileno())
+		self.ser.close()
+		self.ser = None
+		self.error = error
+
+		exc = error if error is not None else ConnectionError("[AsyncLibra] port closed")
+		for futures in self.pending.values():
+			for fut in futures:
+				if not fut.done():
+					fut.set_exception(exc)
+		self.pending.clear()
+		self._wakeUp()
+
+
+	def _onReadable(self):
+		try:
+			data = self.ser.read(self.ser.in_waiting or 1)
+		except serial.SerialException as e:
+			self.close(e)
+			return
+
+		got_sample = False
+		for sample, line in self.parser.parse(data, time.monotonic(), raw=True):
+			got_sample |= self._onLine(sample, line)
+
+		if got_sample:
+			self._wakeUp()
+
+
+	# Line as split by framing.FrameParser, with its sample if it is a weight. Returns True if
+	# line was a sample.
+	def _onLine(self, sample, line):
+		parts = line.split(None, 1)
+		if not parts:
+			return False
+		futures = self.pending.get(parts[0].decode("ascii", "replace"))
+		if futures:
+			fut = futures.popleft()
+			if not fut.done():
+				fut.set_result(line.decode("ascii", "replace").strip())
+			return False
+
+		if sample is None:
+			return False
+		self.samples.append(sample)
+		self._trackStabilization(sample)
+		self.stability.update(sample)
+		for listener in self.listeners:
+			listener(sample)
+		return True
+
+
+	def _trackStabilization(self, sample):
+		if self.stabilization_time_start is None and sample.status == UNSTABLE:
+			self.stabilization_time = NAN
+			self.stabilization_time_start = sample.timestamp
+		elif sample.status == STABLE and self.stabilization_time_start is not None:
+			self.stabilization_time = round(sample.timestamp - self.stabilization_time_start, 3)
+			self.stabilization_time_start = None
+
+
+	def _wakeUp(self):
+		waiters, self.waiters = self.waiters, []
+		for fut in waiters:
+			if not fut.done():
+				fut.set_result(None)
+
+
+	# Every sample read after the call, in order. Samples overwritten in the ring before the
+	# consumer got to them are skipped and counted in the reader's dropped count.
+	async def stream(self):
+		reader = self.samples.reader()
+		while True:
+			m = reader.get(0)
+			if m is not None:
+				yield m
+				continue
+			if self.ser is None:
+				return
+			fut = self.loop.create_future()
+			self.waiters.append(fut)
+			await fut
+
+
+	# Send cmd and return the response line starting with prefix.
+	async def command(self, cmd, prefix, timeout=COMMAND_TIMEOUT):
+		assert self.ser is not None, "[command] Not connected to serial port"
+		fut = self.loop.create_future()
+		try:
+			self.pending[prefix].append(fut)
+			self.ser.write(cmd)
+			return await asyncio.wait_for(fut, timeout)
+		finally:
+			if fut in self.pending.get(prefix, ()):
+				self.pending[prefix].remove(fut)
+
+
+	# Tare on next stable weight, response is "T S value unit".
+	async def tare(self, zero=False):
+		response = await self.command(CMD_SET_TARE, "T")
+		if not zero:
+			self.current_tare += float(response.split()[-2])
+		return self.current_tare
+
+
+	async def zero(self):
+		return await self.tare(zero=True)
+
+
+	# Wait until done() is true, stop (asyncio.Event) is set or the port is closed.
+	async def _until(self, done, stop=None):
+		stopped = asyncio.ensure_future(stop.wait()) if stop is not None else None
+		try:
+			while not done() and self.ser is not None and (stop is None or not stop.is_set()):
+				fut = self.loop.create_future()
+				self.waiters.append(fut)
+				await asyncio.wait([f for f in (fut, stopped) if f is not None], return_when=asyncio.FIRST_COMPLETED)
+		finally:
+			if stopped is not None:
+				stopped.cancel()
+
+
+	# Counting at once with counting.OnceCounting, as Libra.countApi(COUNT_ONCE) does. Returns
+	# the estimated number of pieces, the whole counting.CountResult is in self.count_result.
+	async def count_once(self, target_weight=None, reference_pieces=1, reference_group=False):
+		counting = OnceCounting(target_weight, reference_pieces, self.stability.threshold, reference_group)
+		id = self.counting.start(counting)
+		try:
+			await self._until(lambda: counting.state == DONE)
+		finally:
+			self.counting.stop(id)
+		if counting.result is None:
+			raise self.error if self.error is not None else ConnectionError("[AsyncLibra] port closed")
+		self.count_result = counting.result
+		return counting.result.estimate
+
+
+	# Counting in a row with counting.RowCounting until stop (asyncio.Event) is set, returns
+	# stable samples of counted objects. The session is ended in self.sessions (by default
+	# kept in memory only) also when the task is cancelled.
+	async def count_in_row(self, stop):
+		counting = RowCounting(self.sessions)
+		id = self.counting.start(counting)
+		try:
+			await self._until(lambda: counting.state == DONE, stop)
+		finally:
+			self.counting.stop(id)
+		return counting.session.objects
@@ -0,0 +1,357 @@
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import tty
+from array import array
+
+import serial
+
+import libra
+from environment import SensorSource
+from sample import Sample, Status
+from simulator import FakeScale, syntheticRow, formatLine
+from framing import FrameParser
+
+
+FRAME_INTERVAL = 0.04  # same as GUI refresh
+
+# Modules that must not be imported by import libra, they are loaded when used
+HEAVY_MODULES = ("numpy", "requests", "http.server", "serial.tools.list_ports", "PyQt4")
+
+# Run in a fresh interpreter by benchStartup, argv[1] is the port of a simulated scale
+STARTUP_SCRIPT = '''
+import sys, time
+start = time.perf_counter()
+import libra
+imported = time.perf_counter()
+heavy = [name for name in sys.argv[2:] if name in sys.modules]
+import serial
+from environment import SensorSource
+scale = libra.Libra(port=sys.argv[1], baudrate=115200, bytesize=serial.SEVENBITS, parity=serial.PARITY_EVEN,
+	stopbits=serial.STOPBITS_ONE, xonxoff=False, env_source=SensorSource(lambda: (1013, 40, 21)))
+constructed = time.perf_counter()
+while scale.samples.head == 0 and time.perf_counter() - constructed < 10:
+	time.sleep(0.001)
+first = time.perf_counter()
+print(imported - start, constructed - imported, first - constructed, ",".join(heavy))
+'''
+
+
+def percentiles(values, ps=(50, 90, 99)):
+	if not values:
+		return "n/a"
+	values = sorted(values)
+	return "  ".join("p{0}={1:.2f}ms".format(p, values[min(len(values) - 1, len(values) * p // 100)] * 1000) for p in ps)
+
+
+def openLibra(fake, **options):
+	return libra.Libra(
+		port=fake.port,
+		baudrate=115200,
+		bytesize=serial.SEVENBITS,
+		parity=serial.PARITY_EVEN,
+		stopbits=serial.STOPBITS_ONE,
+		xonxoff=False,
+		env_source=SensorSource(lambda: (1013, 40, 21)),
+		**options
+	)
+
+
+def closeLibra(scale):
+	scale.stopReadCont()
+	scale.stopWritefile()
+	scale.env.stop()
+
+
+# Rows appended to path as (monotonic time the row was seen, row).
+class FileFollower():
+
+	def __init__(self, path):
+		self.path = path
+		self.seen = []
+		self.stopped = False
+		self.thread = threading.Thread(target=self.run, daemon=True)
+		self.thread.start()
+
+	def run(self):
+		offset = 0
+		while not self.stopped:
+			if os.path.exists(self.path):
+				with open(self.path, "rb") as f:
+					f.seek(offset)
+					data = f.read()
+				data = data[:data.rfind(b"\n") + 1]
+				offset += len(data)
+				now = time.monotonic()
+				self.seen += [(now, row) for row in data.splitlines()]
+			time.sleep(0.001)
+
+	def stop(self):
+		self.stopped = True
+		self.thread.join()
+
+
+# Samples/sec, latency from serial line to ring buffer, csv row and GUI value, memory growth.
+def benchThroughput(rate, seconds):
+	fake = FakeScale(syntheticRow(50, seed=1), rate=rate).start()
+	tracemalloc.start()
+	scale = openLibra(fake, write_interval=0.05)
+	# send time of the serial line behind every record queued for the csv, in csv row order.
+	# Records are queued on readCont right after their sample went into the ring.
+	queued = []
+	put = scale.queue_writefile.put
+	def queue(item, *args, **kwargs):
+		if isinstance(item, tuple):
+			seq = scale.samples.head - 1
+			queued.append(fake.sent[seq] if seq < len(fake.sent) else None)
+		put(item, *args, **kwargs)
+	scale.queue_writefile.put = queue
+	follower = FileFollower(scale.all_file)
+
+	gui_latency = []
+	start = time.monotonic()
+	memory_start = None
+	while time.monotonic() - start < seconds:
+		time.sleep(FRAME_INTERVAL)
+		head = scale.samples.head
+		if head and head <= len(fake.sent):
+			gui_latency.append(time.monotonic() - fake.sent[head - 1])
+		if memory_start is None and time.monotonic() - start > seconds / 10:
+			memory_start = tracemalloc.get_traced_memory()[0]
+	elapsed = time.monotonic() - start
+	memory_end = tracemalloc.get_traced_memory()[0]
+
+	read_latency = []
+	first = max(scale.samples.head - scale.samples.capacity, 0)
+	for seq in range(first, min(scale.samples.head, len(fake.sent))):
+		read_latency.append(scale.samples.record(seq).timestamp - fake.sent[seq])
+
+	time.sleep(0.2)
+	follower.stop()
+	rows = [seen for seen, row in follower.seen if not row.startswith(b"#")]  # gap comments are not queued records
+	csv_latency = [seen - sent for seen, sent in zip(rows, queued) if sent is not None]
+	closeLibra(scale)
+	fake.stop()
+	tracemalloc.stop()
+
+	print("throughput @ {0} lines/s for {1}s".format(rate, seconds))
+	print("  samples/sec        {0:.1f} (sent {1:.1f})".format(scale.samples.head / elapsed, len(fake.sent) / elapsed))
+	print("  serial -> sample   " + percentiles(read_latency))
+	print("  serial -> csv row  " + percentiles(csv_latency) + "  ({0} rows)".format(len(rows)))
+	print("  serial -> GUI      " + percentiles(gui_latency))
+	print("  memory growth      {0:.1f} KiB".format((memory_end - (memory_start or 0)) / 1024))
+
+
+def benchCountRow(pieces, rate):
+	trace = syntheticRow(pieces, seed=2)
+	fake = FakeScale(trace, rate=rate, loop=False).start()
+	scale = openLibra(fake)
+	scale.countApi(libra.COUNT_ROW)
+	time.sleep(len(trace) / rate + 0.5)
+	scale.countApi(libra.COUNT_ROW, stop=True)
+	print("count in row @ {0} lines/s: counted {1} of {2}".format(rate, scale.count_results_row, pieces))
+	fake.streaming = True  # readCont needs a line to notice it was stopped
+	fake.loop = True
+	closeLibra(scale)
+	fake.stop()
+
+
+def benchCountOnce(pieces, rate, piece_weight=10.0):
+	reference = syntheticRow(1, piece_weight, seed=3)
+	heap = syntheticRow(1, piece_weight * pieces, seed=4)
+	trace = reference + [(Status.STABLE, 0.0)] * 10 + heap
+	fake = FakeScale(trace, rate=rate, loop=False).start()
+	scale = openLibra(fake)
+	scale.countApi(libra.COUNT_ONCE)
+	time.sleep(len(trace) / rate + 0.5)
+	print("count at once @ {0} lines/s: counted {1} of {2}".format(rate, scale.count_results_once, pieces))
+	fake.streaming = True
+	fake.loop = True
+	closeLibra(scale)
+	fake.stop()
+
+
+# Tare while streaming: time to the response and longest gap between samples around it.
+def benchTare(rate, tares=20):
+	fake = FakeScale(syntheticRow(3, seed=5), rate=rate).start()
+	scale = openLibra(fake)
+	time.sleep(0.5)
+	latency = []
+	first = scale.samples.head
+	for i in range(tares):
+		start = time.perf_counter()
+		scale.setTare()
+		latency.append(time.perf_counter() - start)
+		time.sleep(0.05)
+	timestamps = [scale.samples.record(seq).timestamp for seq in range(max(first, scale.samples.head - scale.samples.capacity), scale.samples.head)]
+	gap = max(b - a for a, b in zip(timestamps, timestamps[1:]))
+	print("tare @ {0} lines/s: response {1}, longest sample gap {2:.1f} ms".format(rate, percentiles(latency), gap * 1000))
+	closeLibra(scale)
+	fake.stop()
+
+
+# Cold start in a new process: import libra, construct Libra, first sample from the scale.
+def benchStartup(runs=5):
+	times = []
+	heavy = set()
+	for i in range(runs):
+		fake = FakeScale(syntheticRow(3, seed=6), rate=200).start()
+		out = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT, fake.port] + list(HEAVY_MODULES),
+			cwd=os.getcwd(), env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__))),
+			capture_output=True, text=True, check=True, timeout=30).stdout.split()
+		fake.stop()
+		times.append([float(t) for t in out[:3]])
+		heavy.update(out[3].split(",") if len(out) > 3 else ())
+
+	print("startup ({0} runs)".format(runs))
+	for i, name in enumerate(("import libra", "Libra()", "first sample")):
+		print("  {0:<18} {1}".format(name, percentiles([t[i] for t in times], (50, 90))))
+	print("  heavy imports      " + (", ".join(sorted(heavy)) or "none"))
+
+
+# Serial reading and parsing of the same stream: one read_until and Sample.parse per line
+# against bulk reads split by framing.FrameParser. Lines are written into a pty as fast as
+# it takes them, with a garbage line every 100 lines.
+def benchParse(lines=50000):
+	rnd = syntheticRow(lines // 16 + 1, seed=7)
+	data = b"".join(
+		formatLine(status, weight) if i % 100 else b"\x00garbage\r\n"
+		for i, (status, weight) in enumerate(rnd[:lines])
+	)
+
+	def perLine(ser):
+		n = 0
+		while True:
+			line = ser.read_until(serial.CR + serial.LF)
+			if not line:
+				return n
+			n += Sample.parse(line) is not None
+
+	def bulk(ser):
+		n = 0
+		parser = FrameParser()
+		while True:
+			chunk = ser.read(1)
+			if not chunk:
+				return n
+			waiting = ser.in_waiting
+			if waiting:
+				chunk += ser.read(waiting)
+			for sample, line in parser.parse(chunk, time.monotonic()):
+				n += sample is not None
+
+	print("parse {0} lines".format(lines))
+	for name, read in (("read_until + parse", perLine), ("bulk + FrameParser", bulk)):
+		master, slave = os.openpty()
+		tty.setraw(slave)
+		ser = serial.Serial(os.ttyname(slave), timeout=0.2)
+		writer = threading.Thread(target=lambda: os.write(master, data), daemon=True)
+		start, cpu = time.perf_counter(), time.process_time()
+		writer.start()
+		n = read(ser)
+		elapsed, cpu = time.perf_counter() - start - 0.2, time.process_time() - cpu
+		writer.join()
+		ser.close()
+		os.close(master)
+		os.close(slave)
+		print("  {0:<20} {1:9.0f} lines/s  {2:6.2f} us CPU/line  ({3} samples)".format(name, lines / elapsed, cpu / lines * 1e6, n))
+
+	samples = [bytes(line) + b"\r\n" for line in data.split(b"\r\n")[:-1]]
+	start = time.perf_counter()
+	for line in samples:
+		Sample.parse(line)
+	per_line = time.perf_counter() - start
+	parser = FrameParser()
+	start = time.perf_counter()
+	for i in range(0, len(data), 4096):
+		parser.parse(data[i:i + 4096], 0.0)
+	framed = time.perf_counter() - start
+	print("  parse only           Sample.parse {0:.2f} us/line, FrameParser {1:.2f} us/line".format(per_line / lines * 1e6, framed / lines * 1e6))
+
+
+# Cost of journaling counted objects (sessions.SessionStore.addObject) with group commit,
+# against an fsync after every object.
+def benchJournal(objects=2000):
+	from sessions import SessionStore
+	from journal import COMMIT_INTERVAL
+
+	sample = Sample(time.monotonic(), Status.STABLE, 12.5, "g")
+	for name, per_object in (("group commit", False), ("fsync per object", True)):
+		store = SessionStore("bench_journal_{0}.csv".format(int(per_object)), commit_interval=0 if per_object else COMMIT_INTERVAL)
+		session = store.beginSession()
+		latency = []
+		start = time.perf_counter()
+		for i in range(objects):
+			t = time.perf_counter()
+			store.addObject(session, sample)
+			if per_object:
+				store.journal.sync()
+			latency.append(time.perf_counter() - t)
+			time.sleep(0.0005)
+		elapsed = time.perf_counter() - start
+		store.journal.sync()
+		commits = store.journal.commits
+		store.endSession(session)
+		store.close()
+		print("journal {0:<17} {1}  ({2} fsyncs for {3} objects in {4:.1f} s)".format(name, percentiles(latency), commits, objects, elapsed))
+
+
+# Longest time between samples while a report of a large counting file is made, once on a
+# thread of the acquisition process and once in offload.OffloadPool.
+def benchOffload(rate, rows=500000):
+	import offload
+
+	with open("bench_counting.csv", "w") as f:
+		for i in range(rows):
+			f.write("{0},01/01/2026, 10:00:00,S,{1},g\n".format(i // 100, 10.0 + (i % 7) * 0.01))
+	fake = FakeScale(syntheticRow(3, seed=8), rate=rate).start()
+	scale = openLibra(fake)
+	time.sleep(0.5)
+
+	def gaps(run):
+		first = scale.samples.head
+		start = time.perf_counter()
+		run()
+		elapsed = time.perf_counter() - start
+		timestamps = [scale.samples.record(seq).timestamp for seq in range(max(first, scale.samples.head - scale.samples.capacity), scale.samples.head)]
+		deltas = [b - a for a, b in zip(timestamps, timestamps[1:])]
+		return elapsed, percentiles(deltas, (50, 99)), max(deltas) * 1000
+
+	def inThread():
+		thread = threading.Thread(target=offload.reportJob, args=("bench_counting.csv", "bench_report.csv"))
+		thread.start()
+		thread.join()
+
+	scale.offload.submit(offload.samplesJob, {"timestamp": array("d"), "status": array("B"), "weight": array("d")}).result()  # start workers
+	print("report of {0} rows during {1} lines/s".format(rows, rate))
+	for name, run in (("thread", inThread), ("worker process", lambda: scale.sessionReport("bench_report.csv", counting_path="bench_counting.csv").result())):
+		print("  {0:<15} {1:6.2f} s, sample gaps {2}, longest {3:.1f} ms".format(name, *gaps(run)))
+	closeLibra(scale)
+	fake.stop()
+
+
+# Run against a simulated scale in a temporary directory, so data.csv and counting.csv of
+# the current directory are not touched.
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Libra pipeline benchmark on a simulated scale")
+	parser.add_argument("--rate", type=float, nargs="+", default=[20, 200, 2000], help="lines per second")
+	parser.add_argument("--seconds", type=float, default=5)
+	parser.add_argument("--pieces", type=int, default=20)
+	args = parser.parse_args()
+
+	os.chdir(tempfile.mkdtemp(prefix="libra_bench_"))
+	benchStartup()
+	benchParse()
+	benchJournal()
+	for rate in args.rate:
+		benchThroughput(rate, args.seconds)
+	for rate in args.rate:
+		benchCountRow(args.pieces, rate)
+		benchCountOnce(args.pieces, rate)
+		benchTare(rate)
+		benchOffload(rate)
@@ -0,0 +1,138 @@
+import collections
+import threading
+
+
+# Seconds to wait for the final response to a command
+COMMAND_TIMEOUT = 5.0
+
+# Response status meaning more lines of the same response follow (e.g. "C2 B ...")
+STATUS_BUSY = "B"
+
+# Commands that timed out and may still be answered, their responses are dropped
+LATE_RESPONSES = 8
+
+# Error responses of the scale, sent instead of a response to the oldest command
+ERRORS = {
+	"ES": "syntax error",
+	"ET": "transmission error",
+	"EL": "logical error"
+}
+
+
+class CommandError(Exception):
+	pass
+
+
+# Command waiting for its response. Lines starting with prefix are collected until a line
+# that is not busy ("<prefix> B ...") arrives.
+class Pending():
+
+	def __init__(self, prefix, consume=True, progress=None):
+		self.prefix = prefix
+		self.consume = consume  # False if the response is also a sample, like response to S
+		self.progress = progress  # called with every busy line
+		self.lines = []
+		self.error = None
+		self.done = threading.Event()
+
+
+	def add(self, line, parts):
+		self.lines.append(line)
+		if len(parts) > 1 and parts[1] == STATUS_BUSY:
+			if self.progress is not None:
+				self.progress(line)
+			return False
+		self.done.set()
+		return True
+
+
+# Sends commands over a serial port that is read continuously by someone else. The reader
+# hands every line to route(), which passes responses to the commands waiting for them and
+# returns False for everything else (samples of the SIR stream). Commands are answered in
+# order, so a line goes to the oldest pending command with the same prefix.
+#
+# The stream never stops: a tare costs one line on the wire instead of stopping the reader
+# thread and sending SIR again.
+class CommandChannel():
+
+	def __init__(self, ser, lock=None):
+		self.ser = ser
+		self.lock = lock if lock is not None else threading.Lock()  # serializes writes and pending
+		self.pending = collections.deque()  # Pending in order of sending
+		self.late = collections.deque(maxlen=LATE_RESPONSES)  # prefixes of commands that timed out
+
+
+	def send(self, cmd, prefix, timeout=COMMAND_TIMEOUT, consume=True, progress=None):
+		waiting = Pending(prefix, consume, progress)
+		with self.lock:
+			self.pending.append(waiting)
+			try:
+				self.ser.write(cmd)
+			except OSError as e:  # serial.SerialException too
+				self.pending.remove(waiting)
+				raise CommandError("[CommandChannel] " + str(e))
+		if not waiting.done.wait(timeout):
+			self._remove(waiting, late=True)
+			raise TimeoutError("[CommandChannel] no response to " + cmd.decode("ascii").strip())
+		if waiting.error is not None:
+			raise CommandError("[CommandChannel] {0} to {1}".format(waiting.error, cmd.decode("ascii").strip()))
+		return waiting.lines
+
+
+	# Write without waiting for a response, e.g. SIR.
+	def write(self, cmd):
+		with self.lock:
+			self.ser.write(cmd)
+
+
+	def _remove(self, waiting, late=False):
+		with self.lock:
+			try:
+				self.pending.remove(waiting)
+			except ValueError:
+				return
+			if late and waiting.consume:  # a late response to S is just a sample
+				self.late.append(waiting.prefix)
+
+
+	# Called by the reader with every line (bytes). Returns True if the line was a response
+	# and should not be treated as a sample. Responses to commands that timed out are dropped.
+	def route(self, line):
+		if not self.pending and not self.late:
+			return False
+		parts = line.decode("ascii", "replace").split()
+		if not parts:
+			return False
+		with self.lock:
+			if parts[0] in ERRORS:
+				if self.pending:
+					waiting = self.pending.popleft()
+					waiting.error = ERRORS[parts[0]]
+					waiting.done.set()
+				elif self.late:
+					self.late.popleft()
+				else:
+					return False
+				return True
+			for waiting in self.pending:
+				if waiting.prefix == parts[0]:
+					break
+			else:
+				if parts[0] in self.late:
+					if len(parts) < 2 or parts[1] != STATUS_BUSY:
+						self.late.remove(parts[0])
+					return True
+				return False
+			if waiting.add(line.decode("ascii", "replace").strip(), parts):
+				self.pending.remove(waiting)
+			return waiting.consume
+
+
+	# Fail every pending command, e.g. when the port is closed.
+	def cancel(self, error="port closed"):
+		with self.lock:
+			pending, self.pending = self.pending, collections.deque()
+			self.late.clear()  # nothing comes from a port that is gone
+		for waiting in pending:
+			waiting.error = error
+			waiting.done.set()
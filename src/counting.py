@@ -0,0 +1,339 @@
+import math
+import statistics
+import threading
+
+from stability import SETTLED
+
+
+CONFIDENCE = 0.95
+MAX_HALF_WIDTH = 0.5  # count interval must be narrower than this to round to the right count
+
+# Piece std relative to piece weight assumed while the spread of pieces is unknown: fewer
+# than two pieces weighed one at a time, a reference weighed as a group or a given weight.
+PIECE_CV = 0.01
+
+
+class CountResult():
+
+	__slots__ = ("weight", "estimate", "count", "low", "high", "sigma")
+
+	def __init__(self, weight, estimate, low, high, sigma):
+		self.weight = weight
+		self.estimate = estimate  # weight / piece weight
+		self.count = round(estimate)
+		self.low = low  # confidence interval of estimate
+		self.high = high
+		self.sigma = sigma
+
+	def isCertain(self):
+		return self.high - self.low < 2 * MAX_HALF_WIDTH
+
+	def __repr__(self):
+		return "CountResult({0}, {1:.2f} [{2:.2f}, {3:.2f}])".format(self.count, self.estimate, self.low, self.high)
+
+
+# Piece weight from a reference of several pieces and counting with its uncertainty.
+#
+# Reference pieces are added one at a time and every increment of settled weight is one
+# piece weight sample, so piece-to-piece spread is known (running mean and variance).
+# Counting a heap of weight W with mean piece weight u and piece std s from N samples:
+#	n = W / u
+#	var(n) = n * s^2 / u^2        spread of the pieces in the heap
+#	       + n^2 * s^2 / (N u^2)  uncertainty of the mean piece weight
+#	       + 2 * e^2 / u^2        scale repeatability e on heap and zero
+class PieceCounter():
+
+	def __init__(self, confidence=CONFIDENCE, scale_std=0.0):
+		self.z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+		self.scale_std = scale_std
+		self.n = 0  # pieces in the reference
+		self.weighed = 0  # of them weighed one at a time, their spread is known from two on
+		self.mean = 0.0
+		self.m2 = 0.0  # sum of squared deviations (Welford)
+
+
+	def addReference(self, piece_weight):
+		self.n += 1
+		self.weighed += 1
+		delta = piece_weight - self.mean
+		self.mean += delta / self.n
+		self.m2 += delta * (piece_weight - self.mean)
+
+
+	# Reference weighed as a group of pieces, spread between pieces is then unknown.
+	def setReference(self, total_weight, pieces):
+		self.n = pieces
+		self.weighed = 0
+		self.mean = total_weight / pieces
+		self.m2 = 0.0
+
+
+	def referencePieces(self):
+		return self.n
+
+
+	def pieceWeight(self):
+		return self.mean
+
+
+	def pieceStd(self):
+		if self.weighed < 2:
+			return PIECE_CV * self.mean
+		return math.sqrt(self.m2 / (self.weighed - 1))
+
+
+	def _variance(self, estimate, pieces):
+		u = self.mean
+		s2 = self.pieceStd() ** 2
+		return (estimate * s2 + estimate * estimate * s2 / pieces + 2 * self.scale_std ** 2) / (u * u)
+
+
+	def count(self, weight):
+		assert self.n > 0 and self.mean > 0, "[PieceCounter] no reference"
+		estimate = weight / self.mean
+		sigma = math.sqrt(self._variance(estimate, self.n))
+		return CountResult(weight, estimate, estimate - self.z * sigma, estimate + self.z * sigma, sigma)
+
+
+	# Number of reference pieces needed to count weight with a certain result, None if the
+	# current reference is enough and math.inf if even a perfect reference is not enough
+	# (pieces vary too much for this heap, count it in smaller parts).
+	def suggestReference(self, weight):
+		estimate = weight / self.mean
+		u2 = self.mean * self.mean
+		s2 = self.pieceStd() ** 2
+		allowed = (MAX_HALF_WIDTH / self.z) ** 2
+		if self._variance(estimate, self.n) < allowed:
+			return None
+		rest = allowed - (estimate * s2 + 2 * self.scale_std ** 2) / u2
+		if rest <= 0:
+			return math.inf
+		return math.ceil(estimate * estimate * s2 / (u2 * rest))
+
+
+# Weights below this are considered an empty scale
+ZERO_WEIGHT = 0.1
+
+# Counting states
+WAIT_REFERENCE = "reference"
+WAIT_ZERO = "zero"
+COUNTING = "counting"
+WAIT_HEAP = "heap"
+DONE = "done"
+
+
+# Counting procedure as a state machine fed with stability events by CountingEngine.
+# log is called with progress messages, notify with the counting whenever its result changes.
+class Counting():
+
+	def __init__(self, log=None, notify=None):
+		self.id = None  # set by CountingEngine
+		self.state = None
+		self.log = log if log is not None else (lambda message: None)
+		self.notify = notify if notify is not None else (lambda counting: None)
+		self.done = threading.Event()
+
+
+	# Called once when added to the engine, settled is the currently settled sample or None.
+	def start(self, settled):
+		if settled is not None:
+			self.onSettled(settled)
+
+
+	def feed(self, event, sample):
+		if event == SETTLED:
+			self.onSettled(sample)
+
+
+	def onSettled(self, sample):
+		pass
+
+
+	def stop(self):
+		self.finish()
+
+
+	def finish(self):
+		self.state = DONE
+		self.done.set()
+		self.notify(self)
+
+
+# Every weight settling above zero after a stable zero is one object. Objects go to the
+# session store as they are counted, the session is closed when counting is stopped. If the
+# store fails (disk full) the counting stops with error set, the reader thread goes on.
+class RowCounting(Counting):
+
+	def __init__(self, store, **kwargs):
+		Counting.__init__(self, **kwargs)
+		self.store = store
+		self.session = store.beginSession()
+		self.count = 0
+		self.info = None  # sessions.SessionInfo once stopped
+		self.error = None  # why the session failed, if it did
+		self.state = WAIT_ZERO
+
+
+	def start(self, settled):
+		self.log("[RowCounting] Waiting for stable zero ...")
+		Counting.start(self, settled)
+
+
+	def onSettled(self, sample):
+		if self.state == WAIT_ZERO and sample.weight < ZERO_WEIGHT:
+			self.state = COUNTING
+			self.log("[RowCounting] Stable zero acquired, start weighting ...")
+		elif self.state == COUNTING and sample.weight > ZERO_WEIGHT:
+			try:
+				self.store.addObject(self.session, sample)
+			except OSError as e:
+				self.error = str(e)
+				self.log("[RowCounting] session failed, object not saved: " + self.error)
+				self.stop()
+				return
+			self.count += 1
+			self.log("beep")
+			self.notify(self)
+
+
+	def stop(self):
+		try:
+			self.info = self.store.endSession(self.session)
+			self.log("[RowCounting] Session {0} saved".format(self.info.id))
+		except OSError as e:
+			self.error = self.error or str(e)
+			self.log("[RowCounting] failed to write session to file: " + str(e))
+		self.finish()
+
+
+# Piece weight is either given or measured from reference pieces put on the scale one at
+# a time (or all at once with reference_group), then the whole heap is weighed and counted
+# with PieceCounter.
+class OnceCounting(Counting):
+
+	def __init__(self, target_weight=None, reference_pieces=1, scale_std=0.0, reference_group=False, **kwargs):
+		Counting.__init__(self, **kwargs)
+		self.counter = PieceCounter(scale_std=scale_std)
+		self.reference_pieces = reference_pieces
+		self.reference_group = reference_group
+		self.last = 0.0  # settled weight after last reference piece
+		self.result = None  # CountResult
+		if target_weight is None:
+			self.state = WAIT_REFERENCE
+		else:
+			self.counter.setReference(target_weight, 1)
+			self.state = WAIT_ZERO
+
+
+	def target(self):
+		return self.counter.pieceWeight() if self.state != WAIT_REFERENCE else None
+
+
+	def start(self, settled):
+		if self.state == WAIT_REFERENCE:
+			self.log("[OnceCounting] Put {0} reference pieces on weight {1} ...".format(
+				self.reference_pieces, "at once" if self.reference_group else "one by one"))
+		else:
+			self.log("[OnceCounting] Target weight is {0}, weight for stable zero ...".format(self.target()))
+		Counting.start(self, settled)
+
+
+	def onSettled(self, sample):
+		weight = sample.weight
+		if self.state == WAIT_REFERENCE and weight > self.last + ZERO_WEIGHT:
+			if self.reference_group:
+				self.counter.setReference(weight, self.reference_pieces)
+				self.log("[OnceCounting] Reference of {0} pieces: {1}".format(self.reference_pieces, weight))
+			else:
+				self.counter.addReference(weight - self.last)
+				self.log("[OnceCounting] Reference piece {0}: {1}".format(self.counter.referencePieces(), weight - self.last))
+			self.last = weight
+			if self.counter.referencePieces() >= self.reference_pieces:
+				self.state = WAIT_ZERO
+				self.log("[OnceCounting] Stable weight acquired, target weight is {0} (std {1})".format(self.target(), self.counter.pieceStd()))
+				self.log("[OnceCounting] Remove object and weight for stable zero ...")
+				self.notify(self)
+		elif self.state == WAIT_ZERO and weight < ZERO_WEIGHT:
+			self.state = WAIT_HEAP
+			self.log("[OnceCounting] Stable zero acquired. Put objects on weight")
+		elif self.state == WAIT_HEAP and weight > ZERO_WEIGHT:
+			result = self.result = self.counter.count(weight)
+			self.log("[OnceCounting] Counted {0} objects ({1:.2f}, {2:.0%} interval {3:.2f} - {4:.2f})".format(
+				result.count, result.estimate, CONFIDENCE, result.low, result.high))
+			suggested = self.counter.suggestReference(weight)
+			if suggested == math.inf:
+				self.log("[OnceCounting] Pieces vary too much for this heap, count it in smaller parts")
+			elif suggested is not None:
+				self.log("[OnceCounting] Count is uncertain, use {0} reference pieces".format(suggested))
+			self.finish()
+
+
+# Every piece put on an empty scale is classified against [low, high].
+class CheckWeighing(Counting):
+
+	def __init__(self, low, high, **kwargs):
+		Counting.__init__(self, **kwargs)
+		self.low = low
+		self.high = high
+		self.counts = {"under": 0, "ok": 0, "over": 0}
+		self.last = None  # (weight, class) of last piece
+		self.state = WAIT_ZERO
+
+
+	def onSettled(self, sample):
+		weight = sample.weight
+		if self.state == WAIT_ZERO and weight < ZERO_WEIGHT:
+			self.state = COUNTING
+		elif self.state == COUNTING and weight > ZERO_WEIGHT:
+			verdict = "under" if weight < self.low else "over" if weight > self.high else "ok"
+			self.counts[verdict] += 1
+			self.last = (weight, verdict)
+			self.log("[CheckWeighing] {0} {1}: {2}".format(weight, sample.unit, verdict))
+			self.state = WAIT_ZERO
+			self.notify(self)
+
+
+# Feeds stability events of one detector to any number of countings at once. Every counting
+# sees every event on the reader thread, no thread per counting and no shared queue that
+# countings could steal samples from.
+class CountingEngine():
+
+	def __init__(self, detector):
+		self.detector = detector
+		self.lock = threading.Lock()
+		self.active = {}  # id -> Counting
+		self.next_id = 0
+		detector.subscribe(self.feed)
+
+
+	# Add counting, returns its id.
+	def start(self, counting):
+		with self.lock:
+			id = self.next_id
+			self.next_id += 1
+			self.active[id] = counting
+			counting.id = id
+			counting.start(self.detector.settled_sample if self.detector.settled else None)
+			if counting.state == DONE:
+				del self.active[id]
+		return id
+
+
+	def stop(self, id):
+		with self.lock:
+			counting = self.active.pop(id, None)
+			if counting is not None:
+				counting.stop()
+		return counting
+
+
+	def get(self, id):
+		return self.active.get(id)
+
+
+	def feed(self, event, sample):
+		with self.lock:
+			for id, counting in list(self.active.items()):
+				counting.feed(event, sample)
+				if counting.state == DONE:
+					del self.active[id]
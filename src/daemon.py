@@ -0,0 +1,415 @@
+import asyncio
+import collections
+import errno
+import json
+import math
+import os
+import signal
+import socket
+import threading
+
+import serial
+
+import libra
+from counting import RowCounting, OnceCounting, CheckWeighing
+from sample import WALL_OFFSET, STATUS_NAMES
+
+
+# Default address clients connect to, a path for a unix socket or (host, port) for TCP
+SOCKET_PATH = "libra.sock"
+
+# Events (not samples) kept per client, the oldest are dropped when a client does not read
+EVENT_QUEUE = 256
+
+# Replies are never dropped, a client with this many unsent replies is not read from until
+# it takes them
+REPLY_QUEUE = 64
+
+SAMPLE_LINE = '{{"type":"sample","seq":{0},"time":{1:.3f},"status":"{2}","weight":{3!r},"unit":"{4}"}}\n'
+
+
+# Message as a line of strict JSON. NaN and Infinity are not JSON and strict clients reject
+# the whole line, so a message holding them is replaced with an error instead of sent.
+def encode(message):
+	try:
+		return json.dumps(message, allow_nan=False) + "\n"
+	except ValueError as e:
+		return json.dumps({"type": "error", "error": str(e), "message": message.get("type")}) + "\n"
+
+
+def sampleMessage(seq, sample):
+	return {
+		"type": "sample",
+		"seq": seq,
+		"time": round(sample.wallTime(), 3),
+		"status": sample.statusText(),
+		"weight": sample.weight,
+		"unit": sample.unit
+	}
+
+
+def countingMessage(counting):
+	message = {"type": "counting", "id": counting.id, "state": counting.state}
+	if isinstance(counting, RowCounting):
+		message.update(method=libra.COUNT_ROW, count=counting.count, error=counting.error)
+	elif isinstance(counting, OnceCounting):
+		message.update(method=libra.COUNT_ONCE, target=counting.target())
+		result = counting.result
+		if result is not None:
+			message.update(count=result.count, estimate=result.estimate, low=result.low, high=result.high)
+	elif isinstance(counting, CheckWeighing):
+		message.update(method=libra.COUNT_CHECK, counts=dict(counting.counts), last=counting.last)
+	return message
+
+
+# One connection. Samples are read from the shared ring with the client's own cursor, so a
+# slow client costs no memory: it waits on its socket (drain) while the ring moves on, and
+# is told how many samples it missed. Events go to a small queue that drops the oldest,
+# replies to requests to their own queue that drops nothing.
+class Client():
+
+	def __init__(self, reader, writer):
+		self.reader = reader
+		self.writer = writer
+		self.samples = None  # ringbuffer.RingReader while subscribed
+		self.reported = 0  # dropped samples already reported
+		self.events = collections.deque(maxlen=EVENT_QUEUE)
+		self.events_dropped = 0
+		self.replies = collections.deque()  # never dropped, see REPLY_QUEUE
+		self.sent = asyncio.Event()  # set whenever a write to the client completed
+		self.countings = set()  # ids of countings started by this client and not stopped
+		self.wake = asyncio.Event()
+		self.closed = False
+
+
+	def reply(self, message):
+		self.replies.append(message)
+		self.wake.set()
+
+
+	# Broadcast event, the oldest is dropped if the client is behind.
+	def push(self, message):
+		if len(self.events) == self.events.maxlen:
+			self.events_dropped += 1
+		self.events.append(message)
+		self.wake.set()
+
+
+# Serves one Libra to local clients over a socket, newline delimited JSON both ways.
+# Libra keeps the only serial reader, the server only reads its ring buffer and calls its API.
+#
+# Requests, "ref" is optional and copied to the reply:
+#	{"cmd": "subscribe"} / {"cmd": "unsubscribe"}     live samples on or off
+#	{"cmd": "latest"}
+#	{"cmd": "tare"} / {"cmd": "zero"}
+#	{"cmd": "count", "method": "in_row" | "once" | "check", "target": ..., "reference_pieces": n, "reference_group": bool}
+#	{"cmd": "stop", "counting": id}             countings still running when their client disconnects are stopped
+#	{"cmd": "health"}
+#	{"cmd": "trend", "from": t1, "to": t2, "resolution": seconds}   rollups, times are unix time
+#	{"cmd": "weighings", "from": t1, "to": t2}   rows of the data file
+#	{"cmd": "session", "id": n}                  objects of a counting session
+# Pushed to clients:
+#	{"type": "sample", ...} (subscribed only), {"type": "settled" | "unsettled", ...},
+#	{"type": "counting", ...}, {"type": "gap", ...}, {"type": "dropped", "samples": n, "events": n},
+#	{"type": "stats", ...} statistics of a finished row counting session
+#
+# Runs its own asyncio loop in one thread, like manager.ScaleManager.
+class LibraServer():
+
+	def __init__(self, scale, address=SOCKET_PATH):
+		self.scale = scale
+		self.address = address
+		self.clients = set()
+		self.loop = asyncio.new_event_loop()
+		self.server = None
+		self.thread = None
+		self.thread_wake = None
+		self.stopped = threading.Event()
+		self.ready = threading.Event()
+
+
+	def start(self):
+		assert self.thread is None, "[LibraServer] already started"
+		if isinstance(self.address, str) and self.inUse(self.address):
+			raise OSError(errno.EADDRINUSE, "[LibraServer] another server is answering on " + self.address)
+		self.thread = threading.Thread(target=self._run, name="libra_server", daemon=True)
+		self.thread.start()
+		self.ready.wait()
+		self.scale.stability.subscribe(self.onStability)
+		self.scale.listeners.append(self.onEvent)
+		self.thread_wake = threading.Thread(target=self._wakeOnSamples, name="libra_server_wake", daemon=True)
+		self.thread_wake.start()
+
+
+	# True if a server accepts connections on unix socket path. A socket file nobody listens
+	# on is left over from a crash and may be replaced.
+	@staticmethod
+	def inUse(path):
+		if not os.path.exists(path):
+			return False
+		probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			probe.connect(path)
+			return True
+		except (ConnectionRefusedError, FileNotFoundError):
+			return False
+		finally:
+			probe.close()
+
+
+	def _run(self):
+		asyncio.set_event_loop(self.loop)
+		if isinstance(self.address, str):
+			if os.path.exists(self.address):
+				os.remove(self.address)  # left by a server that did not stop, checked in start()
+			serve = asyncio.start_unix_server(self._serve, path=self.address)
+		else:
+			serve = asyncio.start_server(self._serve, *self.address)
+		self.server = self.loop.run_until_complete(serve)
+		self.ready.set()
+		self.loop.run_forever()
+
+		# closing the sockets ends the client tasks, give them a moment to finish
+		self.server.close()
+		for client in list(self.clients):
+			client.closed = True
+			client.wake.set()
+			client.writer.transport.abort()
+		tasks = asyncio.all_tasks(self.loop)
+		if tasks:
+			self.loop.run_until_complete(asyncio.wait(tasks, timeout=1.0))
+		self.loop.run_until_complete(self.server.wait_closed())
+		self.loop.close()
+		if isinstance(self.address, str) and os.path.exists(self.address):
+			os.remove(self.address)
+
+
+	def stop(self):
+		if self.thread is None:
+			return
+		self.stopped.set()
+		self.scale.stability.unsubscribe(self.onStability)
+		self.scale.listeners.remove(self.onEvent)
+		self.loop.call_soon_threadsafe(self.loop.stop)
+		self.thread.join()
+		self.thread_wake.join()
+		self.thread = None
+
+
+	# One thread waits for new samples and wakes up all clients, coalescing bursts.
+	def _wakeOnSamples(self):
+		reader = self.scale.samples.reader()
+		while not self.stopped.is_set():
+			if reader.get(0.5) is None:
+				continue
+			reader.latest()
+			try:
+				self.loop.call_soon_threadsafe(self._wakeUp)
+			except RuntimeError:  # loop closed
+				return
+
+
+	def _wakeUp(self):
+		for client in self.clients:
+			if client.samples is not None:
+				client.wake.set()
+
+
+	# Called from other threads, message goes to every client.
+	def broadcast(self, message):
+		try:
+			self.loop.call_soon_threadsafe(self._broadcast, message)
+		except RuntimeError:
+			pass
+
+
+	def _broadcast(self, message):
+		for client in self.clients:
+			client.push(message)
+
+
+	def onStability(self, event, sample):
+		message = sampleMessage(self.scale.samples.head - 1, sample)
+		message["type"] = event
+		self.broadcast(message)
+
+
+	def onEvent(self, event, data):
+		if event == libra.EVENT_COUNTING:
+			self.broadcast(countingMessage(data))
+		elif event == libra.EVENT_GAP:
+			self.broadcast({"type": "gap", "start": round(data.start + WALL_OFFSET, 3), "end": round(data.end + WALL_OFFSET, 3)})
+		elif event == libra.EVENT_STATS:
+			counting, stats = data
+			self.broadcast({"type": "stats", "counting": counting.id, "session": counting.info.id, "stats": stats})
+
+
+	async def _serve(self, reader, writer):
+		client = Client(reader, writer)
+		self.clients.add(client)
+		sender = asyncio.ensure_future(self._send(client))
+		try:
+			while True:
+				line = await reader.readline()
+				if not line:
+					break
+				request = None
+				try:
+					request = json.loads(line)
+					reply = await self.loop.run_in_executor(None, self.handle, client, request)
+				except (ValueError, KeyError, TypeError, AttributeError) as e:
+					reply = {"type": "reply", "ok": False, "error": "{0}: {1}".format(type(e).__name__, e)}
+					if isinstance(request, dict):
+						reply.update((key, request[key]) for key in ("cmd", "ref") if key in request)
+				client.reply(reply)
+				while len(client.replies) >= REPLY_QUEUE and not client.closed:
+					client.sent.clear()
+					await client.sent.wait()
+		except (ConnectionError, asyncio.IncompleteReadError):
+			pass
+		finally:
+			client.closed = True
+			client.wake.set()
+			self.clients.discard(client)
+			await sender
+			writer.close()
+			if client.countings:
+				# nobody is left to stop them, an open row counting would hold its session forever
+				await self.loop.run_in_executor(None, self.stopCountings, client)
+
+
+	def stopCountings(self, client):
+		for id in client.countings:
+			if self.scale.counting.get(id) is not None:
+				self.scale.countApi(libra.COUNT_ROW, stop=True, id=id)
+		client.countings.clear()
+
+
+	async def _send(self, client):
+		names = self.scale.samples.unit_table.names
+		try:
+			while not client.closed:
+				client.wake.clear()
+				events = list(client.replies)
+				client.replies.clear()
+				events.extend(client.events)
+				client.events.clear()
+				if client.events_dropped:
+					events.append({"type": "dropped", "samples": 0, "events": client.events_dropped})
+					client.events_dropped = 0
+				chunks = [encode(message) for message in events]
+
+				samples = client.samples
+				if samples is not None:
+					segments = samples.read()
+					seq = samples.cursor - sum(len(segment[0]) for segment in segments)
+					for timestamp, status, weight, unit in segments:
+						for i in range(len(timestamp)):
+							chunks.append(SAMPLE_LINE.format(
+								seq, timestamp[i] + WALL_OFFSET, STATUS_NAMES[status[i]], weight[i], names[unit[i]]))
+							seq += 1
+					if samples.dropped > client.reported:
+						chunks.append(encode({"type": "dropped", "samples": samples.dropped - client.reported, "events": 0}))
+						client.reported = samples.dropped
+
+				if chunks:
+					client.writer.write("".join(chunks).encode("utf-8"))
+					await client.writer.drain()  # backpressure: slow client falls behind in the ring
+					client.sent.set()
+				else:
+					await client.wake.wait()
+		except ConnectionError:
+			client.closed = True
+		finally:
+			client.sent.set()  # a reader waiting for replies to go out must not wait forever
+
+
+	# Runs in a worker thread, may block on the scale.
+	def handle(self, client, request):
+		cmd = request["cmd"]
+		reply = {"type": "reply", "cmd": cmd, "ok": True}
+		if "ref" in request:
+			reply["ref"] = request["ref"]
+
+		if cmd == "subscribe":
+			client.samples = self.scale.samples.reader()
+			client.reported = 0
+		elif cmd == "unsubscribe":
+			client.samples = None
+		elif cmd == "latest":
+			sample = self.scale.samples.latest()
+			reply["sample"] = sampleMessage(self.scale.samples.head - 1, sample) if sample is not None else None
+		elif cmd in ("tare", "zero"):
+			tare = self.scale.setTare(zero=cmd == "zero")
+			reply.update(ok=tare is not None, tare=tare)
+		elif cmd == "count":
+			target = request.get("target")
+			id = self.scale.countApi(
+				request["method"],
+				target=tuple(target) if isinstance(target, list) else target,
+				reference_pieces=request.get("reference_pieces", 1),
+				reference_group=bool(request.get("reference_group", False))
+			)
+			reply.update(ok=id is not None, counting=id)
+			if id is not None:
+				client.countings.add(id)
+		elif cmd == "stop":
+			id = request["counting"]
+			client.countings.discard(id)
+			counting = self.scale.counting.get(id)
+			self.scale.countApi(libra.COUNT_ROW, stop=True, id=id)
+			reply.update(ok=counting is not None, counting=id)
+		elif cmd == "health":
+			reply["health"] = self.scale.health()
+		elif cmd == "trend":
+			trend = self.scale.rollups.query(request.get("from", 0), request.get("to", math.inf), request.get("resolution"))
+			reply["trend"] = {name: list(column) if name != "resolution" else column for name, column in trend.items()}
+		elif cmd == "weighings":
+			reply["rows"] = self.scale.weighings(request.get("from", 0), request.get("to", math.inf))
+		elif cmd == "session":
+			rows = self.scale.sessionObjects(request["id"])
+			reply.update(ok=rows is not None, rows=rows)
+		else:
+			reply.update(ok=False, error="unknown command")
+		return reply
+
+
+if __name__ == "__main__":
+	import argparse
+
+	parser = argparse.ArgumentParser(description="Run the scale without GUI and serve it on a local socket")
+	parser.add_argument("--port", default="/dev/ttyUSB0", help="serial port of the scale")
+	parser.add_argument("--baudrate", type=int, default=2400)
+	parser.add_argument("--socket", default=SOCKET_PATH, help="unix socket path")
+	parser.add_argument("--tcp", type=int, help="serve on 127.0.0.1:TCP instead of a unix socket")
+	parser.add_argument("--product", default="default", help="stability profile")
+	parser.add_argument("--metrics-port", type=int)
+	parser.add_argument("--rollups", help="directory to keep per second/minute/hour rollups in")
+	args = parser.parse_args()
+
+	scale = libra.Libra(
+		port=args.port,
+		baudrate=args.baudrate,
+		bytesize=serial.SEVENBITS,
+		parity=serial.PARITY_EVEN,
+		stopbits=serial.STOPBITS_ONE,
+		xonxoff=True,
+		product=args.product,
+		metrics_port=args.metrics_port,
+		rollup_path=args.rollups
+	)
+	server = LibraServer(scale, ("127.0.0.1", args.tcp) if args.tcp else args.socket)
+	server.start()
+
+	stop = threading.Event()
+	signal.signal(signal.SIGTERM, lambda *args: stop.set())
+	signal.signal(signal.SIGINT, lambda *args: stop.set())
+	while not stop.is_set():
+		stop.wait(1.0)  # wakes up for signals, no busy loop
+		while not scale.queue_stdout.empty():
+			print(scale.queue_stdout.get())
+
+	server.stop()
+	scale.stopReadCont()
+	scale.stopWritefile()
+	scale.env.stop()
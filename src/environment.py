@@ -0,0 +1,162 @@
+import json
+import threading
+import time
+
+
+ARSO_URL = "http://meteo.arso.gov.si/uploads/probase/www/observ/surface/text/sl/observationAms_LJUBL-ANA_BEZIGRAD_latest.rss"
+
+# Defaults for EnvProvider, in seconds
+ENV_TTL = 900  # value older than this is reported as stale
+ENV_REFRESH_INTERVAL = 300
+ENV_RETRY_INTERVAL = 30  # refresh interval after a failed fetch
+ENV_TIMEOUT = 5
+
+# Returned before the first successful fetch
+UNKNOWN = {
+	"pressure": "",
+	"humidity": "",
+	"temperature": ""
+}
+
+
+# Environment data as stored with every weighing.
+def formatEnv(pressure, humidity, temperature):
+	return {
+		"pressure": "{0} mbar".format(pressure),
+		"humidity": "{0} %".format(humidity),
+		"temperature": "{0} °C".format(temperature)
+	}
+
+
+# Sources have fetch(timeout) that returns environment data dict or raises.
+
+# Observations of ARSO station Ljubljana Bezigrad from their RSS feed.
+class ArsoSource():
+
+	def __init__(self, url=ARSO_URL, p="Zračni tlak:  ", h="Vlažnost zraka: ", t="LJUBLJANA: "):
+		self.url = url
+		self.markers = (p, h, t)
+
+	def fetch(self, timeout):
+		import requests  # only needed when this source is used
+
+		response = requests.get(self.url, timeout=timeout)
+		response.raise_for_status()
+		text = response.text
+		values = []
+		for marker, length in zip(self.markers, (4, 2, 2)):
+			i = text.find(marker)
+			if i < 0:
+				raise ValueError("[ArsoSource] {0} not found in feed".format(marker.strip()))
+			values.append(text[i + len(marker):i + len(marker) + length])
+		return formatEnv(*values)
+
+
+# Local http stand-in that serves {"pressure": .., "humidity": .., "temperature": ..} as json.
+class HttpSource():
+
+	def __init__(self, url):
+		self.url = url
+
+	def fetch(self, timeout):
+		import requests
+
+		response = requests.get(self.url, timeout=timeout)
+		response.raise_for_status()
+		data = response.json()
+		return formatEnv(data["pressure"], data["humidity"], data["temperature"])
+
+
+# Json file with the same keys as HttpSource, e.g. written by another process.
+class FileSource():
+
+	def __init__(self, path):
+		self.path = path
+
+	def fetch(self, timeout):
+		with open(self.path) as f:
+			data = json.load(f)
+		return formatEnv(data["pressure"], data["humidity"], data["temperature"])
+
+
+# Local sensor, read is a callable returning (pressure, humidity, temperature).
+class SensorSource():
+
+	def __init__(self, read):
+		self.read = read
+
+	def fetch(self, timeout):
+		return formatEnv(*self.read())
+
+
+# Keeps environment data fresh in a background thread. get() never blocks, it returns the
+# last fetched value (or UNKNOWN before the first fetch); when fetching fails the previous
+# value is kept and isStale() tells whether it is older than ttl.
+class EnvProvider():
+
+	def __init__(self, source=None, ttl=ENV_TTL, refresh_interval=ENV_REFRESH_INTERVAL,
+			retry_interval=ENV_RETRY_INTERVAL, timeout=ENV_TIMEOUT):
+		self.source = source if source is not None else ArsoSource()
+		self.ttl = ttl
+		self.refresh_interval = refresh_interval
+		self.retry_interval = retry_interval
+		self.timeout = timeout
+
+		self.env_data = UNKNOWN
+		self.updated = None  # time.monotonic() of last successful fetch
+		self.error = None  # exception of last failed fetch
+		self.listeners = []  # callables called with new env data, on provider thread
+
+		self.thread = None
+		self.wake = threading.Event()
+		self.stopped = False
+
+
+	def start(self):
+		if self.thread is not None:
+			return
+		self.thread = threading.Thread(target=self.run, name="env_data", daemon=True)
+		self.thread.start()
+
+
+	def run(self):
+		while not self.stopped:
+			interval = self.refresh_interval if self.update() else self.retry_interval
+			self.wake.wait(interval)
+			self.wake.clear()
+
+
+	# Fetch once on the calling thread, returns True on success.
+	def update(self):
+		try:
+			env_data = self.source.fetch(self.timeout)
+		except Exception as e:
+			self.error = e
+			return False
+		self.env_data = env_data
+		self.updated = time.monotonic()
+		self.error = None
+		for listener in self.listeners:
+			listener(env_data)
+		return True
+
+
+	def get(self):
+		return self.env_data
+
+
+	def isStale(self):
+		return self.updated is None or time.monotonic() - self.updated > self.ttl
+
+
+	# Ask the provider thread to fetch now.
+	def refresh(self):
+		self.wake.set()
+
+
+	def stop(self):
+		self.stopped = True
+		self.wake.set()
+		if self.thread is not None:
+			self.thread.join()
+			self.thread = None
@@ -0,0 +1,79 @@
+import re
+
+from sample import Sample, Status
+
+
+EOL = b"\r\n"
+
+# Longest line kept while waiting for its end, anything longer is noise and is dropped
+MAX_LINE = 1024
+
+# Same fields as Sample.parse: status is the first word, weight the one before last, unit the last.
+# Matched in place in the buffer with pos/endpos, no line is copied out for samples.
+SIR_LINE = re.compile(rb" *(\S+) +(?:\S+ +)*?([-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?) +(\S+) *")
+
+_S = ord("S")
+_D = ord("D")
+
+
+# Splits bytes read in bulk from the scale into lines and parses SIR lines straight from
+# the buffer. Bytes of an unfinished line stay in the buffer until the rest arrives.
+#
+#	parser = FrameParser()
+#	for sample, line in parser.parse(ser.read(ser.in_waiting or 1), time.monotonic()):
+#		...
+class FrameParser():
+
+	def __init__(self):
+		self.buffer = bytearray()  # reused, only the unfinished tail is kept between calls
+		self.units = {}  # unit bytes -> str, units are decoded once
+		self.dropped = 0  # bytes thrown away as noise
+
+
+	# Append data and return complete lines as list of (sample, line). sample is None for lines
+	# that are not weights of the SIR stream (status S...), line (bytes, without EOL) is only
+	# set for those unless raw is set.
+	# All samples of one call get the same timestamp.
+	def parse(self, data, timestamp, raw=False):
+		buffer = self.buffer
+		buffer += data
+		match = SIR_LINE.fullmatch
+		find = buffer.find
+		units = self.units
+		frames = []
+		pos = 0
+		while True:
+			end = find(EOL, pos)
+			if end < 0:
+				break
+			m = match(buffer, pos, end)
+			if m is None or buffer[m.start(1)] != _S:
+				# not a weight of the SIR stream, e.g. a response to T or C0 that came too late
+				frames.append((None, bytes(buffer[pos:end])))
+			else:
+				start, stop = m.span(1)
+				if stop - start == 1:
+					status = Status.STABLE
+				elif stop - start == 2 and buffer[start] == _S and buffer[start + 1] == _D:
+					status = Status.UNSTABLE
+				else:
+					status = Status.OTHER
+				unit = m.group(3)
+				name = units.get(unit)
+				if name is None:
+					name = units[unit] = unit.decode("ascii", "replace")
+				sample = Sample(timestamp, status, float(m.group(2)), name)
+				frames.append((sample, bytes(buffer[pos:end]) if raw else None))
+			pos = end + 2
+
+		if pos:
+			del buffer[:pos]
+		if len(buffer) > MAX_LINE:
+			self.dropped += len(buffer)
+			del buffer[:]
+		return frames
+
+
+	def reset(self):
+		self.dropped += len(self.buffer)
+		del self.buffer[:]
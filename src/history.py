@@ -0,0 +1,190 @@
+import bisect
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+
+from sample import TIME_FORMAT
+
+
+INDEX_SUFFIX = ".tidx"
+
+# Bytes of data file between index entries. A lookup parses at most the rows of one stride.
+INDEX_STRIDE = 16 * 1024
+
+# Index entry: offset of a row in the data file and the latest time (wall clock seconds) of
+# any row up to and including it. Taking the latest time keeps entries sorted even if the
+# clock went back for a while.
+INDEX_ENTRY = struct.Struct("<qd")
+
+_NEWLINE = ord("\n")
+
+_TIMES = {}  # time text -> seconds, rows of the same second are parsed once
+
+
+# Time of a data file row (b"10/18/2026, 12:00:00,S,..."), None for comment lines.
+def rowTime(line):
+	if line[:1] == b"#":
+		return None
+	text = line[:line.find(b",", line.find(b",") + 1)]
+	t = _TIMES.get(text)
+	if t is None:
+		try:
+			t = time.mktime(time.strptime(text.decode("ascii"), TIME_FORMAT))
+		except (ValueError, UnicodeDecodeError):
+			return None
+		if len(_TIMES) > 1024:
+			_TIMES.clear()
+		_TIMES[text] = t
+	return t
+
+
+# Time range queries over an append-only csv with time in the first column (data.csv).
+# The file is memory-mapped and a sparse index (path.tidx) holds one entry every stride
+# bytes, so finding rows between t1 and t2 is a binary search over the index and a scan
+# of one stride at each end, independent of file size.
+#
+# The index is extended by update() from where it ended, only a row per stride of the new
+# data is read. Libra.writefile calls it after writing, queries call it too. Rows must be
+# written in time order, rows written after the clock went back may be missed.
+#
+#	history = WeighingHistory("data.csv")
+#	for row in history.rows(time.time() - 3600, time.time()):
+#		...
+class WeighingHistory():
+
+	def __init__(self, path, index_path=None, stride=INDEX_STRIDE):
+		self.path = path
+		self.index_path = index_path if index_path is not None else path + INDEX_SUFFIX
+		self.stride = stride
+		self.lock = threading.Lock()
+		self.offsets = array("q")
+		self.times = array("d")
+		self.index = None  # index file, opened on first update
+		self.f = None
+		self.map = None
+		self.size = 0  # bytes of complete rows in map
+
+
+	def _load(self):
+		self.index = open(self.index_path, "a+b")
+		self.index.seek(0)
+		data = self.index.read()
+		data = data[:len(data) - len(data) % INDEX_ENTRY.size]  # drop partially written last entry
+		self.offsets = array("q")
+		self.times = array("d")
+		for offset, t in INDEX_ENTRY.iter_unpack(data):
+			self.offsets.append(offset)
+			self.times.append(t)
+		if self.offsets and self.offsets[-1] >= os.path.getsize(self.path):
+			# data file was replaced or truncated, the index is of no use
+			self.offsets = array("q")
+			self.times = array("d")
+			data = b""
+		self.index.truncate(len(data))
+
+
+	# Map the whole file again if it grew, size is set to the end of the last complete row.
+	def _remap(self):
+		if self.f is None:
+			self.f = open(self.path, "rb")
+		size = os.fstat(self.f.fileno()).st_size
+		if self.map is None or size > len(self.map):
+			if not size:
+				return
+			if self.map is not None:
+				self.map.close()
+			self.map = mmap.mmap(self.f.fileno(), size, access=mmap.ACCESS_READ)
+		self.size = self.map.rfind(b"\n", 0, size) + 1
+
+
+	# Index rows appended since the last call. Returns number of new index entries.
+	def update(self):
+		with self.lock:
+			return self._update()
+
+
+	def _update(self):
+		if not os.path.exists(self.path):
+			return 0
+		if self.index is None:
+			self._load()
+		self._remap()
+		m = self.map
+		end = self.size
+		pos = self.offsets[-1] + self.stride if self.offsets else 0
+		latest = self.times[-1] if self.times else -float("inf")
+		entries = []
+		while pos < end:
+			if pos and m[pos - 1] != _NEWLINE:
+				pos = m.find(b"\n", pos, end) + 1
+				if not pos:
+					break
+				continue
+			line_end = m.find(b"\n", pos, end)
+			t = rowTime(m[pos:line_end])
+			if t is None:
+				pos = line_end + 1
+				continue
+			latest = max(latest, t)
+			entries.append(INDEX_ENTRY.pack(pos, latest))
+			self.offsets.append(pos)
+			self.times.append(latest)
+			pos += self.stride
+		if entries:
+			self.index.seek(0, os.SEEK_END)
+			self.index.write(b"".join(entries))
+			self.index.flush()
+		return len(entries)
+
+
+	# Offset of the first row with time >= t, searched from the index entry before it.
+	def _find(self, t):
+		k = bisect.bisect_left(self.times, t)
+		pos = self.offsets[k - 1] if k else 0
+		m = self.map
+		while pos < self.size:
+			line_end = m.find(b"\n", pos, self.size)
+			row_time = rowTime(m[pos:line_end])
+			if row_time is not None and row_time >= t:
+				return pos
+			pos = line_end + 1
+		return self.size
+
+
+	# Byte range (start, end) of rows with t1 <= time < t2.
+	def span(self, t1, t2):
+		with self.lock:
+			self._update()
+			if self.map is None:
+				return (0, 0)
+			start = self._find(t1)
+			return (start, max(start, self._find(t2)))
+
+
+	# Rows with t1 <= time < t2 as they are in the file, comment lines (gaps) included.
+	def read(self, t1, t2):
+		start, end = self.span(t1, t2)
+		with self.lock:
+			return self.map[start:end] if end > start else b""
+
+
+	# Rows with t1 <= time < t2 as lists of strings, like sessions.SessionStore.readSession.
+	def rows(self, t1, t2):
+		data = self.read(t1, t2).decode("utf-8", "replace")
+		return [line.split(",") for line in data.splitlines() if not line.startswith("#")]
+
+
+	def close(self):
+		with self.lock:
+			if self.map is not None:
+				self.map.close()
+				self.map = None
+			if self.f is not None:
+				self.f.close()
+				self.f = None
+			if self.index is not None:
+				self.index.close()
+				self.index = None
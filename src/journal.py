@@ -0,0 +1,159 @@
+import os
+import struct
+import threading
+import time
+import zlib
+
+
+JOURNAL_SUFFIX = ".wal"
+
+# Seconds between fsyncs of the journal. Records reach the OS when appended, so a crash of
+# the process loses nothing, a power cut loses at most this much.
+COMMIT_INTERVAL = 0.2
+
+# Bytes of journal after which SessionStore drops records of ended sessions while other
+# sessions are still open, see Journal.compact.
+COMPACT_SIZE = 4 * 1024 * 1024
+
+# Record header: payload length, crc32 of type, key and payload, type, key
+RECORD = struct.Struct("<IIBq")
+
+# Record types of counting sessions, key is the session's journal key
+BEGIN = 1  # payload: start (wall clock seconds)
+OBJECT = 2  # payload: time of the object (wall clock seconds) and its csv row
+END = 3  # payload: session id and end, session is in the counting file
+TIME = struct.Struct("<d")
+ENDED = struct.Struct("<qd")
+
+
+def _crc(type, key, payload):
+	return zlib.crc32(payload, zlib.crc32(struct.pack("<Bq", type, key)))
+
+
+# Append-only log of small records with group commit. append() writes the record to the
+# file at once (one unbuffered write), a commit thread fsyncs everything appended since
+# its last round every commit_interval seconds, so many records share one fsync. Callers
+# that need a record on disk before going on wait with sync().
+#
+# A record torn by a crash fails its crc, it and everything after it is dropped on open.
+class Journal():
+
+	def __init__(self, path, commit_interval=COMMIT_INTERVAL):
+		self.path = path
+		self.commit_interval = commit_interval
+		self.lock = threading.Lock()
+		self.cond = threading.Condition(self.lock)
+		self.written = 0  # bytes appended
+		self.durable = 0  # bytes known to be on disk
+		self.commits = 0
+		self.truncated = 0  # times truncated, a commit that started before is void
+		self.stopped = False
+
+		self.f = open(path, "a+b", buffering=0)
+		valid = sum(RECORD.size + length for length, type, key, payload in self._scan())
+		self.f.truncate(valid)
+		self.written = self.durable = valid
+
+		self.thread = threading.Thread(target=self._commit, name="journal_commit", daemon=True)
+		self.thread.start()
+
+
+	def _scan(self):
+		self.f.seek(0)
+		data = self.f.read()
+		pos = 0
+		while pos + RECORD.size <= len(data):
+			length, crc, type, key = RECORD.unpack_from(data, pos)
+			payload = data[pos + RECORD.size:pos + RECORD.size + length]
+			if len(payload) != length or _crc(type, key, payload) != crc:
+				break
+			yield length, type, key, payload
+			pos += RECORD.size + length
+
+
+	# Records in the journal as (type, key, payload), oldest first.
+	def records(self):
+		with self.lock:
+			return [(type, key, payload) for length, type, key, payload in self._scan()]
+
+
+	# Returns position after the record, see sync().
+	def append(self, type, key, payload=b""):
+		record = RECORD.pack(len(payload), _crc(type, key, payload), type, key) + payload
+		with self.lock:
+			try:
+				self.f.write(record)
+			except OSError:
+				self.f.truncate(self.written)  # a torn record would hide every later one
+				raise
+			self.written += len(record)
+			self.cond.notify_all()
+			return self.written
+
+
+	# Wait until everything up to position (by default all appended records) is on disk.
+	def sync(self, position=None, timeout=None):
+		with self.lock:
+			position = self.written if position is None else position
+			return self.cond.wait_for(lambda: self.durable >= position or self.stopped, timeout)
+
+
+	def _commit(self):
+		while True:
+			with self.lock:
+				self.cond.wait_for(lambda: self.written > self.durable or self.stopped)
+				if self.stopped and self.written == self.durable:
+					return
+			if not self.stopped:
+				time.sleep(self.commit_interval)  # let more records join this commit
+			with self.lock:
+				position = self.written
+				truncated = self.truncated
+				fd = self.f.fileno()
+			os.fsync(fd)
+			with self.lock:
+				if truncated == self.truncated:
+					self.durable = max(self.durable, position)
+				self.commits += 1
+				self.cond.notify_all()
+
+
+	# Empty the journal, once nothing in it is needed any more.
+	def truncate(self):
+		with self.lock:
+			self.f.truncate(0)
+			os.fsync(self.f.fileno())
+			self.written = self.durable = 0
+			self.truncated += 1
+			self.cond.notify_all()
+
+
+	# Keep only records whose key is in keys, e.g. of sessions still open. The records are
+	# written to a new file that replaces the journal, a crash leaves either the old or the
+	# new one. Appends wait meanwhile.
+	def compact(self, keys):
+		with self.lock:
+			records = [
+				RECORD.pack(length, _crc(type, key, payload), type, key) + payload
+				for length, type, key, payload in self._scan() if key in keys
+			]
+			data = b"".join(records)
+			with open(self.path + ".tmp", "wb") as f:
+				f.write(data)
+				f.flush()
+				os.fsync(f.fileno())
+			os.replace(self.path + ".tmp", self.path)
+			self.f.close()
+			self.f = open(self.path, "a+b", buffering=0)
+			self.written = self.durable = len(data)
+			self.truncated += 1
+			self.cond.notify_all()
+			return len(data)
+
+
+	def close(self):
+		with self.lock:
+			self.stopped = True
+			self.cond.notify_all()
+		self.thread.join()
+		self.f.close()
@@ -2,10 +2,24 @@ import serial
 import sys
 import threading
 import queue
-import datetime
-import subprocess
-import requests
 import time
+from array import array
+
+from writer import BufferedWriter, drain, FLUSH_BATCH
+from ringbuffer import SampleRing, SAMPLE_CAPACITY
+from sample import Sample, Status
+from environment import EnvProvider
+from sessions import SessionStore
+from stability import StabilityDetector, PROFILES, SETTLED, UNSETTLED
+from metrics import Registry
+from archive import ArchiveWriter
+from counting import CountingEngine, RowCounting, OnceCounting, CheckWeighing
+from commands import CommandChannel, CommandError, COMMAND_TIMEOUT
+from transport import SerialTransport, Gap, RECONNECTING, CLOSED
+from rollups import Rollups
+from framing import FrameParser
+from history import WeighingHistory
+from offload import OffloadPool, WORKERS, statsJob, samplesJob, reportJob, compressJob
 
 
 # Commands
@@ -14,10 +28,14 @@ CMD_SET_TARE = "T\r\n".encode("ascii")
 CMD_CALIBRATE_SETTINGS = "C0\r\n".encode("ascii")
 CMD_CALIBRATE_SET_SETTINGS = "C0 0 1\r\n".encode("ascii")
 CMD_CALIBRATE_INIT_CALIB = "C2\r\n".encode("ascii")
+CMD_READ_STABLE = "S\r\n".encode("ascii")
+
+# Seconds to wait for calibration to finish, the user has to put the weight on the scale
+CALIBRATE_TIMEOUT = 120.0
 
 # Return options
-STABLE = "S"
-UNSTABLE = "SD"
+STABLE = Status.STABLE
+UNSTABLE = Status.UNSTABLE
 
 # Files
 COUNTING_FILE = "counting.csv"
@@ -26,45 +44,118 @@ ALL_FILE = "data.csv"
 # Units
 GRAM = "g"
 
+# Seconds between saves of rollups to rollup_path
+ROLLUP_SAVE_INTERVAL = 60.0
+
 # NaN used for stabilization time while unstable
 NAN = float("nan")
 
 # Used for determining which type of counting a user wants
 COUNT_ROW = "in_row"
 COUNT_ONCE = "once"
+COUNT_CHECK = "check"
+
+# Events passed to Libra.listeners as (event, data)
+EVENT_COUNTING = "counting"  # data is counting.Counting whose result changed
+EVENT_GAP = "gap"  # data is transport.Gap, no samples came for a while
+EVENT_STATS = "stats"  # data is (counting.RowCounting, statistics from offload.statsJob) of a finished session
+
+
+# Stable reading queued for writefile as (sample, stabilization_time, env_data), formatted as csv line.
+# A transport.Gap in the queue marks time without data and is written as a comment line.
+def formatRecord(record):
+	if isinstance(record, Gap):
+		return record.format()
+	sample, stabilization_time, env_data = record
+	return ",".join(sample.format() + [
+		str(stabilization_time),
+		env_data["pressure"],
+		env_data["humidity"],
+		env_data["temperature"]
+	]) + "\n"
+
 
 class Libra():
 
-	ser = None  # serial to communicate with libra
-	mutex = None  # lock for serial port availability
+	ser = None  # transport.SerialTransport to communicate with libra, reconnects on its own
+	mutex = None  # lock for writing to serial port
+	commands = None  # commands.CommandChannel, sends commands while readCont keeps reading
+	parser = None  # framing.FrameParser of readCont, splits bulk reads into samples
 
 	thread_cont_read = None  # thread for constant reading
 	thread_writefile = None  # thread for writing data to file, should always be running
 
-	queue_cont_read = None  # queue for storing SIR weight data
-	queue_backup = queue.Queue()  # same as queue_cont_read but only GUI can empty
+	samples = None  # ring buffer of SIR weight data, each consumer reads with its own cursor
 	queue_special = None  # used for anything else
 	queue_writefile = None  # queue for writing data to file
 
+	stability = None  # stability.StabilityDetector, decides when weight has settled
+	counting = None  # counting.CountingEngine running countings started with countApi
+	sessions = None  # sessions.SessionStore of counting sessions in COUNTING_FILE
+	env = None  # environment.EnvProvider, keeps env data fresh in background
 	env_data = None  # stores a dictionary of environment data (humidity, temperature, and pressure)
 
+	metrics = None  # metrics.Registry with counters, gauges and histograms of this instance
+	rollups = None  # rollups.Rollups, per second/minute/hour aggregates of all samples
+	offload = None  # offload.OffloadPool, worker processes for statistics, reports and compression
+	history = None  # history.WeighingHistory, time range queries over all_file
+
 	# Custom signals
 	STOP_COUNTING = False
 	STOP_MAIN = False
 	STOP_WRITE = False
 
 
-	def __init__(self, port=None, baudrate=None, bytesize=None, parity=None, stopbits=None, xonxoff=None):
+	def __init__(self, port=None, baudrate=None, bytesize=None, parity=None, stopbits=None, xonxoff=None,
+			write_mode=FLUSH_BATCH, write_batch_size=64, write_interval=1.0, fsync_every=100,
+			sample_capacity=SAMPLE_CAPACITY, env_source=None, product="default",
+			metrics_port=None, metrics_file=None, archive_path=None, rollup_path=None,
+			offload_workers=WORKERS, compress_rotated=False):
 		self.current_tare = 0.00  # current tare setting
 
-		self.stabilization_time = NAN  # time from first UNSTABLE to first STABLE, initially on 0
-		self.stabilization_time_start = None  # time of first UNSTABLE
+		self.stabilization_time = NAN  # time from weight becoming unsettled to settled again
+		self.stabilization_time_start = None  # time weight became unsettled
 
 		self.count_results_row = 0  # Used for getting results of counting, either number of pieces in a row or at once present
 		self.count_results_once = 0
+		self.count_result = None  # counting.CountResult of last counting at once, with confidence interval
+		self.check_results = None  # counts of under/ok/over pieces of last check weighing
+		self.count_row_id = None  # id of last row counting, stopped by countApi(COUNT_ROW, stop=True)
 		self.target = ""
-		self.all_file = ALL_FILE
+		self.all_file = ALL_FILE  # may be changed at runtime, writefile rotates to the new path
+		self.archive_path = archive_path  # if set, stable readings are also kept in a columnar archive.ArchiveWriter
+		self.rollup_path = rollup_path  # if set, rollups are loaded from and saved to this directory
+		self.compress_rotated = compress_rotated  # gzip data files in a worker once writefile rotates away from them
+		self.writer_options = {
+			"mode": write_mode,
+			"batch_size": write_batch_size,
+			"flush_interval": write_interval,
+			"fsync_every": fsync_every
+		}
 		self.queue_stdout = queue.Queue()
+		self.listeners = []  # callables (event, data) for EVENT_COUNTING and EVENT_GAP, see emit
+		self.samples = SampleRing(sample_capacity)
+		self.rollups = Rollups()
+		if rollup_path is not None:
+			self.rollups.load(rollup_path)
+		self.stability = StabilityDetector.fromProfile(product)
+		self.stability.log = self.queue_stdout.put
+		self.stability.subscribe(self.onStability)
+		self.counting = CountingEngine(self.stability)
+		self.offload = OffloadPool(offload_workers, log=self.queue_stdout.put) if offload_workers else None
+		self.queue_writefile = queue.Queue()
+		self.sessions = SessionStore(COUNTING_FILE)
+		for info in self.sessions.recovered:
+			self.queue_stdout.put("[sessions] session {0} with {1} objects recovered from journal".format(info.id, info.pieces))
+		self.history = WeighingHistory(self.all_file)
+		self.env = EnvProvider(env_source)
+		self.env.start()
+		self.env_data = self.env.get()
+		self.initMetrics()
+		if metrics_port is not None:
+			self.metrics.serve(metrics_port)
+		if metrics_file is not None:
+			self.metrics.startSnapshots(metrics_file)
 
 		if port is not None:
 			try:
@@ -72,9 +163,6 @@ class Libra():
 			except:
 				self.queue_stdout.put("Serial port error")
 
-		self.queue_cont_read = queue.Queue()
-		self.queue_backup = queue.Queue()
-		self.queue_writefile = queue.Queue()
 		self.thread_writefile = threading.Thread(
 			target=self.writefile,
 			name="writefile",
@@ -82,8 +170,6 @@ class Libra():
 		)
 		self.thread_writefile.start()
 
-		self.getEnvData()
-
 
 	def __str__(self):
 		self.queue_stdout.put("Libra on port {0} with following configuration:\n\
@@ -95,22 +181,32 @@ class Libra():
                \tXONXOFF = {6}\n")
 
 
-	def getEnvData(self, p="Zračni tlak:  ", h="Vlažnost zraka: ", t="LJUBLJANA: "):
-		data = requests.get(
-			"http://meteo.arso.gov.si/uploads/probase/www/observ/surface/text/sl/observationAms_LJUBL-ANA_BEZIGRAD_latest.rss")
-		env_data = {}
-		i = data.text.find(p)
-		env_data["pressure"] = data.text[i + len(p):i + len(p) + 4] + " mbar"
-
-		i = data.text.find(h)
-		env_data["humidity"] = data.text[i + len(h):i + len(h) + 2] + " %"
-
-		i = data.text.find(t)
-		env_data["temperature"] = data.text[i + len(t):i + len(t) + 2] + " °C"
-
-		self.env_data = env_data
-
-		return env_data
+	def initMetrics(self):
+		self.metrics = Registry()
+		self.metric_read = self.metrics.histogram("libra_serial_read_seconds", "Time spent waiting in serial read per bulk read")
+		self.metric_parse = self.metrics.histogram("libra_parse_seconds", "Time spent parsing the lines of one bulk read")
+		self.metric_samples = self.metrics.counter("libra_samples_total", "Samples read from the scale")
+		self.metric_malformed = self.metrics.counter("libra_malformed_lines_total", "Serial lines that were not weights")
+		self.metric_tare = self.metrics.histogram("libra_tare_seconds", "Time from sending tare to its response")
+		self.metric_write_batch = self.metrics.histogram("libra_write_batch_seconds", "Time to commit a batch to the data file")
+		self.metrics.gauge("libra_ring_samples", "Samples held in the ring buffer", lambda: len(self.samples))
+		self.metrics.gauge("libra_ring_dropped_samples", "Samples overwritten before a reader got to them", lambda: self.samples.dropped)
+		self.metrics.gauge("libra_queue_writefile_depth", "Records waiting to be written", self.queue_writefile.qsize)
+		self.metrics.gauge("libra_queue_stdout_depth", "Messages waiting for the GUI log", self.queue_stdout.qsize)
+		self.metrics.gauge("libra_serial_connected", "1 if lines are coming from the scale", lambda: int(self.ser is not None and self.ser.isConnected()))
+		self.metrics.gauge("libra_serial_reconnects", "Times the serial port was reopened", lambda: self.ser.reconnects if self.ser is not None else 0)
+		self.metrics.gauge("libra_offload_pending", "Jobs running or queued in worker processes", lambda: self.offload.pending if self.offload is not None else 0)
+		self.metrics.gauge("libra_offload_rejected", "Jobs refused because too many were pending", lambda: self.offload.rejected if self.offload is not None else 0)
+		self.metrics.gauge("libra_serial_gap_seconds", "Total time without data from the scale", lambda: self.ser.gap_seconds if self.ser is not None else 0)
+
+
+	# Latest environment data, never blocks. Data is fetched by self.env in background,
+	# refresh=True asks for a new fetch which will be seen by later calls.
+	def getEnvData(self, refresh=False):
+		if refresh:
+			self.env.refresh()
+		self.env_data = self.env.get()
+		return self.env_data
 
 
 	def __str__(self):
@@ -123,8 +219,17 @@ class Libra():
                \tXONXOFF = {6}\n")
 
 
+	# Open port and start reading. If the port can not be opened now, readCont keeps trying
+	# in background, see transport.SerialTransport. Called again (GUI picking another port)
+	# the reader of the old port is stopped first.
 	def openSerial(self, port, baudrate, bytesize, parity, stopbits, xonxoff):
-		self.ser = serial.Serial(
+		if self.ser is not None:
+			if self.thread_cont_read is not None:
+				self.stopReadCont()
+			self.ser.stop()
+			self.ser = None
+
+		ser = SerialTransport(
 			port=port,
 			baudrate=baudrate,
 			bytesize=bytesize,
@@ -132,15 +237,73 @@ class Libra():
 			stopbits=stopbits,
 			xonxoff=xonxoff
 		)
-
+		# callbacks are set before opening, so SIR goes out as soon as the port is open
+		ser.on_connect = self.onConnect
+		ser.on_gap = self.onGap
+		ser.on_state = self.onSerialState
 		self.current_tare = 0 #self.getTareFromScale()  # get initial tare value
 		self.mutex = threading.Lock()
+		self.commands = CommandChannel(ser, self.mutex)
+		self.ser = ser
+		try:
+			ser.open()
+		except (OSError, serial.SerialException) as e:
+			self.queue_stdout.put("[openSerial] Serial port error, retrying in background: " + str(e))
+			ser.disconnect(e)
 		self.startReadCont()
 
 
+	# Called by transport on readCont thread when port was reopened or went silent.
+	def onConnect(self):
+		if self.parser is not None:
+			self.parser.reset()  # a line cut by the outage would only be garbage
+		try:
+			self.ser.write(CMD_CONT_READ)
+		except serial.SerialException as e:
+			self.queue_stdout.put("[onConnect] " + str(e))
+
+
+	def onSerialState(self, state):
+		self.queue_stdout.put("[serial] " + state)
+		if state == RECONNECTING:
+			self.commands.cancel("scale disconnected")
+
+
+	# First line after time without data. Stability is judged again from fresh samples and the
+	# gap is marked in the data file.
+	def onGap(self, gap):
+		self.stability.reset()
+		self.stabilization_time = NAN
+		self.stabilization_time_start = None
+		self.queue_writefile.put(gap)
+		self.queue_stdout.put("[serial] no data for {0:.1f} s".format(gap.duration()))
+		self.emit(EVENT_GAP, gap)
+
+
+	# Call listeners, on the thread the event happened on (mostly readCont).
+	def emit(self, event, data):
+		for listener in list(self.listeners):
+			try:
+				listener(event, data)
+			except Exception as e:  # mostly called on readCont, which must go on
+				self.queue_stdout.put("[emit] {0} listener failed: {1!r}".format(event, e))
+
+
+	# Serial and pipeline state, for monitoring.
+	def health(self):
+		health = self.ser.health() if self.ser is not None else {"state": CLOSED}
+		health.update({
+			"samples": self.samples.head,
+			"queue_writefile": self.queue_writefile.qsize(),
+			"env_stale": self.env.isStale()
+		})
+		return health
+
+
 	def startReadCont(self):
 		self.STOP_MAIN = False
 		assert self.ser is not None, "[startReadCont] Not connected to serial port"
+		self.ser.resume()  # stopReadCont closed the port
 
 		if self.thread_cont_read is None:
 			self.thread_cont_read = threading.Thread(
@@ -149,162 +312,259 @@ class Libra():
 				daemon=True
 			)
 
-		self.mutex.acquire()
-		self.thread_cont_read.start()  # when killing this process, release lock
+		self.thread_cont_read.start()
 		self.queue_stdout.put("thread_cont_read started!")
 
 
 	def processRead(self, string):
-		string = string.decode('ascii').strip().split()
-		return [datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S")] + string
+		return Sample.parse(string)
 
 
+	# Only thread reading the serial port. Whatever is available is read at once and split
+	# into lines by self.parser. Responses to commands are handed to the callers waiting in
+	# self.commands, everything else is a sample.
 	def readCont(self):
-		self.ser.write(CMD_CONT_READ)
+		self.parser = FrameParser()  # SIR was sent by onConnect when the port was opened
 
 		while True:
 			if self.STOP_MAIN:
 				break
-			now = datetime.datetime.now()
-			str_read = self.ser.read_until(serial.CR+serial.LF)
-			str_read = self.processRead(str_read)
-			self.queue_cont_read.put(str_read)
-			self.queue_backup.put(str_read)
-
-			if self.stabilization_time_start is None and str_read[1] == UNSTABLE:
-				self.stabilization_time = NAN
-				self.stabilization_time_start = now
-			elif str_read[1] == STABLE and self.stabilization_time_start is not None:
-				timediff = now - self.stabilization_time_start
-				self.stabilization_time_start = None
-				self.stabilization_time = timediff.seconds + round(timediff.microseconds/10**6, 3)
-				self.queue_writefile.put(str_read+[str(self.stabilization_time)]+[self.env_data["pressure"], self.env_data["humidity"], self.env_data["temperature"]])
-
-
-	def countApi(self, method,stop=False,target=None):
-		self.thread_count_stop = stop
+			start = time.perf_counter()
+			data = self.ser.read()
+			read = time.perf_counter()
+			if data is None:
+				break
+			if not data:  # timeout, transport is taking care of it
+				continue
+			self.metric_read.observe(read - start)
+
+			# lines of samples are only needed while a command (S) may be waiting for one
+			for sample, line in self.parser.parse(data, time.monotonic(), raw=bool(self.commands.pending)):
+				if line is not None and self.commands.route(line):
+					continue
+				if sample is None:
+					self.metric_malformed.inc()
+					self.queue_stdout.put("[readCont] malformed read: " + line.decode("ascii", "replace").strip())
+					continue
+				self.metric_samples.inc()
+				self.samples.append(sample)
+				self.rollups.update(sample)
+				self.stability.update(sample)
+			self.metric_parse.observe(time.perf_counter() - read)
+
+
+	# Called by stability detector on readCont thread. Settled weights are written to file.
+	def onStability(self, event, sample):
+		if event == UNSETTLED and self.stabilization_time_start is None:
+			self.stabilization_time = NAN
+			self.stabilization_time_start = sample.timestamp
+		elif event == SETTLED and self.stabilization_time_start is not None:
+			self.stabilization_time = round(sample.timestamp - self.stabilization_time_start, 3)
+			self.stabilization_time_start = None
+			self.queue_writefile.put((sample, self.stabilization_time, self.getEnvData()))
+
+
+	# Select stability detection settings from stability.PROFILES.
+	def setProduct(self, product):
+		self.stability.configure(**PROFILES[product])
+		self.queue_stdout.put("[setProduct] stability profile " + product)
+
+
+	# Start counting with given method and return its id, see counting.CountingEngine. Any
+	# number of countings can run at once, each sees every settled weight. With stop=True
+	# counting id (by default the last row counting) is stopped instead.
+	# target is piece weight for COUNT_ONCE and (low, high) for COUNT_CHECK. Without target,
+	# COUNT_ONCE weighs reference_pieces one at a time, or all at once with reference_group.
+	def countApi(self, method, stop=False, target=None, reference_pieces=1, id=None, reference_group=False):
 		if stop:
+			id = id if id is not None else self.count_row_id
+			if id is not None:
+				self.counting.stop(id)
 			self.queue_stdout.put("[countApi] exit")
-			return
-		self.queue_stdout.put("[countApi] Starting thread with method " + method)
+			return id
+
+		self.queue_stdout.put("[countApi] Starting counting with method " + method)
+		options = {"log": self.queue_stdout.put, "notify": self.onCounting}
 		if method == COUNT_ROW:
-			self.thread_count = threading.Thread(target=self.countObjectsInRow,	name="countAPI", daemon=True)
+			counting = RowCounting(self.sessions, **options)
 		elif method == COUNT_ONCE:
-			self.thread_count = threading.Thread(target=self.countObjectsAtOnce, name="countAPI", daemon=True, args=[target])
+			self.target = None
+			self.count_result = None
+			counting = OnceCounting(target, reference_pieces, self.stability.threshold, reference_group, **options)
+		elif method == COUNT_CHECK:
+			counting = CheckWeighing(target[0], target[1], **options)
 		else:
 			self.queue_stdout.put("[countApi] Unknown method ...")
-			return
-
-		self.thread_count.start()
-
+			return None
 
+		id = self.counting.start(counting)
+		if method == COUNT_ROW:
+			self.count_row_id = id
+		return id
+
+
+	# Called by countings on the readCont thread when their results change.
+	def onCounting(self, counting):
+		if isinstance(counting, RowCounting):
+			self.count_results_row = counting.count
+		elif isinstance(counting, OnceCounting):
+			self.target = counting.target()
+			if counting.result is not None:
+				self.count_result = counting.result
+				self.count_results_once = counting.result.estimate
+		elif isinstance(counting, CheckWeighing):
+			self.check_results = dict(counting.counts)
+		self.emit(EVENT_COUNTING, counting)
+		if isinstance(counting, RowCounting) and counting.done.is_set() and counting.info is not None:
+			self.sessionStats(counting)
+
+
+	# Statistics of a finished row counting session, computed in a worker process and passed
+	# to listeners as EVENT_STATS.
+	def sessionStats(self, counting):
+		objects = counting.session.objects
+		if self.offload is None or not objects:
+			return None
+		columns = {
+			"session": array("q", [counting.info.id]) * len(objects),
+			"weight": array("d", [sample.weight for sample in objects])
+		}
+		return self.offload.submit(statsJob, columns, callback=lambda stats: self.emit(EVENT_STATS, (counting, stats)))
+
+
+	# Summary (offload.samplesJob) of the last n samples in the ring, passed to callback from a
+	# worker process. The ring is copied straight into shared memory. Returns Future or None.
+	def samplesSummary(self, callback, n=SAMPLE_CAPACITY):
+		if self.offload is None:
+			return None
+		columns = self.samples.snapshot(n)  # copied under the ring lock, the reader keeps appending
+		del columns["unit"]
+		return self.offload.submit(samplesJob, columns, callback=callback)
+
+
+	# Per session statistics of a whole counting file written to report_path as csv by a
+	# worker process, callback gets report_path. Returns Future or None.
+	def sessionReport(self, report_path, lsl=None, usl=None, callback=None, counting_path=COUNTING_FILE):
+		if self.offload is None:
+			return None
+		return self.offload.submit(reportJob, None, counting_path, report_path, lsl, usl, callback=callback)
+
+
+	# Blocking version of countApi(COUNT_ROW), returns number of objects once stopped from
+	# another thread or with Ctrl+C.
 	def countObjectsInRow(self):
-		self.queue_stdout.put("[countObjectsInRow] Waiting for stable zero ...")
-		while not self.thread_count_stop:
-			m = self.queue_cont_read.get()
-			if m[1] == STABLE and float(m[2]) < 0.1:
-				break
-
-		self.queue_stdout.put("[countObjectsInRow] Stable zero acquired, start weighting ...")
-		objects = []
-		new = False
-		while not self.thread_count_stop:
-			if self.STOP_COUNTING or self.STOP_MAIN:
-				break
-			m = self.queue_cont_read.get()
-			if m[1] == STABLE and new and float(m[2]) > 0.1:
-				new = False
-				objects.append(m)
-				self.queue_stdout.put('beep')
-			elif m[1] == UNSTABLE:
-				new = True
-
+		id = self.countApi(COUNT_ROW)
+		counting = self.counting.get(id)
 		try:
-			id_counting = str(int(subprocess.check_output(["tail", "-1", COUNTING_FILE]).split(',')[0])+1)
-		except:
-			id_counting = "0"
-
-		f = open(COUNTING_FILE, mode="a+")
-		for obj in objects:
-			str_filewrite = id_counting + "," + ",".join(obj) + "\n"
-			if f.write(str_filewrite) != len(str_filewrite):
-				self.queue_stdout.put("[countObjectsInRow] failed to write object:\n\t{}\nto file".format(str_filewrite))
-		f.close()
-
-		self.count_results_row = len(objects)
-
-
-	def countObjectsAtOnce(self, target_weight=None):
-		self.target = None
-		if target_weight is None:  # we need to get stable weight of an object unless it was already supplied
-			self.queue_stdout.put("[countObjectsAtOnce] Waiting for stable weight ...")
-			while True:
-				m = self.queue_cont_read.get()
-				if m[1] == STABLE and float(m[2]) > 0.1:
-					self.target = float(m[2])
-					break
-		else:
-			self.target = target_weight
+			counting.done.wait()
+		except KeyboardInterrupt:
+			self.countApi(COUNT_ROW, stop=True, id=id)
+		return counting.count
 
-		self.queue_stdout.put("[countObjectsAtOnce] Stable weight acquired, target weight is {0}".format(self.target))
-		self.queue_stdout.put("[countObjectsAtOnce] Remove object and weight for stable zero ...")
-		while True:
-			m = self.queue_cont_read.get()
-			if m[1] == STABLE and float(m[2]) < 0.1:
-				break
-		self.queue_stdout.put("[countObjectsAtOnce] Stable zero acquired. Put objects on weight")
-		# weight will now become UNSTABLE due to change of pieces on scale
-		weight = None
-		while True:
-			m = self.queue_cont_read.get()
-			if m[1] == STABLE and float(m[2]) > 0.1:
-				weight = float(m[2])
-				break
 
-		if weight is not None:
-			self.queue_stdout.put("[countObjectsAtOnce] Counted {0} objects".format(weight/self.target))
-			self.count_results_once = weight / self.target
-		else:
-			self.queue_stdout.put("[countObjectsAtOnce] Counting failed. Measured weight is None")
-			self.count_results_once = None
+	# Blocking version of countApi(COUNT_ONCE), returns counted number of objects.
+	def countObjectsAtOnce(self, target_weight=None, reference_pieces=1, reference_group=False):
+		id = self.countApi(COUNT_ONCE, target=target_weight, reference_pieces=reference_pieces, reference_group=reference_group)
+		counting = self.counting.get(id)
+		if counting is not None:
+			counting.done.wait()
+		return self.count_results_once
 
 
-	# Write to file on new stable weight.
+	# Write to file on new stable weight. File is kept open and records are written in
+	# batches, see writer.BufferedWriter for flushing and durability options.
 	def writefile(self):
-		while True:
-			f = open(self.all_file, "a+")
-			if self.STOP_WRITE:
-				break
-			m = self.queue_writefile.get()
-			self.queue_stdout.put(m)
-			str_filewrite = ",".join(m) + "\n"
-			if f.write(str_filewrite) != len(str_filewrite):
+		writer = BufferedWriter(self.all_file, **self.writer_options)
+		writer.commit_time = self.metric_write_batch
+		archive = ArchiveWriter(self.archive_path) if self.archive_path is not None else None
+		next_save = time.monotonic() + ROLLUP_SAVE_INTERVAL
+		while not self.STOP_WRITE:
+			batch = drain(self.queue_writefile, writer.batch_size, writer.timeUntilFlush())
+			if self.all_file != writer.path:
+				old = writer.path
+				writer.rotate(self.all_file)
+				self.history.close()
+				self.history = WeighingHistory(self.all_file)
+				self.queue_stdout.put("[writefile] writing to " + self.all_file)
+				if self.compress_rotated and self.offload is not None:
+					self.offload.submit(compressJob, None, old, callback=lambda result: self.queue_stdout.put(
+						"[writefile] compressed {0} ({1} -> {2} bytes)".format(*result)))
+			try:
+				for m in batch:
+					line = formatRecord(m)
+					self.queue_stdout.put(line.rstrip())
+					writer.write(line)
+				writer.poll()
+				if batch:
+					self.history.update()
+				if archive is not None and batch:
+					for m in batch:
+						if not isinstance(m, Gap):
+							archive.appendRecord(m)
+					archive.flush()
+				if self.rollup_path is not None and time.monotonic() >= next_save:
+					next_save = time.monotonic() + ROLLUP_SAVE_INTERVAL
+					self.rollups.save(self.rollup_path)
+			except OSError:
 				self.queue_stdout.put("[writefile] error writing to file")
-			f.close()
+
+		# flush whatever was queued before stop was requested
+		try:
+			for m in drain(self.queue_writefile, self.queue_writefile.qsize(), 0):
+				writer.write(formatRecord(m))
+				if archive is not None and not isinstance(m, Gap):
+					archive.appendRecord(m)
+			writer.close()
+			if archive is not None:
+				archive.close()
+			if self.rollup_path is not None:
+				self.rollups.save(self.rollup_path)
+		except OSError:
+			self.queue_stdout.put("[writefile] error writing to file")
+
+
+	# Stable readings written to all_file with t1 <= time < t2 (wall clock seconds), as lists
+	# of strings. Found with the sparse index of self.history, not by reading the whole file.
+	def weighings(self, t1, t2=float("inf")):
+		try:
+			return self.history.rows(t1, t2)
+		except (OSError, ValueError) as e:  # ValueError if writefile rotated and closed it meanwhile
+			self.queue_stdout.put("[weighings] " + str(e))
+			return []
+
+
+	# Objects of counting session id as lists of strings, None if there is no such session.
+	def sessionObjects(self, id):
+		try:
+			return self.sessions.readSession(id)
+		except OSError as e:
+			self.queue_stdout.put("[sessionObjects] " + str(e))
+			return None
 
 
-	# API for setting tare value. If value and unit is not given, set tare to current value
+	# API for setting tare value. If value and unit is not given, set tare to current value.
+	# Continuous reading goes on while waiting for the response. Returns current tare or None on error.
 	def setTare(self, zero=False):
-		# signal to thread_read_cont to stop and acquire mutex
-		self.stopReadCont()
-		self.mutex.acquire()
-		while not self.queue_cont_read.empty():
-				self.queue_stdout.put(self.queue_cont_read.get())
+		start = time.perf_counter()
 
 		# Our scale only supports tare on next stable weight.
-		self.ser.write(CMD_SET_TARE)
-
+		try:
+			response = self.commands.send(CMD_SET_TARE, "T")[-1]
+		except (TimeoutError, CommandError) as e:
+			self.queue_stdout.put("[setTare] " + str(e))
+			return None
+		finally:
+			self.metric_tare.observe(time.perf_counter() - start)
 
 		# Response is "T S value unit". If not "S", something went wrong.
-		response = self.ser.read_until(serial.CR+serial.LF).decode("ascii").strip()
 		response_parts = response.split()
+		if response_parts[1] != "S":
+			self.queue_stdout.put("[setTare] tare failed: " + response)
+			return None
 		if not zero:
-			self.current_tare += float(response_parts[1])
+			self.current_tare += float(response_parts[-2])
 			self.queue_stdout.put(self.current_tare)
-
-		# release mutex and continue with continuous weight reading
-		self.mutex.release()
-		self.startReadCont()
+		return self.current_tare
 
 	
 	# Could be deprecated but we love to keep backward compatibility ;).
@@ -312,10 +572,56 @@ class Libra():
 		return self.setTare(0)
 
 
+	# Next stable weight as sample.Sample, None on error. The response is a sample line, so it
+	# also goes to the ring buffer like any other.
+	def readStable(self, timeout=COMMAND_TIMEOUT):
+		try:
+			with self.ser.silence():
+				response = self.commands.send(CMD_READ_STABLE, "S", consume=False, timeout=timeout)[-1]
+		except (TimeoutError, CommandError) as e:
+			self.queue_stdout.put("[readStable] " + str(e))
+			return None
+		finally:
+			self.resumeStream()
+		return Sample.parse(response.encode("ascii"))
+
+
+	# Calibration with external weight. The scale asks for the weight with "C2 B" lines, which
+	# are passed to queue_stdout, and answers "C2 A" when done. Returns True on success.
+	def calibrate(self, weight=None):
+		if weight is not None:
+			self.queue_stdout.put("[calibrate] calibrating with {0} g".format(weight))
+		try:
+			with self.ser.silence():  # no samples until the user is done
+				self.commands.send(CMD_CALIBRATE_SET_SETTINGS, "C0")
+				response = self.commands.send(
+					CMD_CALIBRATE_INIT_CALIB, "C2", CALIBRATE_TIMEOUT,
+					progress=lambda line: self.queue_stdout.put("[calibrate] put weight on scale: " + line)
+				)[-1]
+		except (TimeoutError, CommandError) as e:
+			self.queue_stdout.put("[calibrate] " + str(e))
+			return False
+		finally:
+			self.resumeStream()
+		ok = response.split()[1:2] == ["A"]
+		self.queue_stdout.put("[calibrate] " + ("done" if ok else "failed: " + response))
+		return ok
+
+
+	# S and C2 end the SIR stream on the scale, send SIR again after them.
+	def resumeStream(self):
+		try:
+			self.commands.write(CMD_CONT_READ)
+		except serial.SerialException as e:
+			self.queue_stdout.put("[resumeStream] " + str(e))
+
+
 	# API for stoping writefile thread. Should not close this thread unless the end of the program.
 	def stopWritefile(self):
 		self.STOP_WRITE = True
 		self.thread_writefile.join()
+		if self.offload is not None:
+			self.offload.shutdown()
 		caller = sys._getframe(1).f_code.co_name
 		self.queue_stdout.put("[{0}] thread *writefile* joined!".format(caller))
 		self.thread_writefile = None
@@ -324,9 +630,10 @@ class Libra():
 	# API for stoping read_cont thread.
 	def stopReadCont(self):
 		self.STOP_MAIN = True
+		self.ser.stop()  # wakes readCont from a read or reconnect backoff
 		self.thread_cont_read.join()
 		# self.ser.write("@\r\n".encode("ascii"))
-		self.mutex.release()
+		self.commands.cancel("reader stopped")
 		caller = sys._getframe(1).f_code.co_name
 		self.queue_stdout.put("[{0}] thread *read_cont* joined!".format(caller))
 		self.thread_cont_read = None
@@ -367,8 +674,8 @@ if __name__ == "__main__":
 			else:
 				libra.setTare(value=float(t))
 
-		while True:
-			pass
+		# wait for Ctrl+C, for running without a terminal see daemon.py
+		threading.Event().wait()
 	except KeyboardInterrupt:
 		libra.stopReadCont()
 		libra.stopWritefile()
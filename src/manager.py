@@ -0,0 +1,113 @@
+import asyncio
+import queue
+import threading
+
+from async_libra import AsyncLibra
+from writer import BufferedWriter, FLUSH_BATCH
+
+
+# File all managed scales write their samples to
+SCALES_FILE = "scales.csv"
+
+
+# Drives many balances from one process. All ports are watched by a single asyncio loop
+# running in one thread, so thread count does not grow with the number of scales.
+# Every sample is tagged with the id of its scale, written to a shared csv sink as
+# "scale_id,time,status,weight,unit" and passed to subscribers as (scale_id, sample).
+#
+# Methods are called from other threads, commands return concurrent.futures.Future.
+class ScaleManager():
+
+	def __init__(self, sink_file=SCALES_FILE, write_mode=FLUSH_BATCH, write_batch_size=256, write_interval=1.0):
+		self.scales = {}  # scale id -> AsyncLibra
+		self.subscribers = []  # callables (scale_id, sample), called on the loop thread
+		self.queue_stdout = queue.Queue()
+
+		self.sink = BufferedWriter(sink_file, mode=write_mode, batch_size=write_batch_size, flush_interval=write_interval)
+		self.loop = asyncio.new_event_loop()
+		self.thread = None
+
+
+	def start(self):
+		assert self.thread is None, "[ScaleManager] already started"
+		self.thread = threading.Thread(target=self._run, name="scale_manager", daemon=True)
+		self.thread.start()
+
+
+	def _run(self):
+		asyncio.set_event_loop(self.loop)
+		self.loop.call_soon(self._pollSink)
+		self.loop.run_forever()
+
+		# loop stopped, close everything on this thread
+		for scale in self.scales.values():
+			scale.close()
+		self.sink.close()
+		self.loop.close()
+
+
+	def stop(self):
+		if self.thread is None:
+			return
+		self.loop.call_soon_threadsafe(self.loop.stop)
+		self.thread.join()
+		self.thread = None
+
+
+	def submit(self, coro):
+		return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+
+	# Open port and start reading it. Returns future that resolves once the port is open.
+	def add(self, scale_id, port, **serial_options):
+		return self.submit(self._add(scale_id, AsyncLibra(port, **serial_options)))
+
+
+	async def _add(self, scale_id, scale):
+		assert scale_id not in self.scales, "[ScaleManager] duplicate scale id " + str(scale_id)
+		try:
+			await scale.open()
+		except Exception as e:
+			self.queue_stdout.put("[ScaleManager] Serial port error on {0}: {1}".format(scale_id, e))
+			raise
+		scale.listeners.append(lambda sample: self._onSample(scale_id, sample))
+		self.scales[scale_id] = scale
+		self.queue_stdout.put("[ScaleManager] scale {0} on {1} added".format(scale_id, scale.port))
+
+
+	def remove(self, scale_id):
+		return self.submit(self._remove(scale_id))
+
+
+	async def _remove(self, scale_id):
+		self.scales.pop(scale_id).close()
+
+
+	def _onSample(self, scale_id, sample):
+		try:
+			self.sink.write(str(scale_id) + "," + ",".join(sample.format()) + "\n")
+		except OSError:
+			self.queue_stdout.put("[ScaleManager] error writing to file")
+		for subscriber in self.subscribers:
+			subscriber(scale_id, sample)
+
+
+	# Commit sink batches that have waited long enough, also when no samples are coming.
+	def _pollSink(self):
+		try:
+			self.sink.poll()
+		except OSError:
+			self.queue_stdout.put("[ScaleManager] error writing to file")
+		self.loop.call_later(max(self.sink.timeUntilFlush(), 0.05), self._pollSink)
+
+
+	def latest(self, scale_id):
+		return self.scales[scale_id].samples.latest()
+
+
+	def tare(self, scale_id, zero=False):
+		return self.submit(self.scales[scale_id].tare(zero))
+
+
+	def countOnce(self, scale_id, target_weight=None):
+		return self.submit(self.scales[scale_id].count_once(target_weight))
@@ -0,0 +1,171 @@
+import bisect
+import os
+import threading
+
+
+# Default histogram buckets in seconds, from 10 us to 10 s
+LATENCY_BUCKETS = (0.00001, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+# Metrics are plain attribute updates without locks, cheap enough for the serial read path.
+# An occasional lost update under contention is acceptable for monitoring.
+
+class Counter():
+
+	type = "counter"
+
+	def __init__(self, name, help):
+		self.name = name
+		self.help = help
+		self.value = 0
+
+	def inc(self, n=1):
+		self.value += n
+
+	def render(self):
+		return ["{0} {1}".format(self.name, self.value)]
+
+
+# Gauge is either set explicitly or read from fn when exported (e.g. queue.qsize).
+class Gauge():
+
+	type = "gauge"
+
+	def __init__(self, name, help, fn=None):
+		self.name = name
+		self.help = help
+		self.fn = fn
+		self.value = 0
+
+	def set(self, value):
+		self.value = value
+
+	def get(self):
+		return self.fn() if self.fn is not None else self.value
+
+	def render(self):
+		return ["{0} {1}".format(self.name, self.get())]
+
+
+class Histogram():
+
+	type = "histogram"
+
+	def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+		self.name = name
+		self.help = help
+		self.buckets = tuple(buckets)
+		self.counts = [0] * (len(self.buckets) + 1)  # last one is +Inf
+		self.sum = 0.0
+		self.count = 0
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.sum += value
+		self.count += 1
+
+	def render(self):
+		lines = []
+		cumulative = 0
+		for le, n in zip(self.buckets + ("+Inf",), self.counts):
+			cumulative += n
+			lines.append('{0}_bucket{{le="{1}"}} {2}'.format(self.name, le, cumulative))
+		lines.append("{0}_sum {1}".format(self.name, self.sum))
+		lines.append("{0}_count {1}".format(self.name, self.count))
+		return lines
+
+
+# Collection of metrics that can be exported in Prometheus text format, either over http
+# or as a snapshot file rewritten every few seconds.
+class Registry():
+
+	def __init__(self):
+		self.metrics = {}
+		self.server = None
+		self.snapshot_stop = None
+
+
+	def _add(self, metric):
+		assert metric.name not in self.metrics, "[Registry] duplicate metric " + metric.name
+		self.metrics[metric.name] = metric
+		return metric
+
+
+	def counter(self, name, help):
+		return self._add(Counter(name, help))
+
+
+	def gauge(self, name, help, fn=None):
+		return self._add(Gauge(name, help, fn))
+
+
+	def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+		return self._add(Histogram(name, help, buckets))
+
+
+	def render(self):
+		lines = []
+		for metric in list(self.metrics.values()):
+			lines.append("# HELP {0} {1}".format(metric.name, metric.help))
+			lines.append("# TYPE {0} {1}".format(metric.name, metric.type))
+			lines += metric.render()
+		return "\n".join(lines) + "\n"
+
+
+	# Serve render() on http://host:port/metrics from a daemon thread.
+	def serve(self, port=9100, host="127.0.0.1"):
+		import http.server  # not needed unless serving, slow to import
+
+		registry = self
+
+		class Handler(http.server.BaseHTTPRequestHandler):
+			def do_GET(self):
+				if self.path != "/metrics":
+					self.send_error(404)
+					return
+				body = registry.render().encode("utf-8")
+				self.send_response(200)
+				self.send_header("Content-Type", CONTENT_TYPE)
+				self.send_header("Content-Length", str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, *args):
+				pass
+
+		self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+		threading.Thread(target=self.server.serve_forever, name="metrics_http", daemon=True).start()
+		return self.server.server_address
+
+
+	def writeSnapshot(self, path):
+		tmp = path + ".tmp"
+		with open(tmp, "w") as f:
+			f.write(self.render())
+		os.replace(tmp, path)
+
+
+	# Rewrite snapshot file at path every interval seconds from a daemon thread.
+	def startSnapshots(self, path, interval=10.0):
+		self.snapshot_stop = threading.Event()
+
+		def run(stop):
+			while not stop.wait(interval):
+				try:
+					self.writeSnapshot(path)
+				except OSError:
+					pass
+
+		threading.Thread(target=run, args=[self.snapshot_stop], name="metrics_snapshot", daemon=True).start()
+
+
+	def stop(self):
+		if self.server is not None:
+			self.server.shutdown()
+			self.server.server_close()
+			self.server = None
+		if self.snapshot_stop is not None:
+			self.snapshot_stop.set()
+			self.snapshot_stop = None
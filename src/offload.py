@@ -0,0 +1,262 @@
+import math
+import os
+import threading
+
+
+# Worker processes, one core is left to the serial reader and the GUI
+WORKERS = max(1, (os.cpu_count() or 2) - 1)
+
+# Jobs submitted but not finished. More are refused instead of queued, so a stuck worker
+# can not pile up shared memory in the acquisition process.
+MAX_PENDING = 32
+
+# Added to worker niceness, workers give way to the acquisition process
+WORKER_NICE = 5
+
+ALIGN = 8
+
+
+# Columns of numbers copied once into a block of shared memory, workers map the block and
+# see them as numpy arrays without pickling the data. A column is a buffer (array.array,
+# memoryview, numpy array) or a list of buffers of the same type that are concatenated,
+# like the segments of ringbuffer.SampleRing.window.
+#
+# The block belongs to the process that created it and is removed with unlink().
+class SharedColumns():
+
+	def __init__(self, columns):
+		from multiprocessing import shared_memory
+
+		parts = {}
+		layout = []
+		size = 0
+		for name, column in columns.items():
+			views = [memoryview(buffer) for buffer in (column if isinstance(column, list) else [column])]
+			assert views, "[SharedColumns] column {0} has no buffers".format(name)
+			format = views[0].format
+			count = sum(len(view) for view in views)
+			layout.append((name, format, size, count))
+			parts[name] = views
+			size += (count * views[0].itemsize + ALIGN - 1) // ALIGN * ALIGN
+
+		self.layout = layout
+		self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+		for name, format, offset, count in layout:
+			for view in parts[name]:
+				data = view.cast("B")
+				self.shm.buf[offset:offset + len(data)] = data
+				offset += len(data)
+
+
+	# Picklable description passed to the worker, see attach.
+	def descriptor(self):
+		return (self.shm.name, self.layout)
+
+
+	def unlink(self):
+		self.shm.close()
+		self.shm.unlink()
+
+
+# In the worker: open the block of descriptor and return (shm, dict of numpy arrays).
+# The arrays are views into shm, drop them before shm.close().
+def attach(descriptor):
+	import numpy
+	from multiprocessing import shared_memory
+
+	name, layout = descriptor
+	shm = shared_memory.SharedMemory(name=name)
+	columns = {
+		column: numpy.frombuffer(shm.buf, dtype=format, count=count, offset=offset)
+		for column, format, offset, count in layout
+	}
+	return shm, columns
+
+
+def _initWorker():
+	try:
+		os.nice(WORKER_NICE)
+	except (AttributeError, OSError):
+		pass
+
+
+# Runs in the worker: job(columns, *args) with columns from shared memory, or job(*args)
+# if nothing was shared. Jobs return plain data, not views of the columns.
+def _run(job, descriptor, args):
+	if descriptor is None:
+		return job(*args)
+	shm, columns = attach(descriptor)
+	try:
+		return job(columns, *args)
+	finally:
+		columns.clear()
+		try:
+			shm.close()
+		except BufferError:  # job kept a view, the mapping goes away with the worker
+			pass
+
+
+# Pool of worker processes for work that would hold the GIL long enough for readCont to
+# miss samples: statistics, reports, compressing old data files. Data goes over in shared
+# memory (SharedColumns), only descriptors and results are pickled.
+#
+# Processes are started with spawn on the first submit, forking a process that runs the
+# serial reader and Qt threads is not safe. submit() never blocks, with max_pending jobs
+# in flight it refuses and returns None.
+#
+#	pool = OffloadPool()
+#	pool.submit(statsJob, {"session": ids, "weight": weights}, callback=print)
+class OffloadPool():
+
+	def __init__(self, workers=WORKERS, max_pending=MAX_PENDING, log=None):
+		self.workers = workers
+		self.max_pending = max_pending
+		self.log = log if log is not None else lambda message: None
+		self.executor = None
+		self.lock = threading.Lock()
+		self.pending = 0
+		self.done = 0
+		self.failed = 0
+		self.rejected = 0
+
+
+	def _executor(self):
+		if self.executor is None:
+			import multiprocessing
+			from concurrent.futures import ProcessPoolExecutor
+
+			self.executor = ProcessPoolExecutor(
+				self.workers,
+				mp_context=multiprocessing.get_context("spawn"),
+				initializer=_initWorker
+			)
+		return self.executor
+
+
+	# Run job(columns, *args) in a worker, columns (dict name -> buffer(s)) are copied to
+	# shared memory first. With columns=None job(*args) is run. callback(result) is called
+	# on a pool thread when the job succeeds, failures are logged. Returns the
+	# concurrent.futures.Future or None if refused.
+	def submit(self, job, columns=None, *args, callback=None):
+		with self.lock:
+			if self.pending >= self.max_pending:
+				self.rejected += 1
+				self.log("[OffloadPool] too many jobs, {0} refused".format(job.__name__))
+				return None
+			self.pending += 1
+
+		shared = None
+		try:
+			if columns is not None:
+				shared = SharedColumns(columns)
+			future = self._executor().submit(_run, job, shared.descriptor() if shared is not None else None, args)
+		except Exception as e:
+			if shared is not None:
+				shared.unlink()
+			with self.lock:
+				self.pending -= 1
+				self.failed += 1
+			self.log("[OffloadPool] {0} not started: {1}".format(job.__name__, e))
+			return None
+
+		def finished(future):
+			if shared is not None:
+				shared.unlink()
+			with self.lock:
+				self.pending -= 1
+			if future.cancelled():
+				return
+			error = future.exception()
+			if error is not None:
+				with self.lock:
+					self.failed += 1
+				self.log("[OffloadPool] {0} failed: {1!r}".format(job.__name__, error))
+				return
+			with self.lock:
+				self.done += 1
+			if callback is not None:
+				callback(future.result())
+
+		future.add_done_callback(finished)
+		return future
+
+
+	def stats(self):
+		with self.lock:
+			return {"pending": self.pending, "done": self.done, "failed": self.failed, "rejected": self.rejected}
+
+
+	# Waits for running jobs, queued ones are cancelled unless wait_all is set.
+	def shutdown(self, wait_all=False):
+		if self.executor is not None:
+			self.executor.shutdown(wait=True, cancel_futures=not wait_all)
+			self.executor = None
+
+
+# Jobs. Module level functions so workers can find them by name. Results go out as JSON
+# (daemon), so floats that are nan or inf are returned as None.
+
+def _finite(value):
+	value = float(value)
+	return value if math.isfinite(value) else None
+
+
+# Per session statistics of counted objects, see analytics.sessionStats. Columns: session,
+# weight. Returns dict of lists plus outliers (count) and reference (piece weight, std, n).
+def statsJob(columns, lsl=None, usl=None):
+	import analytics
+
+	session, weight = columns["session"], columns["weight"]
+	stats = {}
+	for key, value in analytics.sessionStats(session, weight, lsl, usl).items():
+		stats[key] = value.tolist() if key in ("session", "count") else [_finite(v) for v in value]
+	stats["outliers"] = int(analytics.outliers(weight).sum()) if len(weight) else 0
+	stats["reference"] = [_finite(value) for value in analytics.referenceWeight(weight)] if len(weight) else None
+	return stats
+
+
+# Summary of samples, e.g. a window of the ring buffer. Columns: timestamp, status, weight.
+def samplesJob(columns):
+	weight = columns["weight"]
+	if not len(weight):
+		return {"count": 0}
+	stable = columns["status"] == 0
+	return {
+		"count": len(weight),
+		"seconds": _finite(columns["timestamp"][-1] - columns["timestamp"][0]),
+		"mean": _finite(weight.mean()),
+		"std": _finite(weight.std()),
+		"min": _finite(weight.min()),
+		"max": _finite(weight.max()),
+		"stable": _finite(stable.mean()),
+		"stable_mean": _finite(weight[stable].mean()) if stable.any() else None
+	}
+
+
+# Statistics of all sessions in a counting file, written to report_path as csv. Returns report_path.
+def reportJob(counting_path, report_path, lsl=None, usl=None):
+	import analytics
+
+	data = analytics.loadCounting(counting_path)
+	stats = analytics.sessionStats(data["session"], data["weight"], lsl, usl)
+	keys = ("session", "count", "mean", "std", "min", "max", "cp", "cpk")
+	with open(report_path + ".tmp", "w") as f:
+		f.write(",".join(keys) + "\n")
+		for row in zip(*(stats[key] for key in keys)):
+			f.write("{0},{1},{2:.6f},{3:.6f},{4},{5},{6:.4f},{7:.4f}\n".format(*row))
+	os.replace(report_path + ".tmp", report_path)
+	return report_path
+
+
+# Compress a finished data file to path.gz and remove the original. Returns (path, size before, size after).
+def compressJob(path, level=9):
+	import gzip
+	import shutil
+
+	target = path + ".gz"
+	with open(path, "rb") as src, gzip.open(target + ".tmp", "wb", compresslevel=level) as dst:
+		shutil.copyfileobj(src, dst, 1 << 20)
+	os.replace(target + ".tmp", target)
+	size = os.path.getsize(path)
+	os.remove(path)
+	return (target, size, os.path.getsize(target))
@@ -0,0 +1,177 @@
+import threading
+from array import array
+
+from sample import Sample, Status
+
+
+# Default number of samples kept, a few minutes of SIR data at 20 Hz.
+SAMPLE_CAPACITY = 4096
+
+_STATUS = tuple(Status)  # status code -> Status without going through Status(code)
+
+# Column names in the order of segments() tuples
+COLUMNS = ("timestamp", "status", "weight", "unit")
+
+
+# Maps short strings (units) to small ints so they can live in an array("B").
+class _Table():
+
+	def __init__(self):
+		self.names = []
+		self.codes = {}
+
+	def code(self, name):
+		c = self.codes.get(name)
+		if c is None:
+			assert len(self.names) < 256, "[_Table] too many distinct values"
+			c = len(self.names)
+			self.names.append(name)
+			self.codes[name] = c
+		return c
+
+
+# Fixed-capacity store of samples kept as parallel typed arrays. The writer never blocks
+# and never grows memory, old samples are overwritten. Any number of readers keep their
+# own cursor, a reader that falls more than capacity behind loses the overwritten samples
+# and the loss is counted in reader.dropped.
+#
+# Samples are addressed by sequence number, seq % capacity is the slot in the arrays.
+# Returned memoryviews point into the ring, they stay valid until the writer laps them.
+class SampleRing():
+
+	def __init__(self, capacity=SAMPLE_CAPACITY):
+		self.capacity = capacity
+		self.timestamp = array("d", bytes(8 * capacity))
+		self.status = array("B", bytes(capacity))
+		self.weight = array("d", bytes(8 * capacity))
+		self.unit = array("B", bytes(capacity))
+		self.unit_table = _Table()
+
+		self.head = 0  # sequence number of next sample to be written
+		self.dropped = 0  # sum of dropped counts of all readers
+		self.cond = threading.Condition()
+
+
+	def append(self, sample):
+		with self.cond:
+			i = self.head % self.capacity
+			self.timestamp[i] = sample.timestamp
+			self.status[i] = sample.status
+			self.weight[i] = sample.weight
+			self.unit[i] = self.unit_table.code(sample.unit)
+			self.head += 1
+			self.cond.notify_all()
+
+
+	def __len__(self):
+		return min(self.head, self.capacity)
+
+
+	# Sample with sequence number seq.
+	def record(self, seq):
+		i = seq % self.capacity
+		return Sample(
+			self.timestamp[i],
+			_STATUS[self.status[i]],
+			self.weight[i],
+			self.unit_table.names[self.unit[i]]
+		)
+
+
+	def latest(self):
+		with self.cond:
+			if self.head == 0:
+				return None
+			return self.record(self.head - 1)
+
+
+	# Views of samples [start, end) as a list of at most two segments (the range may wrap),
+	# each segment is a tuple of (timestamp, status, weight, unit) memoryviews.
+	# Status view holds Status values, unit view holds codes to be decoded with unit_table.names.
+	def segments(self, start, end):
+		segments = []
+		while start < end:
+			i = start % self.capacity
+			n = min(end - start, self.capacity - i)
+			segments.append((
+				memoryview(self.timestamp)[i:i + n],
+				memoryview(self.status)[i:i + n],
+				memoryview(self.weight)[i:i + n],
+				memoryview(self.unit)[i:i + n]
+			))
+			start += n
+		return segments
+
+
+	# Last n samples, see segments.
+	def window(self, n):
+		with self.cond:
+			n = min(n, len(self))
+			return self.segments(self.head - n, self.head)
+
+
+	# Copy of the last n samples as dict column name -> array, oldest first. The copy is
+	# made with the lock held, views from window() may meanwhile be overwritten by append.
+	def snapshot(self, n):
+		with self.cond:
+			n = min(n, len(self))
+			columns = {name: array(getattr(self, name).typecode) for name in COLUMNS}
+			for segment in self.segments(self.head - n, self.head):
+				for name, view in zip(COLUMNS, segment):
+					columns[name].frombytes(view.cast("B"))
+			return columns
+
+
+	def reader(self):
+		return RingReader(self)
+
+
+class RingReader():
+
+	def __init__(self, ring):
+		self.ring = ring
+		self.cursor = ring.head  # only samples appended after reader creation are seen
+		self.dropped = 0  # samples overwritten before this reader got to them
+
+
+	# Skip samples that were already overwritten. Call with ring.cond held.
+	def _catchUp(self):
+		oldest = self.ring.head - self.ring.capacity
+		if self.cursor < oldest:
+			self.dropped += oldest - self.cursor
+			self.ring.dropped += oldest - self.cursor
+			self.cursor = oldest
+
+
+	def pending(self):
+		with self.ring.cond:
+			self._catchUp()
+			return self.ring.head - self.cursor
+
+
+	# Everything since the last read as segments, see SampleRing.segments.
+	def read(self):
+		with self.ring.cond:
+			self._catchUp()
+			segments = self.ring.segments(self.cursor, self.ring.head)
+			self.cursor = self.ring.head
+			return segments
+
+
+	# Next sample. Blocks until one is available, returns None if timeout expires first.
+	def get(self, timeout=None):
+		with self.ring.cond:
+			if not self.ring.cond.wait_for(lambda: self.cursor < self.ring.head, timeout):
+				return None
+			self._catchUp()
+			m = self.ring.record(self.cursor)
+			self.cursor += 1
+			return m
+
+
+	def latest(self):
+		with self.ring.cond:
+			self.cursor = self.ring.head
+			if self.ring.head == 0:
+				return None
+			return self.ring.record(self.ring.head - 1)
@@ -0,0 +1,187 @@
+import math
+import os
+import struct
+import threading
+import time
+from array import array
+
+from sample import Status, WALL_OFFSET
+
+
+# (seconds per bucket, buckets kept): an hour of seconds, a day of minutes, a month of hours
+RESOLUTIONS = ((1, 3600), (60, 1440), (3600, 24 * 30))
+
+HEADER = struct.Struct("<4sII")  # magic, resolution, capacity
+MAGIC = b"ROLL"
+
+# Columns of a level as (name, array typecode), in file order
+COLUMNS = (
+	("bucket", "q"),  # bucket number (wall time // resolution) held in the slot, -1 if empty
+	("count", "Q"),
+	("min", "d"),
+	("max", "d"),
+	("sum", "d"),
+	("stable", "Q")  # samples the scale reported as stable
+)
+
+
+# Fixed number of buckets of one resolution in a ring, bucket n lives in slot n % capacity
+# and is overwritten by bucket n + capacity. Memory never grows.
+class RollupLevel():
+
+	def __init__(self, resolution, capacity):
+		self.resolution = resolution
+		self.capacity = capacity
+		self.bucket = array("q", [-1]) * capacity
+		self.count = array("Q", bytes(8 * capacity))
+		self.min = array("d", [math.inf]) * capacity
+		self.max = array("d", [-math.inf]) * capacity
+		self.sum = array("d", bytes(8 * capacity))
+		self.stable = array("Q", bytes(8 * capacity))
+		self.newest = -1  # newest bucket held, -1 while empty
+
+
+	def add(self, t, weight, stable):
+		bucket = int(t // self.resolution)
+		i = bucket % self.capacity
+		if self.bucket[i] != bucket:
+			if self.bucket[i] > bucket:  # older than what is kept
+				return
+			self.bucket[i] = bucket
+			if bucket > self.newest:
+				self.newest = bucket
+			self.count[i] = 0
+			self.min[i] = math.inf
+			self.max[i] = -math.inf
+			self.sum[i] = 0.0
+			self.stable[i] = 0
+		self.count[i] += 1
+		self.sum[i] += weight
+		self.stable[i] += stable
+		if weight < self.min[i]:
+			self.min[i] = weight
+		if weight > self.max[i]:
+			self.max[i] = weight
+
+
+	# Oldest wall time still covered by this level, given the current time.
+	def retention(self, now):
+		return (int(now // self.resolution) - self.capacity + 1) * self.resolution
+
+
+	# Buckets with t1 <= start < t2 in time order, dict of arrays: time (bucket start),
+	# count, min, max, mean and stable (fraction of stable samples). Empty buckets are left out.
+	def query(self, t1, t2):
+		result = {name: array("d") for name in ("time", "count", "min", "max", "mean", "stable")}
+		if self.newest < 0:
+			return result
+		# only buckets the ring still holds, t1 and t2 come from clients and may be far off
+		first = max(math.ceil(t1 / self.resolution), self.newest - self.capacity + 1)
+		last = min(math.ceil(t2 / self.resolution), self.newest + 1)
+		for bucket in range(first, last):
+			i = bucket % self.capacity
+			if self.bucket[i] != bucket or not self.count[i]:
+				continue
+			n = self.count[i]
+			result["time"].append(bucket * self.resolution)
+			result["count"].append(n)
+			result["min"].append(self.min[i])
+			result["max"].append(self.max[i])
+			result["mean"].append(self.sum[i] / n)
+			result["stable"].append(self.stable[i] / n)
+		return result
+
+
+	def columns(self):
+		return [getattr(self, name) for name, code in COLUMNS]
+
+
+	# Returns False (and keeps the level empty) if the file is for another resolution or capacity.
+	def read(self, f):
+		header = f.read(HEADER.size)
+		if len(header) != HEADER.size or HEADER.unpack(header) != (MAGIC, self.resolution, self.capacity):
+			return False
+		columns = []
+		for name, code in COLUMNS:
+			column = array(code)
+			column.fromfile(f, self.capacity)
+			columns.append(column)
+		for (name, code), column in zip(COLUMNS, columns):
+			setattr(self, name, column)
+		self.newest = max(self.bucket)
+		return True
+
+
+# Rollups of the sample stream at several resolutions, updated with every sample. Used for
+# trend views and long-term storage instead of keeping every raw reading. Times are wall
+# clock seconds, so saved rollups stay valid across restarts.
+class Rollups():
+
+	def __init__(self, resolutions=RESOLUTIONS):
+		self.levels = [RollupLevel(resolution, capacity) for resolution, capacity in resolutions]
+		self.lock = threading.Lock()  # update runs on readCont, save and query on other threads
+
+
+	def update(self, sample):
+		t = sample.timestamp + WALL_OFFSET
+		stable = sample.status == Status.STABLE
+		with self.lock:
+			for level in self.levels:
+				level.add(t, sample.weight, stable)
+
+
+	# Finest level that still covers t1, or the given resolution. The oldest bucket of a level
+	# is being overwritten by the newest, a level covering all but that bucket will do.
+	def level(self, t1, resolution=None):
+		if resolution is not None:
+			for level in self.levels:
+				if level.resolution == resolution:
+					return level
+			raise KeyError("[Rollups] no level with resolution " + str(resolution))
+		now = time.time()
+		for level in self.levels:
+			if level.retention(now) - level.resolution <= t1:
+				return level
+		return self.levels[-1]
+
+
+	# See RollupLevel.query, resolution of the result is in result["resolution"].
+	def query(self, t1, t2=math.inf, resolution=None):
+		if t2 == math.inf:
+			t2 = time.time() + 1
+		with self.lock:
+			level = self.level(t1, resolution)
+			result = level.query(t1, t2)
+		result["resolution"] = level.resolution
+		return result
+
+
+	def _path(self, path, level):
+		return os.path.join(path, "{0}s.bin".format(level.resolution))
+
+
+	# One file per level in directory path, replaced atomically.
+	def save(self, path):
+		os.makedirs(path, exist_ok=True)
+		for level in self.levels:
+			with self.lock:
+				columns = [column.tobytes() for column in level.columns()]
+			tmp = self._path(path, level) + ".tmp"
+			with open(tmp, "wb") as f:
+				f.write(HEADER.pack(MAGIC, level.resolution, level.capacity))
+				for column in columns:
+					f.write(column)
+			os.replace(tmp, self._path(path, level))
+
+
+	# Levels saved in path, levels without a (matching) file stay empty. Returns levels loaded.
+	def load(self, path):
+		loaded = 0
+		for level in self.levels:
+			try:
+				with open(self._path(path, level), "rb") as f:
+					with self.lock:
+						loaded += level.read(f)
+			except (OSError, EOFError):
+				pass
+		return loaded
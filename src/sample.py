@@ -0,0 +1,75 @@
+import enum
+import time
+
+
+class Status(enum.IntEnum):
+	STABLE = 0  # "S"
+	UNSTABLE = 1  # "SD"
+	OTHER = 2  # anything else the scale reports (overload, underload, errors)
+
+
+STATUS_CODES = {
+	"S": Status.STABLE,
+	"SD": Status.UNSTABLE
+}
+
+STATUS_NAMES = {
+	Status.STABLE: "S",
+	Status.UNSTABLE: "SD",
+	Status.OTHER: "?"
+}
+
+# Difference between wall clock and time.monotonic(), only used when formatting timestamps
+WALL_OFFSET = time.time() - time.monotonic()
+
+TIME_FORMAT = "%m/%d/%Y, %H:%M:%S"
+
+
+# One weight reading. Parsed once when read from serial, formatting to strings is left
+# to whoever writes it to a file or shows it.
+class Sample():
+
+	__slots__ = ("timestamp", "status", "weight", "unit")
+
+	def __init__(self, timestamp, status, weight, unit):
+		self.timestamp = timestamp  # time.monotonic() when the line was read
+		self.status = status  # Status
+		self.weight = weight  # float
+		self.unit = unit  # str
+
+
+	# Parse SIR response line (b"S      12.34 g\r\n"). Returns None for lines that are not weights.
+	@classmethod
+	def parse(cls, line, timestamp=None):
+		if timestamp is None:
+			timestamp = time.monotonic()
+		parts = line.split()
+		if len(parts) < 3:
+			return None
+		try:
+			weight = float(parts[-2])
+		except ValueError:
+			return None
+		status = STATUS_CODES.get(parts[0].decode("ascii", "replace"), Status.OTHER)
+		return cls(timestamp, status, weight, parts[-1].decode("ascii", "replace"))
+
+
+	def wallTime(self):
+		return self.timestamp + WALL_OFFSET
+
+
+	def timeText(self):
+		return time.strftime(TIME_FORMAT, time.localtime(self.wallTime()))
+
+
+	def statusText(self):
+		return STATUS_NAMES[self.status]
+
+
+	# Sample as list of strings, as written to csv files.
+	def format(self):
+		return [self.timeText(), self.statusText(), str(self.weight), self.unit]
+
+
+	def __repr__(self):
+		return "Sample({0}, {1}, {2}, {3})".format(self.timestamp, self.status.name, self.weight, self.unit)
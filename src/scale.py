@@ -5,63 +5,251 @@ from scale_qt4 import MainWindow
 import sys
 import signal
 import serial
-import serial.tools.list_ports
+import threading
+import queue
 import time
-from threading import Thread
+
+from sample import WALL_OFFSET
+from trend import DecimationBuffer, SPANS, fill
 
 def close(*args):
 	QtGui.QApplication.quit()
 
-signal.signal(signal.SIGINT, close)
+FRAME_INTERVAL = 40  # ms between display refreshes
+TREND_INTERVAL = 0.1  # s between trend redraws, at most 10 frames per second
+TREND_GEOMETRY = (380, 330, 440, 170)  # x, y, width, height in the main window
+TREND_MARGIN = 0.05  # part of the weight range left free above and below the trace
+
+
+# Live weight trace. Every pixel column shows min and max weight of its time slice from a
+# trend.DecimationBuffer, so a sample burst or hours of history cost the same to draw.
+# The trace is kept in a pixmap: when time moves on, the pixmap is scrolled and only new
+# columns are drawn. Wheel zooms through trend.SPANS, dragging scrolls back in time (from
+# rollups once raw samples are gone), double click returns to live view.
+class TrendWidget(QtGui.QWidget):
+	def __init__(self, libra, parent=None):
+		QtGui.QWidget.__init__(self, parent)
+		self.libra = libra
+		self.reader = libra.samples.reader()
+		self.span = 0  # index into SPANS
+		self.end = None  # wall time of right edge, None follows the current time
+		self.drag_x = None
+		self.low, self.high = 0.0, 1.0  # weight range of the y axis
+		self.drawn = None  # newest column in the pixmap
+		self.last_draw = 0.0
+		self.buffer = None
+		self.pixmap = None
+		self.setCursor(QtCore.Qt.OpenHandCursor)
+
+	def step(self):
+		return SPANS[self.span] / float(max(self.width(), 1))
+
+	def rightEdge(self):
+		return self.end if self.end is not None else time.time()
+
+	# Rebuild the buffer for the current span, position and size and draw everything.
+	def refill(self):
+		columns = max(self.width(), 1)
+		self.buffer = DecimationBuffer(columns, self.step())
+		end = self.rightEdge()
+		fill(self.buffer, self.libra.rollups, self.libra.samples, end - SPANS[self.span], end, WALL_OFFSET)
+		self.buffer.takeDirty()
+		self.reader = self.libra.samples.reader()
+		self.rescale(True)
+		self.redraw()
+
+	# Fit y axis to visible data, returns True if it changed. Only grows unless shrink is set.
+	def rescale(self, shrink=False):
+		last = int(self.rightEdge() // self.buffer.step)
+		visible = self.buffer.range(last - self.buffer.columns + 1, last)
+		if visible is None:
+			return False
+		low, high = visible
+		if not shrink and self.low <= low and high <= self.high:
+			return False
+		margin = max(high - low, 1.0) * TREND_MARGIN
+		self.low, self.high = low - margin, high + margin
+		return True
+
+	def y(self, weight):
+		return int((self.high - weight) / (self.high - self.low) * (self.height() - 1))
+
+	def drawColumns(self, painter, first, last, newest):
+		painter.setPen(QtGui.QColor(30, 90, 200))
+		width = self.width()
+		for bucket in range(max(first, newest - width + 1), last + 1):
+			x = width - 1 - (newest - bucket)
+			painter.fillRect(x, 0, 1, self.height(), self.palette().base())
+			column = self.buffer.column(bucket)
+			if column is not None:
+				painter.drawLine(x, self.y(column[1]), x, self.y(column[0]))
+
+	def redraw(self):
+		self.pixmap = QtGui.QPixmap(self.size())
+		self.pixmap.fill(self.palette().base().color())
+		self.drawn = int(self.rightEdge() // self.buffer.step)
+		painter = QtGui.QPainter(self.pixmap)
+		self.drawColumns(painter, self.drawn - self.width() + 1, self.drawn, self.drawn)
+		painter.end()
+		self.update()
+
+	# Called on every display frame, new samples go to the buffer, drawing is limited to TREND_INTERVAL.
+	def refresh(self):
+		if self.buffer is None:
+			return
+		segments = self.reader.read()
+		if self.end is not None:
+			return  # looking at history, new samples are picked up by refill on return to live
+		for timestamp, status, weight, unit in segments:
+			for i in range(len(timestamp)):
+				self.buffer.add(timestamp[i] + WALL_OFFSET, weight[i])
+
+		now = time.monotonic()
+		if now - self.last_draw < TREND_INTERVAL:
+			return
+		self.last_draw = now
+		if self.rescale():
+			self.buffer.takeDirty()
+			self.redraw()
+			return
+
+		newest = int(time.time() // self.buffer.step)
+		shift = newest - self.drawn
+		dirty = self.buffer.takeDirty()
+		if not shift and dirty is None:
+			return
+		if shift:
+			self.pixmap.scroll(-shift, 0, self.pixmap.rect())
+		painter = QtGui.QPainter(self.pixmap)
+		if shift:
+			self.drawColumns(painter, newest - shift + 1, newest, newest)
+		if dirty is not None:
+			self.drawColumns(painter, dirty[0], min(dirty[1], newest), newest)
+		painter.end()
+		self.drawn = newest
+		self.update()
+
+	def paintEvent(self, event):
+		if self.pixmap is not None:
+			painter = QtGui.QPainter(self)
+			painter.drawPixmap(0, 0, self.pixmap)
+			painter.setPen(self.palette().text().color())
+			painter.drawText(4, 12, "{0:g}".format(round(self.high, 3)))
+			painter.drawText(4, self.height() - 4, "{0:g}   {1}".format(
+				round(self.low, 3), time.strftime("%H:%M:%S", time.localtime(self.rightEdge() - SPANS[self.span]))))
+
+	def resizeEvent(self, event):
+		self.refill()
+
+	def wheelEvent(self, event):
+		span = self.span + (1 if event.delta() < 0 else -1)
+		if 0 <= span < len(SPANS):
+			self.span = span
+			self.refill()
+
+	def mousePressEvent(self, event):
+		self.drag_x = event.x()
+		self.setCursor(QtCore.Qt.ClosedHandCursor)
+
+	def mouseMoveEvent(self, event):
+		if self.drag_x is None:
+			return
+		dx = event.x() - self.drag_x
+		if abs(dx) < 4:
+			return
+		self.drag_x = event.x()
+		end = self.rightEdge() - dx * self.step()
+		self.end = end if end < time.time() else None
+		self.refill()
+
+	def mouseReleaseEvent(self, event):
+		self.drag_x = None
+		self.setCursor(QtCore.Qt.OpenHandCursor)
+
+	def mouseDoubleClickEvent(self, event):
+		self.end = None
+		self.refill()
 
 class Window(MainWindow):
 	def __init__(self, libra):
 		self.libra = libra
 		MainWindow.__init__(self)
-		t = Thread(name="updateDisplay", target=self.updateDisplay)
-		t.daemon = True
-		t.start()
+		self.shown = {}  # widget name -> value currently displayed
+		self.shown_head = 0  # samples.head of the sample currently displayed
 		self.ports = []
-		self.findSerial()
-		try:
-			self.libra.setTare(True)
-		except:
-			print("not zero")
+
+		self.trend = TrendWidget(libra, self.centralwidget)
+		self.trend.setGeometry(QtCore.QRect(*TREND_GEOMETRY))
+
+		# Slow start-up work is left for after the window is shown: port scan runs on the first
+		# event loop iteration and zeroing waits for the scale in background.
+		QtCore.QTimer.singleShot(0, self.findSerial)
+		threading.Thread(target=self.zeroOnStart, name="zero_on_start", daemon=True).start()
 
 		self.updateEnvData()
-		# self.timer_display = QtCore.QTimer()
-		# QtCore.QObject.connect(self.timer_display, QtCore.SIGNAL('timeout()'), self.updateDisplay)
 
-		# self.timer_display.start(1)  # 2 seconds
+		# Display is refreshed once per frame on the GUI thread. Samples that arrived since the
+		# last frame are coalesced to the latest one and only changed widgets are redrawn.
+		self.timer_display = QtCore.QTimer()
+		QtCore.QObject.connect(self.timer_display, QtCore.SIGNAL('timeout()'), self.updateDisplay)
+		self.timer_display.start(FRAME_INTERVAL)
 
+	# Ask for fresh env data, labels are updated by updateDisplay once it arrives.
 	def updateEnvData(self):
-		env_data = self.libra.getEnvData()
-		self.temp.setText(env_data["temperature"])
-		self.humidity.setText(env_data["humidity"])
-		self.tlak.setText(env_data["pressure"])
+		self.showEnvData(self.libra.getEnvData(refresh=True))
+
+	def showEnvData(self, env_data):
+		self.showText("temp", env_data["temperature"])
+		self.showText("humidity", env_data["humidity"])
+		self.showText("tlak", env_data["pressure"])
+
+	# Set text of widget called name unless it already shows value.
+	def showText(self, name, value):
+		if self.shown.get(name) != value:
+			self.shown[name] = value
+			getattr(self, name).setText(value)
 
 	def updateDisplay(self):
-		while 1:
-			if not self.libra.queue_backup.empty():
-				data = self.libra.queue_backup.get()
-				if len(data) > 2:
-					self.mass.display(data[2])
-					self.status.setText(data[1])
-
-			self.status_2.setText(str(self.libra.stabilization_time))
-			self.count.setText(str(round(self.libra.count_results_once)))
-			self.count_2.setText(str(self.libra.count_results_row))
-			self.weight.setText(str(self.libra.target))
-			self.tara.setText(str(self.libra.current_tare))
-			if not self.libra.queue_stdout.empty():
-				self.textBrowser.append(self.libra.queue_stdout.get())
-			time.sleep(0.05)
+		self.trend.refresh()
+		head = self.libra.samples.head
+		if head != self.shown_head:
+			self.shown_head = head
+			data = self.libra.samples.latest()
+			if self.shown.get("mass") != data.weight:
+				self.shown["mass"] = data.weight
+				self.mass.display(data.weight)
+			self.showText("status", data.statusText())
+
+		count_once = self.libra.count_results_once
+		self.showText("status_2", str(self.libra.stabilization_time))
+		self.showText("count", str(round(count_once)) if count_once is not None else "")
+		self.showText("count_2", str(self.libra.count_results_row))
+		self.showText("weight", str(self.libra.target))
+		self.showText("tara", str(self.libra.current_tare))
+		self.showEnvData(self.libra.getEnvData())
+
+		lines = []
+		while True:
+			try:
+				lines.append(str(self.libra.queue_stdout.get_nowait()))
+			except queue.Empty:
+				break
+		if lines:
+			self.textBrowser.append("\n".join(lines))
 
 
 	def setStatus(self,status):
-		self.status.setText(status)
+		self.showText("status", status)
+
+	def zeroOnStart(self):
+		try:
+			self.libra.setTare(True)
+		except:
+			print("not zero")
 
 	def findSerial(self):
+		import serial.tools.list_ports  # only needed here, slow to import
+
 		# self.serial_port.addItems(list(serial.tools.list_ports.comports()))
 		for p in serial.tools.list_ports.comports():
 			if p.device not in self.ports:
@@ -77,8 +265,9 @@ class Window(MainWindow):
 
 		# cmd = "{0}\r\n".format(str(self.command.text())).encode('ascii')
 		# self.libra.ser.write(cmd)
-		data = self.libra.queue_backup.get()
-		self.return_data.setText(data[0])
+		data = self.libra.samples.latest()
+		if data is not None:
+			self.return_data.setText(" ".join(data.format()))
 
 	def setToZero(self):
 		# self.tara.setText(self.libra.setZero())
@@ -86,7 +275,7 @@ class Window(MainWindow):
 
 	def setTo(self):
 		self.libra.setTare(float(str(self.tara.text())))
-		self.tara.setText(str(self.libra.current_tare))
+		self.showText("tara", str(self.libra.current_tare))
 
 
 	def doCalibration(self):
@@ -100,14 +289,16 @@ class Window(MainWindow):
 		w.resize(320, 240)
 		w.setWindowTitle("Hello World!")
 
-		self.libra.all_file = QtGui.QFileDialog.getSaveFileName(w, 'Save File', 'podatki.csv')
+		path = str(QtGui.QFileDialog.getSaveFileName(w, 'Save File', 'podatki.csv'))
+		if path:  # writefile thread picks up the new path and rotates to it
+			self.libra.all_file = path
 
 	def calculatePieces(self):
 		try:
 			weight = float(self.weight.text())
 		except:
 			weight = None
-			self.weight.setText("")
+			self.showText("weight", "")
 
 		self.libra.countApi(libra.COUNT_ONCE,target=weight)
 		# self.count.setText(str(self.libra.countApi(libra.COUNT_ONCE)))
@@ -117,6 +308,7 @@ class Window(MainWindow):
 		# self.count_2.setText(str(self.libra.countApi(libra.COUNT_ROW)))
 
 def runGui():
+	signal.signal(signal.SIGINT, close)
 	app = QtGui.QApplication(sys.argv)
 	window = Window(Libra(
         port="/dev/ttyUSB0",
@@ -133,4 +325,5 @@ def runGui():
 	sys.exit(app.exec_())
 
 
-runGui()
+if __name__ == "__main__":
+	runGui()
@@ -0,0 +1,316 @@
+import mmap
+import os
+import struct
+import threading
+import time
+
+from journal import Journal, JOURNAL_SUFFIX, COMMIT_INTERVAL, COMPACT_SIZE, BEGIN, OBJECT, END, TIME, ENDED
+
+
+COUNTING_FILE = "counting.csv"
+INDEX_SUFFIX = ".idx"
+
+# Index record: id, offset and length of session rows in counting file, start and end
+# (wall clock seconds) and number of pieces.
+INDEX_RECORD = struct.Struct("<qqqddI")
+
+
+class SessionInfo():
+
+	__slots__ = ("id", "offset", "length", "start", "end", "pieces")
+
+	def __init__(self, id, offset, length, start, end, pieces):
+		self.id = id
+		self.offset = offset
+		self.length = length
+		self.start = start
+		self.end = end
+		self.pieces = pieces
+
+	def __repr__(self):
+		return "SessionInfo(id={0}, pieces={1}, start={2}, end={3})".format(self.id, self.pieces, self.start, self.end)
+
+
+# Counting session that is still open, objects are kept until the session ends so rows
+# of a session are contiguous in the counting file even when sessions overlap. Id is
+# assigned when the session ends, which keeps the index sorted and dense.
+class Session():
+
+	def __init__(self, start, key=None):
+		self.id = None
+		self.key = key  # key of the session's records in the journal
+		self.start = start
+		self.end = None
+		self.objects = []
+
+
+# Counting sessions in counting.csv ("id,time,status,weight,unit" per counted object) with
+# a sidecar index of fixed-size records. Ids are sequential so lookup by id is a single
+# seek into the index, and the next id is known without reading the counting file.
+#
+# An index that is missing or behind the counting file (older versions wrote only the csv)
+# is rebuilt from the unindexed tail of the counting file when the store is opened.
+#
+# Sessions that are still open live in memory, so every step is also written to a journal
+# (path.wal, see journal.Journal) as it happens: session begin, every object, session end.
+# Sessions interrupted by a crash are found in the journal when the store is opened and
+# written to the counting file, they are in self.recovered. Once no session is open the
+# journal is emptied. A session that is never ended (its counting was forgotten) would keep
+# the journal from being emptied, so past compact_size bytes records of ended sessions are
+# dropped from it.
+class SessionStore():
+
+	def __init__(self, path=COUNTING_FILE, index_path=None, journal_path=None, commit_interval=COMMIT_INTERVAL,
+			compact_size=COMPACT_SIZE):
+		self.path = path
+		self.index_path = index_path if index_path is not None else path + INDEX_SUFFIX
+		self.lock = threading.Lock()
+		self.next_id = 0
+		self.count = 0  # number of indexed sessions
+		self.open = set()  # journal keys of open sessions
+		self.next_key = 0
+		self.recovered = []  # SessionInfo of sessions recovered from the journal
+		self.compact_size = compact_size  # journal bytes that trigger the next compaction
+		self.compact_min = compact_size
+
+		self.f = open(self.path, "ab")
+		self.index = open(self.index_path, "a+b")
+		self.reader = None  # counting file opened for reading, and its map, see readSession
+		self.map = None
+		self._load()
+		self.journal = Journal(journal_path if journal_path is not None else path + JOURNAL_SUFFIX, commit_interval)
+		self._recover()
+
+
+	def _load(self):
+		size = os.path.getsize(self.index_path)
+		size -= size % INDEX_RECORD.size  # drop partially written last record
+		self.index.truncate(size)
+		self.count = size // INDEX_RECORD.size
+
+		indexed = 0
+		if self.count:
+			last = self._record(self.count - 1)
+			indexed = last.offset + last.length
+			self.next_id = last.id + 1
+		if indexed < os.path.getsize(self.path):
+			self._reindex(indexed)
+
+
+	# Index sessions written after offset. Consecutive rows with the same id are one session.
+	def _reindex(self, offset):
+		current = None
+		with open(self.path, "rb") as f:
+			f.seek(offset)
+			for line in f:
+				parts = line.split(b",", 3)
+				try:
+					id = int(parts[0])
+				except ValueError:
+					offset += len(line)
+					continue
+				if current is None or current.id != id:
+					if current is not None:
+						self._appendIndex(current)
+					current = SessionInfo(max(id, self.next_id), offset, 0, 0.0, 0.0, 0)
+					self.next_id = current.id + 1
+				current.length += len(line)
+				current.pieces += 1
+				offset += len(line)
+		if current is not None:
+			self._appendIndex(current)
+
+
+	def _appendIndex(self, info):
+		self.index.seek(0, os.SEEK_END)
+		self.index.write(INDEX_RECORD.pack(info.id, info.offset, info.length, info.start, info.end, info.pieces))
+		self.index.flush()
+		self.count += 1
+
+
+	def __len__(self):
+		return self.count
+
+
+	# Sessions that were open when the journal was last written, e.g. before a crash, are
+	# written to the counting file. A session that made it to the counting file but not to
+	# the journal's END (crash in between) is recognised by its start and not written twice.
+	def _recover(self):
+		sessions = {}
+		for type, key, payload in self.journal.records():
+			if type == BEGIN:
+				sessions[key] = Session(TIME.unpack_from(payload)[0], key)
+			elif type == OBJECT and key in sessions:
+				t, = TIME.unpack_from(payload)
+				sessions[key].objects.append(payload[TIME.size:].decode("utf-8"))
+				sessions[key].end = t
+			elif type == END:
+				sessions.pop(key, None)
+
+		for session in sorted(sessions.values(), key=lambda session: session.start):
+			info = self._written(session)
+			if info is None:
+				info = self._write(session, session.objects, session.end if session.end is not None else session.start)
+			self.recovered.append(info)
+		self._flush()
+		self.journal.truncate()
+
+
+	# SessionInfo of session if it is already in the counting file.
+	def _written(self, session):
+		for position in range(self.count - 1, -1, -1):
+			info = self._record(position)
+			if info.end < session.start:
+				break
+			if info.start == session.start and info.pieces == len(session.objects):
+				return info
+		return None
+
+
+	def _flush(self):
+		self.f.flush()
+		os.fsync(self.f.fileno())
+		os.fsync(self.index.fileno())
+
+
+	def beginSession(self, start=None):
+		with self.lock:
+			session = Session(start if start is not None else time.time(), self.next_key)
+			self.next_key += 1
+			self.open.add(session.key)
+		self.journal.append(BEGIN, session.key, TIME.pack(session.start))
+		return session
+
+
+	# Object is in the journal when this returns, on disk within journal.COMMIT_INTERVAL. Raises
+	# OSError if the journal can not be written (disk full), the object is kept in memory.
+	def addObject(self, session, sample):
+		session.objects.append(sample)
+		self.journal.append(OBJECT, session.key, TIME.pack(sample.wallTime()) + ",".join(sample.format()).encode("utf-8"))
+
+
+	# Append session rows and its index record, returns SessionInfo.
+	def endSession(self, session, end=None):
+		session.end = end if end is not None else time.time()
+		with self.lock:
+			info = self._write(session, [",".join(obj.format()) for obj in session.objects], session.end)
+			self.open.discard(session.key)
+			idle = not self.open
+		try:
+			position = self.journal.append(END, session.key, ENDED.pack(info.id, info.end))
+		except OSError:
+			return info  # rows are in the counting file, recovery finds them there (_written)
+		if idle or position >= self.compact_size:
+			# rows are on disk before the journal that could restore them is emptied
+			with self.lock:
+				self._flush()
+				if not self.open:
+					self.journal.truncate()
+				elif self.journal.written >= self.compact_size:
+					size = self.journal.compact(set(self.open))
+					# open sessions alone may be big, wait until the journal doubles
+					self.compact_size = max(self.compact_min, 2 * size)
+		return info
+
+
+	# Rows (csv text without id) of session to the counting file and index. Call with lock held.
+	def _write(self, session, rows, end):
+		session.id = self.next_id
+		self.next_id += 1
+		prefix = str(session.id) + ","
+		data = "".join(prefix + row + "\n" for row in rows).encode("utf-8")
+		self.f.seek(0, os.SEEK_END)
+		offset = self.f.tell()
+		self.f.write(data)
+		self.f.flush()
+		info = SessionInfo(session.id, offset, len(data), session.start, end, len(rows))
+		self._appendIndex(info)
+		return info
+
+
+	def lookup(self, id):
+		if id < 0:
+			return None
+		# ids are dense apart from reindexed legacy sessions, try direct position first
+		position = id - self._firstId()
+		if 0 <= position < self.count:
+			info = self._record(position)
+			if info.id == id:
+				return info
+		lo, hi = 0, self.count
+		while lo < hi:
+			mid = (lo + hi) // 2
+			info = self._record(mid)
+			if info.id == id:
+				return info
+			if info.id < id:
+				lo = mid + 1
+			else:
+				hi = mid
+		return None
+
+
+	def _firstId(self):
+		return self._record(0).id if self.count else 0
+
+
+	def _record(self, position):
+		with self.lock:
+			self.index.seek(position * INDEX_RECORD.size)
+			return SessionInfo(*INDEX_RECORD.unpack(self.index.read(INDEX_RECORD.size)))
+
+
+	def sessions(self):
+		for position in range(self.count):
+			yield self._record(position)
+
+
+	# Rows of session id as lists of strings, None if there is no such session. The counting
+	# file is memory-mapped, and mapped again only when a session past its end is asked for.
+	def readSession(self, id):
+		info = self.lookup(id)
+		if info is None:
+			return None
+		end = info.offset + info.length
+		with self.lock:
+			if self.map is None or end > len(self.map):
+				if self.reader is None:
+					self.reader = open(self.path, "rb")
+				if self.map is not None:
+					self.map.close()
+				self.map = mmap.mmap(self.reader.fileno(), 0, access=mmap.ACCESS_READ)
+			data = self.map[info.offset:end].decode("utf-8")
+		return [line.split(",") for line in data.splitlines()]
+
+
+	def close(self):
+		if self.map is not None:
+			self.map.close()
+		if self.reader is not None:
+			self.reader.close()
+		self.journal.close()
+		self.f.close()
+		self.index.close()
+
+
+# Same interface as SessionStore for countings whose objects need not be saved (e.g. those
+# of async_libra.AsyncLibra), sessions only live in memory.
+class MemorySessions():
+
+	def __init__(self):
+		self.next_id = 0
+
+
+	def beginSession(self, start=None):
+		return Session(start if start is not None else time.time())
+
+
+	def addObject(self, session, sample):
+		session.objects.append(sample)
+
+
+	def endSession(self, session, end=None):
+		session.end = end if end is not None else time.time()
+		session.id = self.next_id
+		self.next_id += 1
+		return SessionInfo(session.id, 0, 0, session.start, session.end, len(session.objects))
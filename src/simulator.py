@@ -0,0 +1,174 @@
+import os
+import pty
+import random
+import select
+import threading
+import time
+import tty
+from array import array
+
+from sample import Sample, STATUS_NAMES, Status
+
+
+# Responses of the simulated scale to calibration commands
+RESPONSE_C0 = b'C0 A 0 1 ""\r\n'
+RESPONSE_C0_SET = b"C0 A\r\n"
+RESPONSE_C2_BUSY = b'C2 B "100.00 g"\r\n'
+RESPONSE_C2_DONE = b"C2 A\r\n"
+
+
+def formatLine(status, weight, unit="g"):
+	return "{0:<2} {1:>10.2f} {2}\r\n".format(STATUS_NAMES[status], weight, unit).encode("ascii")
+
+
+# Trace of pieces put on the scale one after another, as list of (status, weight).
+# Every piece takes `settle` unstable samples to reach its weight and is then held for `hold`
+# stable samples. Gaussian noise with deviation `noise` is added to every weight.
+def syntheticRow(pieces, piece_weight=10.0, noise=0.002, settle=6, hold=10, zero=10, seed=None):
+	rnd = random.Random(seed)
+	trace = [(Status.STABLE, rnd.gauss(0.0, noise)) for i in range(zero)]
+	weight = 0.0
+	for n in range(pieces):
+		target = weight + piece_weight
+		for i in range(settle):
+			overshoot = (target - weight) * (1.0 - (i + 1) / settle) * rnd.uniform(-1.0, 1.0)
+			trace.append((Status.UNSTABLE, target + overshoot + rnd.gauss(0.0, noise * 10)))
+		weight = target
+		trace += [(Status.STABLE, weight + rnd.gauss(0.0, noise)) for i in range(hold)]
+	return trace
+
+
+# Trace read from a file with raw SIR lines (as printed by test.py) or data.csv/counting.csv rows.
+def loadTrace(path):
+	trace = []
+	with open(path, "rb") as f:
+		for line in f:
+			if b"," in line:
+				parts = line.split(b",")
+				if len(parts) > 4 and parts[0].strip().isdigit() and b"/" not in parts[0]:
+					parts = parts[1:]  # counting.csv starts with session id
+				sample = Sample.parse(b" ".join(parts[2:5]))
+			else:
+				sample = Sample.parse(line)
+			if sample is not None:
+				trace.append((sample.status, sample.weight))
+	return trace
+
+
+# Scale simulated on a pseudo terminal. Libra opens FakeScale.port like a real serial port.
+# After SIR the trace is sent at `rate` lines per second (not limited by any baud rate),
+# looping over it if loop is set. T, C0 and C2 are answered like the real scale would,
+# S and C2 end the stream until the next SIR.
+#
+# Send time of every line is kept in sent (monotonic), for measuring latency.
+class FakeScale():
+
+	def __init__(self, trace, rate=20.0, loop=True, unit="g"):
+		self.trace = list(trace)
+		self.rate = rate
+		self.loop = loop
+		self.unit = unit
+		self.tare = 0.0
+		self.streaming = False
+		self.position = 0  # index in trace of next line
+		self.sent = array("d")
+
+		self.master, self.slave = pty.openpty()
+		tty.setraw(self.slave)
+		self.port = os.ttyname(self.slave)
+
+		self.stopped = False
+		self.thread = None
+		self.commands = bytearray()
+
+
+	def start(self):
+		self.thread = threading.Thread(target=self.run, name="fake_scale", daemon=True)
+		self.thread.start()
+		return self
+
+
+	def stop(self):
+		self.stopped = True
+		if self.thread is not None:
+			# once the reader is gone a full pty blocks the writer, drain it until run returns
+			while self.thread.is_alive():
+				if select.select([self.slave], [], [], 0.05)[0]:
+					os.read(self.slave, 1 << 16)
+			self.thread.join()
+			self.thread = None
+		os.close(self.master)
+		os.close(self.slave)
+
+
+	def current(self):
+		status, weight = self.trace[min(self.position, len(self.trace) - 1)]
+		return status, weight
+
+
+	def run(self):
+		interval = 1.0 / self.rate
+		next_time = time.monotonic()
+		while not self.stopped:
+			now = time.monotonic()
+			timeout = max(next_time - now, 0.0) if self.streaming else 0.1
+			readable, _, _ = select.select([self.master], [], [], timeout)
+			if readable:
+				self.commands += os.read(self.master, 1024)
+				self.handleCommands()
+
+			if not self.streaming:
+				next_time = time.monotonic()
+				continue
+			lines = []
+			now = time.monotonic()
+			while next_time <= now and self.streaming:
+				status, weight = self.current()
+				lines.append(formatLine(status, weight - self.tare, self.unit))
+				self.sent.append(now)
+				next_time += interval
+				self.position += 1
+				if self.position >= len(self.trace):
+					if self.loop:
+						self.position = 0
+					else:
+						self.streaming = False
+			if lines:
+				os.write(self.master, b"".join(lines))
+
+
+	def handleCommands(self):
+		while True:
+			i = self.commands.find(b"\r\n")
+			if i < 0:
+				return
+			cmd = bytes(self.commands[:i]).strip()
+			del self.commands[:i + 2]
+			self.handle(cmd)
+
+
+	def handle(self, cmd):
+		if cmd == b"SIR":
+			self.streaming = True
+		elif cmd == b"@":
+			self.streaming = False
+		elif cmd == b"T":
+			status, weight = self.current()
+			self.tare = weight
+			os.write(self.master, "T S {0:>10.2f} {1}\r\n".format(weight, self.unit).encode("ascii"))
+		elif cmd == b"Z":
+			self.tare = self.current()[1]
+			os.write(self.master, b"Z A\r\n")
+		elif cmd == b"S":
+			self.streaming = False
+			status, weight = self.current()
+			os.write(self.master, formatLine(Status.STABLE, weight - self.tare, self.unit))
+		elif cmd == b"C0":
+			os.write(self.master, RESPONSE_C0)
+		elif cmd.startswith(b"C0 "):
+			os.write(self.master, RESPONSE_C0_SET)
+		elif cmd == b"C2":
+			self.streaming = False
+			os.write(self.master, RESPONSE_C2_BUSY + RESPONSE_C2_DONE)
+		else:
+			os.write(self.master, b"ES\r\n")
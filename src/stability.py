@@ -0,0 +1,132 @@
+import collections
+import math
+import threading
+
+from sample import Sample, Status
+
+
+# Events passed to subscribers as (event, sample)
+SETTLED = "settled"
+UNSETTLED = "unsettled"
+
+# Tuning per product, see StabilityDetector for the meaning of the values. Add entries for
+# products that need faster or stricter detection and select them with Libra.setProduct.
+PROFILES = {
+	"default": {"window": 5, "threshold": 0.02, "band": 0.05, "trust_scale": True},
+	"fast": {"window": 3, "threshold": 0.03, "band": 0.08, "trust_scale": True},
+	"precise": {"window": 10, "threshold": 0.005, "band": 0.02, "trust_scale": False}
+}
+
+
+# Decides whether weight has settled from the weights themselves instead of waiting for the
+# scale's own (slow) stability filter. Keeps running sums over a sliding window, so every
+# sample costs O(1):
+#	- weight is settled once the last `window` weights have standard deviation <= threshold
+#	  (or the scale reports S, if trust_scale is set),
+#	- it stops being settled as soon as a weight is further than `band` from the settled mean.
+# On each transition subscribers are called with (SETTLED or UNSETTLED, sample). The sample
+# passed with SETTLED carries the window mean as weight.
+#
+# update runs on the reader thread while configure and reset may be called from any other
+# (Libra.setProduct), so the state is changed under a lock. Subscribers are called after it
+# is released.
+class StabilityDetector():
+
+	def __init__(self, window=5, threshold=0.02, band=0.05, trust_scale=True):
+		self.subscribers = []
+		self.lock = threading.RLock()
+		self.log = lambda message: None  # gets subscriber errors, see _emit
+		self.configure(window, threshold, band, trust_scale)
+
+
+	@classmethod
+	def fromProfile(cls, name):
+		return cls(**PROFILES[name])
+
+
+	def configure(self, window=5, threshold=0.02, band=0.05, trust_scale=True):
+		with self.lock:
+			self.window = window
+			self.threshold = threshold
+			self.band = band
+			self.trust_scale = trust_scale
+			self.reset()
+
+
+	def reset(self):
+		with self.lock:
+			self.weights = collections.deque()
+			self.shift = 0.0  # sums are kept relative to this value to avoid cancellation
+			self.sum = 0.0
+			self.sum_sq = 0.0
+			self.settled = False
+			self.settled_sample = None  # sample passed with last SETTLED
+
+
+	def subscribe(self, callback):
+		self.subscribers.append(callback)
+
+
+	def unsubscribe(self, callback):
+		self.subscribers.remove(callback)
+
+
+	def mean(self):
+		return self.shift + self.sum / len(self.weights)
+
+
+	def std(self):
+		n = len(self.weights)
+		variance = (self.sum_sq - self.sum * self.sum / n) / n
+		return math.sqrt(max(variance, 0.0))
+
+
+	# Feed one sample, returns SETTLED or UNSETTLED on a transition, otherwise None.
+	def update(self, sample):
+		with self.lock:
+			event, sample = self._update(sample)
+		if event is not None:
+			self._emit(event, sample)
+		return event
+
+
+	# Returns (event or None, sample to pass with it). Call with lock held.
+	def _update(self, sample):
+		w = sample.weight
+		if not self.weights:
+			self.shift = w
+		d = w - self.shift
+		self.weights.append(d)
+		self.sum += d
+		self.sum_sq += d * d
+		if len(self.weights) > self.window:
+			old = self.weights.popleft()
+			self.sum -= old
+			self.sum_sq -= old * old
+
+		if self.settled:
+			if abs(w - self.settled_sample.weight) > self.band:
+				self.reset()
+				return UNSETTLED, sample
+			return None, sample
+
+		if self.trust_scale and sample.status == Status.STABLE:
+			weight = w
+		elif len(self.weights) >= self.window and self.std() <= self.threshold:
+			weight = self.mean()
+		else:
+			return None, sample
+
+		self.settled = True
+		self.settled_sample = Sample(sample.timestamp, Status.STABLE, weight, sample.unit)
+		return SETTLED, self.settled_sample
+
+
+	# A subscriber that raises is logged and skipped, update runs on the reader thread and
+	# must not die with it.
+	def _emit(self, event, sample):
+		for callback in list(self.subscribers):
+			try:
+				callback(event, sample)
+			except Exception as e:
+				self.log("[StabilityDetector] {0} failed on {1}: {2!r}".format(getattr(callback, "__qualname__", callback), event, e))
@@ -0,0 +1,276 @@
+import contextlib
+import threading
+import time
+
+import serial
+
+from sample import WALL_OFFSET, TIME_FORMAT
+
+
+# Seconds without data before the scale is considered stalled. With SIR active the scale
+# sends several lines per second, silence means the stream or the adapter is gone.
+READ_TIMEOUT = 2.0
+
+# Reconnect backoff in seconds, doubled after every failed attempt
+BACKOFF_MIN = 0.5
+BACKOFF_MAX = 30.0
+
+# Health states
+CONNECTED = "connected"
+STALLED = "stalled"  # port open but silent, SIR was sent again
+RECONNECTING = "reconnecting"
+CLOSED = "closed"
+
+
+
+# Time without data from the scale, written to the data file as a comment line so readers
+# that skip comments (numpy.loadtxt, archive.convertCsv) are not affected.
+class Gap():
+
+	__slots__ = ("start", "end")
+
+	def __init__(self, start, end):
+		self.start = start  # time.monotonic() of last data before the gap
+		self.end = end  # time.monotonic() of first data after it
+
+	def duration(self):
+		return self.end - self.start
+
+	def format(self):
+		start, end = (time.strftime(TIME_FORMAT, time.localtime(t + WALL_OFFSET)) for t in (self.start, self.end))
+		return "# gap,{0},{1},{2:.3f}\n".format(start, end, self.duration())
+
+	def __repr__(self):
+		return "Gap({0}, {1})".format(self.start, self.end)
+
+
+# Serial port that survives the scale or USB adapter going away. read() never raises on
+# port errors: it reconnects with exponential backoff and returns the next data once it
+# flows again. If the port name disappears (adapter plugged into another USB port), ports
+# are rescanned for the same device by serial number or USB ids.
+#
+# Callbacks, called on the reading thread:
+#	on_connect()        port (re)opened, e.g. send SIR again
+#	on_gap(gap)         first data after a reconnect or stall, with the Gap
+#	on_state(state)     health state changed
+class SerialTransport():
+
+	def __init__(self, port, read_timeout=READ_TIMEOUT, backoff_min=BACKOFF_MIN, backoff_max=BACKOFF_MAX, **serial_options):
+		self.port = port
+		self.serial_options = serial_options
+		self.read_timeout = read_timeout
+		self.backoff_min = backoff_min
+		self.backoff_max = backoff_max
+		self.delay = backoff_min  # wait after next failed reconnect
+
+		self.ser = None
+		self.device = None  # (serial number, vid, pid) of the port, used to find it again
+		self.write_lock = threading.Lock()
+		self.stopped = threading.Event()
+		self.on_connect = None
+		self.on_gap = None
+		self.on_state = None
+
+		self.state = CLOSED
+		self.state_since = time.monotonic()
+		self.last_data = None  # monotonic time data was last read
+		self.gap_start = None  # monotonic time the current gap started, None if data flows
+		self.reconnects = 0
+		self.gaps = 0
+		self.gap_seconds = 0.0
+		self.last_error = None
+		self.silenced = 0  # commands waiting that stop the stream, see silence()
+
+
+	def health(self):
+		return {
+			"state": self.state,
+			"port": self.port,
+			"since": self.state_since,
+			"last_data": self.last_data,
+			"reconnects": self.reconnects,
+			"gaps": self.gaps,
+			"gap_seconds": round(self.gap_seconds, 3),
+			"last_error": self.last_error
+		}
+
+
+	def isConnected(self):
+		return self.state == CONNECTED
+
+
+	def _setState(self, state):
+		if state == self.state:
+			return
+		self.state = state
+		self.state_since = time.monotonic()
+		if self.on_state is not None:
+			self.on_state(state)
+
+
+	# Open port once, raises serial.SerialException on failure.
+	def open(self):
+		ser = serial.Serial(port=self.port, timeout=self.read_timeout, **self.serial_options)
+		with self.write_lock:
+			self.ser = ser
+		self._setState(CONNECTED)
+		if self.on_connect is not None:
+			self.on_connect()
+
+
+	def _deviceOf(self, port):
+		import serial.tools.list_ports
+
+		for p in serial.tools.list_ports.comports():
+			if p.device == port:
+				return (p.serial_number, p.vid, p.pid)
+		return None
+
+
+	# Port of the same device, possibly under a new name. Falls back to the configured name.
+	def _findPort(self):
+		if self.device is None or self.device == (None, None, None):
+			return self.port
+		import serial.tools.list_ports
+
+		ports = list(serial.tools.list_ports.comports())
+		for p in ports:
+			if p.device == self.port:
+				return self.port
+		serial_number, vid, pid = self.device
+		for p in ports:
+			if serial_number is not None and p.serial_number == serial_number:
+				return p.device
+		for p in ports:
+			if serial_number is None and vid is not None and (p.vid, p.pid) == (vid, pid):
+				return p.device
+		return self.port
+
+
+	def _closePort(self):
+		with self.write_lock:
+			ser, self.ser = self.ser, None
+		if ser is not None:
+			try:
+				ser.close()
+			except (OSError, serial.SerialException):
+				pass
+
+
+	# Close the port, read() opens it again.
+	def disconnect(self, error=None):
+		if self.gap_start is None:
+			self.gap_start = self.last_data if self.last_data is not None else time.monotonic()
+		if error is not None:
+			self.last_error = str(error)
+		self._closePort()
+		self._setState(RECONNECTING)
+
+
+	# One attempt to open the port again, waits with backoff if it fails.
+	def reconnect(self):
+		self.port = self._findPort()
+		try:
+			self.open()
+			self.reconnects += 1
+			self.delay = self.backoff_min
+			return True
+		except (OSError, serial.SerialException) as e:
+			self.last_error = str(e)
+		self.stopped.wait(self.delay)
+		self.delay = min(self.delay * 2, self.backoff_max)
+		return False
+
+
+	# Bytes available from the scale, read in bulk (see framing.FrameParser for splitting
+	# them into lines). Returns b"" after a read timeout or failed reconnect (so callers can
+	# check their stop flags) and None once stopped. A read timeout first sends SIR again
+	# (on_connect), a second one in a row reopens the port.
+	def read(self):
+		while not self.stopped.is_set():
+			ser = self.ser
+			if ser is None:
+				if not self.reconnect():
+					return b""
+				continue
+			try:
+				data = ser.read(1)  # blocks until something comes or timeout
+				waiting = ser.in_waiting if data else 0
+				if waiting:
+					data += ser.read(waiting)
+			except (OSError, serial.SerialException, TypeError, AttributeError) as e:
+				# pyserial raises TypeError/AttributeError when the port is closed under it
+				if self.stopped.is_set():
+					return None
+				self.disconnect(e)
+				continue
+
+			if not data:
+				if self.stopped.is_set():
+					return None
+				if self.silenced:
+					return b""
+				if self.state == STALLED:
+					self.disconnect("no data for {0} s".format(2 * self.read_timeout))
+				else:
+					if self.gap_start is None:
+						self.gap_start = self.last_data if self.last_data is not None else time.monotonic()
+					self._setState(STALLED)
+					if self.on_connect is not None:
+						self.on_connect()
+				return b""
+
+			now = time.monotonic()
+			if self.last_data is None:
+				# looked up after the first data, scanning ports is too slow for start-up
+				self.device = self._deviceOf(self.port)
+			self.last_data = now
+			if self.gap_start is not None:
+				gap = Gap(self.gap_start, now)
+				self.gap_start = None
+				self.gaps += 1
+				self.gap_seconds += gap.duration()
+				self._setState(CONNECTED)
+				if self.on_gap is not None:
+					self.on_gap(gap)
+			return data
+		return None
+
+
+	# Commands like S and C2 end the SIR stream on the scale, while one waits for its response
+	# no data is expected and read timeouts are not taken for a stall.
+	#
+	#	with transport.silence():
+	#		commands.send(b"S\r\n", "S")
+	@contextlib.contextmanager
+	def silence(self):
+		with self.write_lock:
+			self.silenced += 1
+		try:
+			yield
+		finally:
+			with self.write_lock:
+				self.silenced -= 1
+
+
+	def write(self, data):
+		with self.write_lock:
+			if self.ser is None:
+				raise serial.SerialException("[SerialTransport] not connected")
+			try:
+				return self.ser.write(data)
+			except (OSError, serial.SerialException, TypeError, AttributeError) as e:
+				raise serial.SerialException("[SerialTransport] write failed: " + str(e))
+
+
+	def stop(self):
+		self.stopped.set()
+		self._closePort()
+		self._setState(CLOSED)
+
+
+	# Undo stop(), the next read() opens the port again.
+	def resume(self):
+		self.stopped.clear()
+		if self.ser is None:
+			self._setState(RECONNECTING)
@@ -0,0 +1,117 @@
+import math
+from array import array
+
+
+# Seconds shown by the trend, changed with the mouse wheel
+SPANS = (60, 10 * 60, 60 * 60, 6 * 60 * 60, 24 * 60 * 60)
+
+
+# Min and max weight per pixel column of a trend. Column n covers wall time
+# [n * step, (n + 1) * step) and lives in slot n % columns, like rollups.RollupLevel, so the
+# buffer scrolls by overwriting its oldest column and memory is fixed by the widget width
+# no matter how many samples or hours are shown.
+#
+# Columns changed since the last takeDirty() are tracked, so only they have to be drawn.
+class DecimationBuffer():
+
+	def __init__(self, columns, step):
+		self.columns = columns
+		self.step = step
+		self.bucket = array("q", [-1]) * columns
+		self.min = array("d", [math.inf]) * columns
+		self.max = array("d", [-math.inf]) * columns
+		self.newest = -1  # newest column with data
+		self.dirty = None  # (first, last) columns changed
+
+
+	def _slot(self, bucket):
+		i = bucket % self.columns
+		if self.bucket[i] != bucket:
+			if self.bucket[i] > bucket:  # older than what is kept
+				return -1
+			self.bucket[i] = bucket
+			self.min[i] = math.inf
+			self.max[i] = -math.inf
+		if bucket > self.newest:
+			self.newest = bucket
+		if self.dirty is None:
+			self.dirty = (bucket, bucket)
+		else:
+			self.dirty = (min(self.dirty[0], bucket), max(self.dirty[1], bucket))
+		return i
+
+
+	def add(self, t, weight):
+		i = self._slot(int(t // self.step))
+		if i < 0:
+			return
+		if weight < self.min[i]:
+			self.min[i] = weight
+		if weight > self.max[i]:
+			self.max[i] = weight
+
+
+	# Aggregate of many samples, e.g. a rollup bucket starting at t.
+	def addRange(self, t, low, high):
+		i = self._slot(int(t // self.step))
+		if i < 0:
+			return
+		if low < self.min[i]:
+			self.min[i] = low
+		if high > self.max[i]:
+			self.max[i] = high
+
+
+	# (min, max) of column bucket, None if it has no data.
+	def column(self, bucket):
+		i = bucket % self.columns
+		if self.bucket[i] != bucket or self.min[i] > self.max[i]:
+			return None
+		return (self.min[i], self.max[i])
+
+
+	# (min, max) over columns [first, last], None if they have no data.
+	def range(self, first, last):
+		low, high = math.inf, -math.inf
+		for bucket in range(max(first, last - self.columns + 1), last + 1):
+			i = bucket % self.columns
+			if self.bucket[i] == bucket:
+				low = min(low, self.min[i])
+				high = max(high, self.max[i])
+		return (low, high) if low <= high else None
+
+
+	# Columns changed since the last call as (first, last), None if nothing changed.
+	def takeDirty(self):
+		dirty, self.dirty = self.dirty, None
+		return dirty
+
+
+# Fill buffer with samples between t1 and t2 (wall clock seconds) from rollups and, when
+# columns are finer than the finest rollup, from whatever the ring buffer still holds. Work
+# done is bounded by the rollup levels and the ring capacity, not by the time span.
+def fill(buffer, rollups, ring, t1, t2, wall_offset):
+	level = None
+	for candidate in rollups.levels:
+		if candidate.resolution <= buffer.step:
+			level = candidate.resolution  # coarsest level still finer than a column
+	if level is not None:
+		trend = rollups.query(t1, t2, level)
+		for t, low, high in zip(trend["time"], trend["min"], trend["max"]):
+			buffer.addRange(t, low, high)
+		return
+
+	# A rollup bucket spans several columns but is drawn in the first, a change would show
+	# before it happened. Buckets are only used before the oldest sample of the ring.
+	segments = ring.window(ring.capacity)
+	oldest = min((timestamp[0] for timestamp, status, weight, unit in segments if len(timestamp)), default=None)
+	oldest = oldest + wall_offset if oldest is not None else t2
+	trend = rollups.query(t1, min(oldest, t2))
+	for t, low, high in zip(trend["time"], trend["min"], trend["max"]):
+		if t + trend["resolution"] <= oldest:
+			buffer.addRange(t, low, high)
+	for timestamp, status, weight, unit in segments:
+		for i in range(len(timestamp)):
+			t = timestamp[i] + wall_offset
+			if t1 <= t < t2:
+				buffer.add(t, weight[i])
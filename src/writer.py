@@ -0,0 +1,125 @@
+import os
+import time
+import queue
+
+
+# Durability modes
+FLUSH_BATCH = "flush_batch"  # hand every committed batch to the OS
+FSYNC_EVERY_N = "fsync_every_n"  # like FLUSH_BATCH, plus fsync after every N records
+FSYNC_ON_SHUTDOWN = "fsync_on_shutdown"  # keep data in our buffer, fsync only on rotate and close
+
+MODES = (FLUSH_BATCH, FSYNC_EVERY_N, FSYNC_ON_SHUTDOWN)
+
+
+# Take up to max_items from q. Blocks at most timeout seconds for the first item,
+# the rest are taken only if they are already waiting.
+def drain(q, max_items, timeout):
+	items = []
+	try:
+		items.append(q.get(timeout=max(timeout, 0.0)))
+		while len(items) < max_items:
+			items.append(q.get_nowait())
+	except queue.Empty:
+		pass
+	return items
+
+
+# Keeps one file open and appends lines to it in batches. A batch is committed when
+# batch_size lines are pending or when the oldest pending line is flush_interval seconds old.
+class BufferedWriter():
+
+	def __init__(self, path, mode=FLUSH_BATCH, batch_size=64, flush_interval=1.0, fsync_every=100, buffering=64*1024):
+		assert mode in MODES, "[BufferedWriter] Unknown durability mode " + str(mode)
+
+		self.path = None
+		self.mode = mode
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+		self.fsync_every = fsync_every
+		self.buffering = buffering
+
+		self.f = None
+		self.pending = []  # lines not yet handed to the file object
+		self.pending_since = None  # monotonic time of oldest pending line
+		self.unsynced = 0  # records written since last fsync
+		self.records = 0  # records written since open
+		self.commit_time = None  # optional metrics.Histogram, observes duration of every commit
+
+		self.open(path)
+
+
+	def open(self, path):
+		self.f = open(path, "a", buffering=self.buffering)
+		self.path = path
+
+
+	def write(self, line):
+		if not self.pending:
+			self.pending_since = time.monotonic()
+		self.pending.append(line)
+		if len(self.pending) >= self.batch_size:
+			self.commit()
+
+
+	def writelines(self, lines):
+		for line in lines:
+			self.write(line)
+
+
+	# Seconds until the pending batch has to be committed, used as a get timeout by callers.
+	def timeUntilFlush(self):
+		if not self.pending:
+			return self.flush_interval
+		return self.flush_interval - (time.monotonic() - self.pending_since)
+
+
+	# Commit pending lines if they have waited long enough.
+	def poll(self):
+		if self.pending and self.timeUntilFlush() <= 0:
+			self.commit()
+
+
+	def commit(self):
+		if not self.pending:
+			return
+		start = time.perf_counter()
+		n = len(self.pending)
+		self.f.write("".join(self.pending))
+		self.pending = []
+		self.pending_since = None
+		self.records += n
+		self.unsynced += n
+
+		if self.mode == FLUSH_BATCH:
+			self.f.flush()
+		elif self.mode == FSYNC_EVERY_N:
+			self.f.flush()
+			if self.unsynced >= self.fsync_every:
+				self.sync()
+
+		if self.commit_time is not None:
+			self.commit_time.observe(time.perf_counter() - start)
+
+
+	def sync(self):
+		self.f.flush()
+		os.fsync(self.f.fileno())
+		self.unsynced = 0
+
+
+	# Finish current file (everything pending goes to the old path) and continue in new one.
+	def rotate(self, path):
+		if path == self.path:
+			return
+		self.close()
+		self.open(path)
+
+
+	def close(self):
+		if self.f is None:
+			return
+		self.commit()
+		self.sync()
+		self.f.close()
+		self.f = None
+		self.records = 0
@@ -0,0 +1,56 @@
+import asyncio
+import os
+
+from async_libra import AsyncLibra
+from sample import Sample, Status
+
+
+# Serial port stand-in, the loop watches a pipe nobody writes to.
+class IdleSerial():
+
+	def __init__(self):
+		self.r, self.w = os.pipe()
+		self.timeout = None
+		self.written = []
+
+	def fileno(self):
+		return self.r
+
+	def write(self, data):
+		self.written.append(data)
+
+	def close(self):
+		os.close(self.r)
+		os.close(self.w)
+
+
+def weigh(libra, *weights):
+	for weight in weights:
+		libra._onLine(Sample(0.0, Status.UNSTABLE, weight + 3.0, "g"), b"SD")
+		libra._onLine(Sample(0.0, Status.STABLE, weight, "g"), b"S")
+	libra._wakeUp()
+
+
+def test_count_once_uses_counting_engine():
+	async def run():
+		async with AsyncLibra(ser=IdleSerial()) as libra:
+			task = asyncio.ensure_future(libra.count_once(reference_pieces=10, reference_group=True))
+			await asyncio.sleep(0)
+			weigh(libra, 20.0, 0.0, 100.2)
+			return await asyncio.wait_for(task, 1), libra.count_result
+	estimate, result = asyncio.run(run())
+	assert result.count == 50 and estimate == result.estimate and result.isCertain()
+
+
+def test_count_in_row_counts_settled_objects_until_stopped():
+	async def run():
+		async with AsyncLibra(ser=IdleSerial()) as libra:
+			stop = asyncio.Event()
+			task = asyncio.ensure_future(libra.count_in_row(stop))
+			await asyncio.sleep(0)
+			weigh(libra, 0.0, 5.0, 0.0, 7.0, 0.05)
+			await asyncio.sleep(0)
+			stop.set()
+			return await asyncio.wait_for(task, 1)
+	objects = asyncio.run(run())
+	assert [sample.weight for sample in objects] == [5.0, 7.0]
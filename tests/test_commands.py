@@ -0,0 +1,47 @@
+import threading
+
+import pytest
+
+from commands import CommandChannel
+from framing import FrameParser
+
+
+class Port():
+
+	def __init__(self):
+		self.written = []
+
+	def write(self, data):
+		self.written.append(data)
+
+
+def test_late_response_is_dropped_not_a_sample():
+	channel = CommandChannel(Port())
+	with pytest.raises(TimeoutError):
+		channel.send(b"T\r\n", "T", timeout=0.01)
+	frames = FrameParser().parse(b"T S       9.45 g\r\nS       9.45 g\r\n", 0.0)
+	assert frames[0][0] is None and channel.route(frames[0][1])
+	assert frames[1][0] is not None
+	assert not channel.late
+
+
+def test_late_busy_lines_are_dropped_until_the_final_one():
+	channel = CommandChannel(Port())
+	with pytest.raises(TimeoutError):
+		channel.send(b"C2\r\n", "C2", timeout=0.01)
+	assert channel.route(b'C2 B "put weight"')
+	assert channel.late
+	assert channel.route(b"C2 A")
+	assert not channel.route(b"C2 A")
+
+
+def test_response_still_goes_to_the_waiting_command():
+	channel = CommandChannel(Port())
+	result = []
+	thread = threading.Thread(target=lambda: result.append(channel.send(b"T\r\n", "T", timeout=5)))
+	thread.start()
+	while not channel.pending:
+		pass
+	assert channel.route(b"T S 1.00 g")
+	thread.join()
+	assert result == [["T S 1.00 g"]]
@@ -0,0 +1,71 @@
+import pytest
+
+from counting import PieceCounter, OnceCounting, RowCounting, CountingEngine, PIECE_CV, DONE
+from sample import Sample, Status
+from stability import StabilityDetector, SETTLED
+
+
+def settle(counting, *weights):
+	for weight in weights:
+		counting.feed(SETTLED, Sample(0.0, Status.STABLE, weight, "g"))
+
+
+def test_piece_std_needs_two_pieces_weighed_one_by_one():
+	counter = PieceCounter(scale_std=0.001)
+	counter.addReference(2.0)
+	assert counter.pieceStd() == pytest.approx(PIECE_CV * 2.0)
+	counter.addReference(2.2)
+	assert counter.pieceStd() == pytest.approx(0.1414, abs=1e-4)
+
+
+def test_group_reference_has_relative_piece_std():
+	counter = PieceCounter()
+	counter.setReference(20.0, 10)
+	assert counter.pieceWeight() == 2.0 and counter.referencePieces() == 10
+	assert counter.pieceStd() == pytest.approx(PIECE_CV * 2.0)
+	assert counter.count(100.0).isCertain()
+	assert not counter.count(200.0).isCertain()
+
+
+def test_once_counting_with_group_reference():
+	counting = OnceCounting(reference_pieces=10, reference_group=True)
+	counting.start(None)
+	settle(counting, 20.0, 0.0, 100.2)
+	assert counting.state == DONE
+	assert counting.counter.referencePieces() == 10
+	assert counting.result.count == 50
+
+
+class FullStore():
+
+	def beginSession(self):
+		return object()
+
+	def addObject(self, session, sample):
+		raise OSError(28, "No space left on device")
+
+	def endSession(self, session):
+		raise OSError(28, "No space left on device")
+
+
+def test_row_counting_fails_without_raising_when_store_fails():
+	detector = StabilityDetector(trust_scale=True)
+	engine = CountingEngine(detector)
+	messages = []
+	id = engine.start(RowCounting(FullStore(), log=messages.append))
+	counting = engine.get(id)
+	for weight in (0.0, 5.0):
+		detector.update(Sample(0.0, Status.UNSTABLE, 100.0, "g"))
+		detector.update(Sample(0.0, Status.STABLE, weight, "g"))
+	assert counting.state == DONE and "No space" in counting.error
+	assert engine.get(id) is None
+
+
+def test_failing_subscriber_does_not_stop_others():
+	detector = StabilityDetector(trust_scale=True)
+	seen, logged = [], []
+	detector.log = logged.append
+	detector.subscribe(lambda event, sample: 1 / 0)
+	detector.subscribe(lambda event, sample: seen.append(event))
+	detector.update(Sample(0.0, Status.STABLE, 1.0, "g"))
+	assert seen == [SETTLED] and "ZeroDivisionError" in logged[0]
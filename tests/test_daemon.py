@@ -0,0 +1,156 @@
+import json
+import socket
+import time
+
+import numpy
+import pytest
+
+import daemon
+import libra
+from offload import statsJob, samplesJob
+from ringbuffer import SampleRing
+from sample import Sample, Status, STATUS_NAMES, WALL_OFFSET
+
+
+def strict(line):
+	def reject(constant):
+		raise ValueError("not JSON: " + constant)
+	assert line.endswith("\n")
+	return json.loads(line, parse_constant=reject)
+
+
+def test_stats_of_single_object_session_is_strict_json():
+	stats = statsJob({"session": numpy.array([3], dtype=numpy.int64), "weight": numpy.array([12.5])})
+	assert stats["cp"] == [None] and stats["cpk"] == [None] and stats["std"] == [None]
+	message = strict(daemon.encode({"type": "stats", "counting": 1, "session": 3, "stats": stats}))
+	assert message["stats"]["mean"] == [12.5]
+
+
+def test_samples_summary_without_stable_samples_is_strict_json():
+	summary = samplesJob({
+		"timestamp": numpy.array([1.0, 2.0]),
+		"status": numpy.array([1, 1], dtype=numpy.uint8),
+		"weight": numpy.array([1.0, 3.0])
+	})
+	assert summary["stable_mean"] is None
+	assert strict(daemon.encode(summary))["mean"] == 2.0
+
+
+def test_non_finite_values_become_error_messages():
+	message = strict(daemon.encode({"type": "counting", "estimate": float("nan")}))
+	assert message["type"] == "error" and message["message"] == "counting"
+
+
+@pytest.mark.parametrize("status", list(Status))
+def test_sample_line_matches_sample_message(status):
+	ring = SampleRing(8)
+	ring.append(Sample(100.0, status, -1.25, "g"))
+	line = daemon.SAMPLE_LINE.format(0, ring.timestamp[0] + WALL_OFFSET, STATUS_NAMES[status], ring.weight[0], "g")
+	expected = daemon.sampleMessage(0, ring.record(0))
+	assert strict(line) == expected
+
+
+# What LibraServer uses of Libra, countings are only recorded.
+class StubScale():
+
+	def __init__(self):
+		self.samples = SampleRing(8)
+		self.listeners = []
+		self.running = set()
+		self.stability = self
+		self.counting = self
+
+	def subscribe(self, callback):
+		pass
+
+	def unsubscribe(self, callback):
+		pass
+
+	def get(self, id):
+		return id if id in self.running else None
+
+	def countApi(self, method, stop=False, id=None, **options):
+		if stop:
+			self.running.discard(id)
+			return id
+		id = len(self.running) + 1
+		self.running.add(id)
+		return id
+
+
+@pytest.fixture
+def server(tmp_path):
+	server = daemon.LibraServer(StubScale(), str(tmp_path / "libra.sock"))
+	server.start()
+	yield server
+	server.stop()
+
+
+def connect(server):
+	client = socket.socket(socket.AF_UNIX)
+	client.connect(server.address)
+	return client, client.makefile("r")
+
+
+def request(client, lines, message):
+	client.sendall((json.dumps(message) + "\n").encode("utf-8"))
+	return strict(lines.readline())
+
+
+def test_countings_of_disconnected_client_are_stopped(server):
+	client, lines = connect(server)
+	kept = request(client, lines, {"cmd": "count", "method": libra.COUNT_ROW})["counting"]
+	left = request(client, lines, {"cmd": "count", "method": libra.COUNT_ROW})["counting"]
+	assert request(client, lines, {"cmd": "stop", "counting": kept})["ok"]
+	server.scale.running.add(kept)  # started again by someone else, not this client's any more
+	lines.close()
+	client.close()
+	for i in range(100):
+		if left not in server.scale.running:
+			break
+		time.sleep(0.02)
+	assert server.scale.running == {kept}
+
+
+def test_error_reply_echoes_cmd_and_ref(server):
+	client, lines = connect(server)
+	reply = request(client, lines, {"cmd": "stop", "ref": 7})
+	assert reply["ok"] is False and reply["cmd"] == "stop" and reply["ref"] == 7
+	assert "counting" in reply["error"]
+	reply = request(client, lines, {"cmd": "count", "method": libra.COUNT_ROW, "ref": "a"})
+	assert reply["ok"] and reply["ref"] == "a"
+	lines.close()
+	client.close()
+
+
+def test_socket_in_use_is_not_taken_over(server):
+	other = daemon.LibraServer(StubScale(), server.address)
+	with pytest.raises(OSError):
+		other.start()
+	client, lines = connect(server)  # first server still answers
+	assert request(client, lines, {"cmd": "latest"})["sample"] is None
+	lines.close()
+	client.close()
+
+
+def test_stale_socket_is_replaced(tmp_path):
+	path = str(tmp_path / "libra.sock")
+	stale = socket.socket(socket.AF_UNIX)
+	stale.bind(path)
+	stale.close()  # file stays, nobody listens
+	server = daemon.LibraServer(StubScale(), path)
+	server.start()
+	client, lines = connect(server)
+	assert request(client, lines, {"cmd": "latest"})["ok"]
+	lines.close()
+	client.close()
+	server.stop()
+
+
+def test_reply_is_not_dropped_behind_events():
+	client = daemon.Client(None, None)
+	client.reply({"type": "reply", "ref": 1})
+	for i in range(2 * daemon.EVENT_QUEUE):
+		client.push({"type": "gap", "n": i})
+	assert list(client.replies) == [{"type": "reply", "ref": 1}]
+	assert len(client.events) == daemon.EVENT_QUEUE and client.events_dropped == daemon.EVENT_QUEUE
@@ -0,0 +1,86 @@
+import random
+import time
+
+import pytest
+
+from history import WeighingHistory, rowTime
+from sample import TIME_FORMAT
+
+
+START = time.mktime(time.strptime("10/18/2026, 08:00:00", TIME_FORMAT))
+
+
+def row(t, weight):
+	return "{0},S,{1:.2f},g,1.2,1013 mbar,40 %,21 C\n".format(time.strftime(TIME_FORMAT, time.localtime(t)), weight)
+
+
+# Rows a second or more apart with some gap comments, as Libra.writefile writes them.
+def rows(n, start, seed):
+	rng = random.Random(seed)
+	lines = []
+	t = start
+	for i in range(n):
+		t += rng.choice((0, 1, 1, 2, 5))
+		if rng.random() < 0.02:
+			lines.append("# gap,{0},{0},0.000\n".format(time.strftime(TIME_FORMAT, time.localtime(t))))
+		lines.append(row(t, rng.uniform(0, 100)))
+	return lines, t
+
+
+def bruteForce(lines, t1, t2):
+	times = [(rowTime(line.encode()), line) for line in lines]
+	return [line.rstrip("\n").split(",") for t, line in times if t is not None and t1 <= t < t2]
+
+
+@pytest.fixture
+def data(tmp_path):
+	path = str(tmp_path / "data.csv")
+	lines, end = rows(3000, START, seed=1)
+	with open(path, "w") as f:
+		f.writelines(lines)
+	history = WeighingHistory(path, stride=512)
+	yield path, history, lines, end
+	history.close()
+
+
+def test_range_queries_match_brute_force(data):
+	path, history, lines, end = data
+	rng = random.Random(2)
+	times = [(rowTime(line.encode()), line) for line in lines]
+	for i in range(200):
+		t1 = rng.uniform(START - 10, end + 10)
+		t2 = t1 + rng.choice((0, 1, 30, 600, 10 ** 5))
+		expected = [line.rstrip("\n").split(",") for t, line in times if t is not None and t1 <= t < t2]
+		assert history.rows(t1, t2) == expected
+
+
+def test_read_keeps_gap_comments(data):
+	path, history, lines, end = data
+	text = history.read(START, end + 1).decode()
+	assert text == "".join(lines)
+
+
+def test_rows_appended_later_are_found(data):
+	path, history, lines, end = data
+	history.rows(START, end)
+	more, last = rows(500, end, seed=3)
+	with open(path, "a") as f:
+		f.writelines(more)
+	lines = lines + more
+	assert history.rows(end - 100, last + 1) == bruteForce(lines, end - 100, last + 1)
+	assert history.update() == 0  # already indexed by the query
+
+	history.close()
+	reopened = WeighingHistory(path, stride=512)  # index is read back from the .tidx file
+	assert reopened.rows(START, last + 1) == bruteForce(lines, START, last + 1)
+	reopened.close()
+
+
+def test_partial_last_row_is_not_returned(data):
+	path, history, lines, end = data
+	with open(path, "a") as f:
+		f.write(row(end + 1, 5.0)[:20])
+	assert history.rows(end, end + 10) == bruteForce(lines, end, end + 10)
+	with open(path, "a") as f:
+		f.write(row(end + 1, 5.0)[20:])
+	assert history.rows(end + 1, end + 10) == [row(end + 1, 5.0).rstrip("\n").split(",")]
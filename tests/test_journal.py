@@ -0,0 +1,97 @@
+import os
+
+from journal import Journal, BEGIN, OBJECT, END, TIME
+from sample import Sample, Status
+from sessions import SessionStore
+
+
+def sample(weight, t=1000.0):
+	return Sample(t, Status.STABLE, weight, "g")
+
+
+def store(tmp_path, **options):
+	return SessionStore(str(tmp_path / "counting.csv"), commit_interval=0, **options)
+
+
+# Leaves the session open and closes the files, as if the process died.
+def crash(sessions):
+	sessions.journal.sync()
+	sessions.close()
+
+
+def test_interrupted_session_is_recovered(tmp_path):
+	sessions = store(tmp_path)
+	session = sessions.beginSession(start=50.0)
+	for weight in (10.0, 11.0, 12.0):
+		sessions.addObject(session, sample(weight))
+	crash(sessions)
+
+	sessions = store(tmp_path)
+	assert [info.pieces for info in sessions.recovered] == [3]
+	rows = sessions.readSession(sessions.recovered[0].id)
+	assert [row[4] for row in rows] == ["10.0", "11.0", "12.0"]
+	assert sessions.journal.records() == []
+	sessions.close()
+
+
+def test_session_written_before_crash_is_not_recovered_twice(tmp_path):
+	sessions = store(tmp_path)
+	session = sessions.beginSession(start=50.0)
+	sessions.addObject(session, sample(10.0))
+	with sessions.lock:  # rows reach the counting file, the process dies before END
+		sessions._write(session, [",".join(sample(10.0).format())], 60.0)
+	crash(sessions)
+
+	sessions = store(tmp_path)
+	assert len(sessions) == 1
+	assert sessions.recovered[0].id == session.id
+	sessions.close()
+
+
+def test_torn_record_is_dropped(tmp_path):
+	sessions = store(tmp_path)
+	session = sessions.beginSession(start=50.0)
+	sessions.addObject(session, sample(10.0))
+	crash(sessions)
+	with open(str(tmp_path / "counting.csv.wal"), "ab") as f:
+		f.write(b"\x10\x00\x00\x00garbage")
+
+	sessions = store(tmp_path)
+	assert [info.pieces for info in sessions.recovered] == [1]
+	assert os.path.getsize(str(tmp_path / "counting.csv.wal")) == 0
+	sessions.close()
+
+
+def test_journal_is_compacted_while_a_session_stays_open(tmp_path):
+	sessions = store(tmp_path, compact_size=4096)
+	leaked = sessions.beginSession(start=10.0)
+	sessions.addObject(leaked, sample(1.0))
+	for i in range(200):
+		session = sessions.beginSession(start=20.0 + i)
+		for weight in range(5):
+			sessions.addObject(session, sample(float(weight)))
+		sessions.endSession(session, end=20.5 + i)
+	assert os.path.getsize(str(tmp_path / "counting.csv.wal")) < 2 * 4096
+	assert len(sessions) == 200
+	crash(sessions)
+
+	sessions = store(tmp_path)
+	assert [info.pieces for info in sessions.recovered] == [1]
+	assert len(sessions) == 201
+	sessions.close()
+
+
+def test_compact_keeps_records_of_given_keys(tmp_path):
+	journal = Journal(str(tmp_path / "j.wal"), commit_interval=0)
+	journal.append(BEGIN, 1, TIME.pack(1.0))
+	journal.append(BEGIN, 2, TIME.pack(2.0))
+	journal.append(OBJECT, 1, TIME.pack(1.5) + b"row")
+	journal.append(END, 1)
+	journal.compact({2})
+	journal.append(OBJECT, 2, TIME.pack(2.5) + b"row")
+	assert journal.sync(timeout=5)
+	journal.close()
+
+	journal = Journal(str(tmp_path / "j.wal"), commit_interval=0)
+	assert [(type, key) for type, key, payload in journal.records()] == [(BEGIN, 2), (OBJECT, 2)]
+	journal.close()
@@ -0,0 +1,22 @@
+from ringbuffer import SampleRing
+from sample import Sample, Status
+
+
+def fill(ring, start, end):
+	for i in range(start, end):
+		ring.append(Sample(float(i), Status.STABLE, i * 0.5, "g"))
+
+
+def test_snapshot_is_a_copy_across_the_wrap():
+	ring = SampleRing(capacity=8)
+	fill(ring, 0, 11)
+	columns = ring.snapshot(ring.capacity)
+	assert list(columns["timestamp"]) == [float(i) for i in range(3, 11)]
+	fill(ring, 11, 19)  # laps the whole ring
+	assert list(columns["weight"]) == [i * 0.5 for i in range(3, 11)]
+	assert ring.unit_table.names[columns["unit"][0]] == "g"
+
+
+def test_snapshot_of_empty_ring():
+	columns = SampleRing(capacity=8).snapshot(4)
+	assert all(len(column) == 0 for column in columns.values())
@@ -0,0 +1,27 @@
+import time
+
+from rollups import Rollups
+from sample import Sample, Status, WALL_OFFSET
+
+
+def test_empty_level_query_does_not_scan_the_range():
+	rollups = Rollups()
+	start = time.perf_counter()
+	result = rollups.query(0, time.time() + 3e7, 1)
+	assert len(result["time"]) == 0
+	assert time.perf_counter() - start < 0.5
+
+
+def test_far_ends_are_cut_to_the_held_buckets():
+	rollups = Rollups()
+	now = time.time()
+	rollups.update(Sample(now - WALL_OFFSET, Status.STABLE, 5.0, "g"))
+	start = time.perf_counter()
+	result = rollups.query(-1e12, now + 3e7, 1)
+	assert list(result["max"]) == [5.0]
+	assert time.perf_counter() - start < 0.5
+
+
+def test_last_hour_comes_from_seconds():
+	assert Rollups().query(time.time() - 3600)["resolution"] == 1
+	assert Rollups().query(time.time() - 3700)["resolution"] == 60
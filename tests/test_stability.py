@@ -0,0 +1,37 @@
+import threading
+
+from sample import Sample, Status
+from stability import StabilityDetector, PROFILES
+
+
+# Sample that calls configure from another thread while update is reading it, as
+# Libra.setProduct may do while the reader thread is in update.
+class Intrusive(Sample):
+
+	def __init__(self, detector, *args):
+		Sample.__init__(self, *args)
+		self.detector = detector
+		self.thread = None
+		self.waited = None
+
+	@property
+	def status(self):
+		if self.thread is None:
+			self.thread = threading.Thread(target=self.detector.configure, kwargs=PROFILES["precise"])
+			self.thread.start()
+			self.thread.join(0.2)
+			self.waited = self.thread.is_alive()
+		return self._status
+
+	@status.setter
+	def status(self, status):
+		self._status = status
+
+
+def test_configure_waits_for_update_on_another_thread():
+	detector = StabilityDetector.fromProfile("default")
+	sample = Intrusive(detector, 0.0, Status.STABLE, 5.0, "g")
+	detector.update(sample)
+	sample.thread.join()
+	assert sample.waited
+	assert detector.window == PROFILES["precise"]["window"] and not detector.settled